@@ -0,0 +1,136 @@
+"""Command line entry point.
+
+    python -m crayon cache stats
+    python -m crayon cache gc --max-bytes 500M --max-age 30
+    python -m crayon prewarm lin:-1000:1000:1 log:-12:12 titles.txt
+
+"""
+
+import argparse
+import multiprocessing
+import sys
+import time
+
+from crayon.cache import CacheManager, DEFAULT_BASEDIR
+
+_units = dict(k=1 << 10, m=1 << 20, g=1 << 30)
+
+def _size(text):
+    """Parse a size such as 4096, 500K, 20M or 2G"""
+    text = text.strip().lower().rstrip('b')
+    scale = _units.get(text[-1:], 1)
+    if scale != 1:
+        text = text[:-1]
+    try:
+        return int(float(text) * scale)
+    except ValueError:
+        raise argparse.ArgumentTypeError('not a size: %r' % text)
+
+def _cache_stats(manager, args):
+    stats = manager.stats()
+    now = time.time()
+    print '%-32s %9s %12s %12s %8s' % ('template', 'entries', 'entry bytes',
+                                        'bytes', 'idle (d)')
+    for name, info in sorted(stats.iteritems()):
+        print '%-32s %9d %12d %12d %8.1f' % (
+            name, info['entries'], info['entry_bytes'], info['bytes'],
+            (now - info['last_used']) / 86400.0)
+    print '%-32s %9d %12d %12d' % (
+        'total', sum(i['entries'] for i in stats.itervalues()),
+        sum(i['entry_bytes'] for i in stats.itervalues()),
+        sum(i['bytes'] for i in stats.itervalues()))
+
+def _cache_gc(manager, args):
+    removed = manager.gc(keep=args.keep)
+    print 'removed %(directories)d directories, %(entries)d entries, ' \
+          '%(bytes)d bytes' % removed
+
+def _prewarm(manager, args):
+    # Imported here so the cache commands work without the latex side
+    from crayon.latex import TexRunner
+    from crayon.prewarm import read_source, prewarm
+
+    labels = []
+    for source in args.sources:
+        try:
+            labels.extend(read_source(source))
+        except (IOError, ValueError), e:
+            print >> sys.stderr, 'crayon prewarm: %s' % e
+            return 2
+
+    def progress(done, total):
+        print >> sys.stderr, '%d/%d' % (done, total)
+
+    runner = TexRunner(jobs=args.jobs, cache=manager)
+    try:
+        result = prewarm(runner, labels, batch=args.batch, svg=args.svg,
+                         force=args.force,
+                         progress=None if args.quiet else progress)
+    finally:
+        runner.close()
+
+    print '%(labels)d labels, %(failed)d failed' % result
+    if args.stats:
+        print runner.stats.report()
+    return 1 if result['failed'] else 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='crayon')
+    commands = parser.add_subparsers()
+
+    cache = commands.add_parser('cache', help='inspect or trim the cache')
+    cache.add_argument('--dir', default=DEFAULT_BASEDIR,
+                       help='cache directory (default %(default)s)')
+    actions = cache.add_subparsers()
+
+    stats = actions.add_parser('stats', help='show cache usage')
+    stats.set_defaults(run=_cache_stats)
+
+    gc = actions.add_parser('gc', help='evict entries and stale templates')
+    gc.add_argument('--max-bytes', type=_size,
+                    help='cap on total entry size, e.g. 500M')
+    gc.add_argument('--max-entries', type=int,
+                    help='cap on the number of entries')
+    gc.add_argument('--max-age', type=float,
+                    help='days after which an unused template directory '
+                         'is removed')
+    gc.add_argument('--keep', action='append', default=[],
+                    help='template hash never to remove (repeatable)')
+    gc.set_defaults(run=_cache_gc, max_bytes=None, max_entries=None,
+                    max_age=None)
+
+    warm = commands.add_parser('prewarm',
+                               help='compile known labels ahead of time')
+    warm.add_argument('sources', nargs='+', metavar='SOURCE',
+                      help='lin:A:B:STEP, log:A:B, a file with one label '
+                           'per line, or - for standard input')
+    warm.add_argument('--dir', default=DEFAULT_BASEDIR,
+                      help='cache directory (default %(default)s)')
+    warm.add_argument('--jobs', type=int,
+                      default=multiprocessing.cpu_count(),
+                      help='latex processes to run at once '
+                           '(default %(default)s)')
+    warm.add_argument('--batch', type=int, default=2000,
+                      help='labels per batch (default %(default)s)')
+    warm.add_argument('--force', action='store_true',
+                      help='compile labels that are already cached')
+    warm.add_argument('--no-svg', dest='svg', action='store_false',
+                      help='only fill the extents database')
+    warm.add_argument('--quiet', action='store_true',
+                      help='do not report progress')
+    warm.add_argument('--stats', action='store_true',
+                      help='print the time spent in each stage')
+    warm.set_defaults(run=_prewarm)
+
+    args = parser.parse_args(argv)
+
+    max_age = getattr(args, 'max_age', None)
+    manager = CacheManager(args.dir,
+                           max_bytes=getattr(args, 'max_bytes', None),
+                           max_entries=getattr(args, 'max_entries', None),
+                           max_age=None if max_age is None
+                                   else max_age * 86400.0)
+    return args.run(manager, args)
+
+if __name__ == '__main__':
+    sys.exit(main())
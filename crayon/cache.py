@@ -0,0 +1,669 @@
+"""On-disk caches shared between TexRunner instances and processes.
+
+"""
+
+import sqlite3
+import marshal
+import threading
+import struct
+import fcntl
+import mmap
+import zlib
+import shutil
+import errno
+import time
+import os
+
+DEFAULT_BASEDIR = os.path.expanduser('~/.cache/crayon')
+
+class _Store(object):
+    """An SQLite database in WAL mode, so readers carry on while another
+    process writes. One store may be shared between threads."""
+
+    ## SQLite limits the number of parameters in one statement
+    _chunk = 500
+
+    def __init__(self, filename, timeout, wal=True):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(filename, timeout=timeout,
+                                     isolation_level=None,
+                                     check_same_thread=False)
+        # WAL needs shared memory between the processes, which a network
+        # filesystem cannot give; the rollback journal only needs locks.
+        # None leaves the database as its owner set it up.
+        if wal is not None:
+            self._conn.execute('PRAGMA journal_mode=%s'
+                               % ('WAL' if wal else 'DELETE'))
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+
+    def _select(self, query, keys):
+        """Run query, which has one %s for a list of parameters, over keys
+        in chunks, generating the rows"""
+        keys = list(keys)
+        with self._lock:
+            for n in xrange(0, len(keys), self._chunk):
+                chunk = keys[n:n + self._chunk]
+                for row in self._conn.execute(
+                        query % ','.join('?' * len(chunk)), chunk):
+                    yield row
+
+    def _write(self, *statements):
+        """Run (sql, rows) pairs with executemany in one transaction"""
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                for sql, rows in statements:
+                    self._conn.executemany(sql, rows)
+            except:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class ExtentsStore(_Store):
+    """Extents keyed by Tex hash, kept in an SQLite database.
+
+    Each batch of extents is written in a single transaction.
+
+    """
+    _columns = ('y0', 'ymin', 'xmin', 'ymax', 'xmax', 'yn')
+
+    def __init__(self, filename, timeout=30.0, wal=True):
+        """Keyword arguments:
+            filename -- the database file, created if missing
+            timeout -- seconds to wait on another writer's lock (default 30)
+            wal -- use write-ahead logging, which is faster but needs a
+                   local filesystem (default True)
+
+        """
+        _Store.__init__(self, filename, timeout, wal)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS extents '
+            '(hash TEXT PRIMARY KEY, %s)'
+            % ', '.join('%s REAL NOT NULL' % c for c in self._columns))
+
+    def get_many(self, hashes):
+        """Return a dict mapping each known hash to its extents"""
+        query = 'SELECT hash, %s FROM extents WHERE hash IN (%%s)' % \
+                ', '.join(self._columns)
+        return dict((str(row[0]), tuple(row[1:]))
+                    for row in self._select(query, hashes))
+
+    def get(self, hash, default=None):
+        return self.get_many((hash,)).get(hash, default)
+
+    def put_many(self, items):
+        """Store an iterable of (hash, extents) pairs in one transaction"""
+        rows = [(h,) + tuple(ext) for h, ext in items]
+        if not rows:
+            return
+        insert = 'INSERT OR REPLACE INTO extents (hash, %s) VALUES (?, %s)' % \
+                 (', '.join(self._columns), ', '.join('?' * len(self._columns)))
+        self._write((insert, rows))
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT COUNT(*) FROM extents').fetchone()[0]
+
+class GlyphStore(_Store):
+    """Glyph outlines and the layouts of labels built from them, kept in an
+    SQLite database.
+
+    Each outline is stored once under its glyph key, however many labels
+    use it; a layout only holds the key and position of each glyph. A
+    layout of None records a label that cannot be drawn from outlines.
+
+    """
+    def __init__(self, filename, timeout=30.0, wal=True):
+        """Keyword arguments:
+            filename -- the database file, created if missing
+            timeout -- seconds to wait on another writer's lock (default 30)
+            wal -- as for ExtentsStore (default True)
+
+        """
+        _Store.__init__(self, filename, timeout, wal)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS glyphs '
+                           '(key TEXT PRIMARY KEY, outline BLOB NOT NULL)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS layouts '
+                           '(hash TEXT PRIMARY KEY, layout BLOB)')
+
+    def get_layouts(self, hashes):
+        """Return a dict mapping each known hash to its layout or None"""
+        query = 'SELECT hash, layout FROM layouts WHERE hash IN (%s)'
+        return dict((str(h), None if data is None else marshal.loads(data))
+                    for h, data in self._select(query, hashes))
+
+    def get_glyphs(self, keys):
+        """Return a dict mapping each known glyph key to its outline"""
+        query = 'SELECT key, outline FROM glyphs WHERE key IN (%s)'
+        return dict((str(k), marshal.loads(data))
+                    for k, data in self._select(query, keys))
+
+    def put(self, layouts, glyphs):
+        """Store an iterable of (hash, layout) pairs and a mapping of glyph
+        keys to outlines in one transaction. Glyphs already stored are left
+        alone."""
+        dump = lambda x: sqlite3.Binary(marshal.dumps(x))
+        layouts = [(h, None if l is None else dump(l)) for h, l in layouts]
+        glyphs = [(k, dump(o)) for k, o in glyphs.iteritems()]
+        if layouts or glyphs:
+            self._write(
+                ('INSERT OR IGNORE INTO glyphs (key, outline) VALUES (?, ?)',
+                 glyphs),
+                ('INSERT OR REPLACE INTO layouts (hash, layout) VALUES (?, ?)',
+                 layouts))
+
+class PackStore(_Store):
+    """Blobs keyed by hex hash, appended to a single pack file and found
+    through an SQLite index beside it (the pack's name plus .index), so
+    that looking up a batch of entries costs one query instead of a stat
+    and an open for each.
+
+    Each record in the pack is the binary hash, the payload length and a
+    flags byte, then the payload, compressed with zlib where that helps.
+    The pack is read through an mmap. Writers append to it holding a lockf
+    lock on its first byte, which remove() also takes while it rewrites the
+    pack without the entries it drops. A reader that looks in a pack
+    another process has just rewritten finds a record that does not carry
+    the hash it asked for and reports a miss, so at worst an entry is made
+    again.
+
+    lockf does not exclude threads of one process, and closing any
+    descriptor of the pack drops all of the process's locks on it, so
+    stores of the same pack in one process also share a threading lock,
+    held around everything they do with the pack file.
+
+    """
+    _header = struct.Struct('>16sIB')
+    _ZLIB = 1
+
+    ## Pack filename -> the lock its stores in this process share
+    _pack_locks = {}
+    _pack_locks_lock = threading.Lock()
+
+    def __init__(self, filename, timeout=30.0, wal=True, compress=True,
+                 readonly=False):
+        """Keyword arguments:
+            filename -- the pack file, created if missing
+            timeout -- seconds to wait on another writer's lock (default 30)
+            wal -- as for ExtentsStore, or None to leave an existing index
+                   as it is (default True)
+            compress -- compress new payloads (default True)
+            readonly -- only read an existing pack and index, creating
+                        neither (default False)
+
+        """
+        self.filename = filename
+        self.compress = compress
+        self.readonly = readonly
+        ## Guards the file descriptor and the mapping
+        self._pack_lock = self._shared_lock(filename)
+        self._fd = None
+        _Store.__init__(self, filename + '.index', timeout,
+                        None if readonly else wal)
+        if not readonly:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS entries '
+                               '(hash TEXT PRIMARY KEY, '
+                               'offset INTEGER NOT NULL, '
+                               'length INTEGER NOT NULL, '
+                               'used REAL NOT NULL)')
+        with self._pack_lock:
+            self._open()
+
+    @classmethod
+    def _shared_lock(cls, filename):
+        filename = os.path.realpath(filename)
+        with cls._pack_locks_lock:
+            try:
+                return cls._pack_locks[filename]
+            except KeyError:
+                lock = cls._pack_locks[filename] = threading.Lock()
+                return lock
+
+    def _open(self):
+        if self._fd is not None:
+            os.close(self._fd)
+        self._map = None
+        if self.readonly:
+            self._fd = os.open(self.filename, os.O_RDONLY)
+        else:
+            self._fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0666)
+        self._inode = os.fstat(self._fd).st_ino
+
+    def _refresh(self):
+        """Reopen the pack if it has been replaced by remove()"""
+        try:
+            if os.stat(self.filename).st_ino == self._inode:
+                return
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+        self._open()
+
+    def _lock_pack(self):
+        """Take the writer's lock on the current pack"""
+        while True:
+            self._refresh()
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, 0)
+            if os.stat(self.filename).st_ino == self._inode:
+                return
+            # Replaced while we waited
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, 0)
+
+    def _record(self, hash, offset, length):
+        """The whole record of hash at offset, or None if the pack holds
+        something else there"""
+        end = offset + length
+        if self._map is None or len(self._map) < end:
+            size = os.fstat(self._fd).st_size
+            if size < end:
+                return None
+            self._map = mmap.mmap(self._fd, size, access=mmap.ACCESS_READ)
+        if length < self._header.size:
+            return None
+        digest, nbytes, _ = self._header.unpack_from(self._map, offset)
+        if digest != hash.decode('hex') or \
+           nbytes != length - self._header.size:
+            return None
+        return self._map[offset:end]
+
+    def get_many(self, hashes, touch=True):
+        """Return a dict mapping each known hash to its payload. Unless
+        touch is false, the entries found are marked as used now."""
+        query = 'SELECT hash, offset, length FROM entries WHERE hash IN (%s)'
+        rows = list(self._select(query, hashes))
+        found = {}
+        with self._pack_lock:
+            self._refresh()
+            for h, offset, length in rows:
+                h = str(h)
+                record = self._record(h, offset, length)
+                if record is None:
+                    continue
+                _, _, flags = self._header.unpack_from(record)
+                data = record[self._header.size:]
+                found[h] = zlib.decompress(data) if flags & self._ZLIB \
+                           else data
+        if touch and found:
+            now = time.time()
+            self._write(('UPDATE entries SET used = ? WHERE hash = ?',
+                         [(now, h) for h in found]))
+        return found
+
+    def get(self, hash, default=None):
+        return self.get_many((hash,)).get(hash, default)
+
+    def put_many(self, items):
+        """Append an iterable of (hash, payload) pairs to the pack, and
+        index them in one transaction"""
+        records, rows = [], []
+        offset, now = 0, time.time()
+        for h, data in items:
+            flags = 0
+            if self.compress:
+                packed = zlib.compress(data)
+                if len(packed) < len(data):
+                    data, flags = packed, self._ZLIB
+            records.append(self._header.pack(h.decode('hex'), len(data),
+                                             flags) + data)
+            rows.append((h, offset, len(records[-1]), now))
+            offset += len(records[-1])
+        if not records:
+            return
+
+        data = ''.join(records)
+        with self._pack_lock:
+            self._lock_pack()
+            try:
+                start = os.lseek(self._fd, 0, os.SEEK_END)
+                while data:
+                    data = data[os.write(self._fd, data):]
+                self._write(('INSERT OR REPLACE INTO entries '
+                             '(hash, offset, length, used) VALUES (?, ?, ?, ?)',
+                             [(h, start + o, n, t) for h, o, n, t in rows]))
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, 0)
+
+    def entries(self):
+        """Return a list of (hash, bytes, last used) for every entry"""
+        with self._lock:
+            return [(str(h), n, t) for h, n, t in self._conn.execute(
+                'SELECT hash, length, used FROM entries')]
+
+    def remove(self, hashes):
+        """Drop the given entries and rewrite the pack without them, and
+        without any space lost to entries written over"""
+        hashes = set(hashes)
+        with self._pack_lock:
+            self._lock_pack()
+            try:
+                self._rewrite(hashes)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, 0)
+            self._open()
+
+    def _rewrite(self, hashes):
+        temp = '%s.%d.tmp' % (self.filename, os.getpid())
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._conn.execute('SELECT hash, offset, length '
+                                          'FROM entries ORDER BY offset')
+                kept, dropped, offset = [], [], 0
+                with open(temp, 'wb') as f:
+                    for h, old, length in rows.fetchall():
+                        h = str(h)
+                        record = None if h in hashes else \
+                                 self._record(h, old, length)
+                        if record is None:
+                            dropped.append((h,))
+                            continue
+                        f.write(record)
+                        kept.append((offset, h))
+                        offset += length
+                self._conn.executemany(
+                    'UPDATE entries SET offset = ? WHERE hash = ?', kept)
+                self._conn.executemany('DELETE FROM entries WHERE hash = ?',
+                                       dropped)
+                os.rename(temp, self.filename)
+            except:
+                self._conn.execute('ROLLBACK')
+                if os.path.exists(temp):
+                    os.remove(temp)
+                raise
+            self._conn.execute('COMMIT')
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def close(self):
+        with self._pack_lock:
+            if self._fd is not None:
+                self._map = None
+                os.close(self._fd)
+                self._fd = None
+        _Store.close(self)
+
+class LockFile(object):
+    """Advisory locks on byte ranges of one file, shared by all the processes
+    using a template directory.
+
+    Locks are taken with lockf, which unlike flock also works across hosts
+    on NFS. They belong to the process rather than the thread, and closing
+    the file drops all of them, so one LockFile is kept open for as long as
+    its locks are wanted. Threads sharing a LockFile may hold the same slot
+    at once, as when two entries hash onto it; the slot is counted, and
+    only unlocked when the last of them lets go. A process that dies loses
+    its locks.
+
+    """
+    ## Byte 0 is held shared by every TexRunner using the directory, and
+    ## byte 1 while the preamble format is built. Entries hash onto the
+    ## slots above; two entries sharing a slot only ever wait on each other.
+    TEMPLATE, PREAMBLE = 0, 1
+    _first_entry, _entry_slots = 16, 1 << 20
+
+    ## Seconds between tries while waiting for a slot another process has
+    _poll = 0.01, 0.2
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0666)
+        ## Slot -> how many holders in this process. Every lockf call is
+        ## made holding _held_lock, so that none undoes another's.
+        self._held = {}
+        self._held_lock = threading.Lock()
+
+    @classmethod
+    def entry(cls, hash):
+        """The slot of an entry, from its hex hash"""
+        return cls._first_entry + int(hash[:8], 16) % cls._entry_slots
+
+    def lock(self, slot, shared=False, blocking=True):
+        """Lock a slot. Returns False if blocking is false and another
+        process holds it. A slot this process already holds is counted
+        again, whether it was taken shared or not."""
+        op = (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB
+        delay, most = self._poll
+        while True:
+            with self._held_lock:
+                if slot in self._held:
+                    self._held[slot] += 1
+                    return True
+                try:
+                    fcntl.lockf(self._fd, op, 1, slot)
+                except IOError as exc:
+                    if exc.errno not in (errno.EACCES, errno.EAGAIN):
+                        raise
+                else:
+                    self._held[slot] = 1
+                    return True
+            ## Waiting in lockf itself would keep the other threads from
+            ## their slots meanwhile, so poll instead
+            if not blocking:
+                return False
+            time.sleep(delay)
+            delay = min(2 * delay, most)
+
+    def unlock(self, slot):
+        with self._held_lock:
+            count = self._held.get(slot, 0)
+            if count > 1:
+                self._held[slot] = count - 1
+                return
+            self._held.pop(slot, None)
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, slot)
+
+    def close(self):
+        with self._held_lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            self._held.clear()
+
+## Template directory -> number of TexRunners in this process using it.
+## lockf locks belong to the process, so probing them tells us nothing about
+## our own runners, and closing the probe would drop their locks.
+_held_templates = {}
+_held_templates_lock = threading.Lock()
+
+def hold_template(path):
+    """Note that a TexRunner in this process uses the template directory at
+    path, so that gc leaves it alone until release_template"""
+    path = os.path.realpath(path)
+    with _held_templates_lock:
+        _held_templates[path] = _held_templates.get(path, 0) + 1
+
+def release_template(path):
+    path = os.path.realpath(path)
+    with _held_templates_lock:
+        if _held_templates.get(path, 0) > 1:
+            _held_templates[path] -= 1
+        else:
+            _held_templates.pop(path, None)
+
+def template_held(path):
+    """True if a TexRunner in this process holds the template directory"""
+    with _held_templates_lock:
+        return os.path.realpath(path) in _held_templates
+
+class CacheManager(object):
+    """Keeps the cache directory within bounds.
+
+    The base directory holds one subdirectory per template hash. Entries are
+    the rendered SVGs within them, kept in a pack (see PackStore) or, as
+    older versions left them, one file each. They are evicted least
+    recently used first, going by when the TexRunner last looked them up,
+    or for files by the later of their access and modification times
+    (since many filesystems are mounted without atime updates). Template
+    directories that have not
+    been used for max_age seconds are removed altogether, unless a TexRunner
+    in this process, or one in shared mode elsewhere, still has them open.
+
+    """
+    entry_suffix = '.svg'
+    pack_name = 'svgs.pack'
+    lock_name = 'lock'
+
+    def __init__(self, basedir=DEFAULT_BASEDIR, max_bytes=None,
+                 max_entries=None, max_age=None):
+        """Keyword arguments:
+            basedir -- the cache directory (default ~/.cache/crayon)
+            max_bytes -- cap on the total size of all entries (default None)
+            max_entries -- cap on the number of entries (default None)
+            max_age -- seconds after which an unused template directory is
+                       removed (default None)
+
+        """
+        self.basedir = basedir
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.max_age = max_age
+
+    def stats(self):
+        """Return a dict mapping each template directory to a dict of its
+        entry count, entry bytes, total bytes and last use."""
+        result = {}
+        for name, path in self._templatedirs():
+            entries, total, last_used = 0, 0, os.stat(path).st_mtime
+            entry_bytes = 0
+            for filename, st in self._files(path):
+                total += st.st_size
+                last_used = max(last_used, st.st_atime, st.st_mtime)
+                if filename.endswith(self.entry_suffix):
+                    entries += 1
+                    entry_bytes += st.st_size
+            for _, nbytes, used in self._pack_entries(path):
+                entries += 1
+                entry_bytes += nbytes
+                last_used = max(last_used, used)
+            result[name] = dict(entries=entries, entry_bytes=entry_bytes,
+                                bytes=total, last_used=last_used)
+        return result
+
+    def gc(self, keep=(), now=None):
+        """Remove stale template directories, then evict entries until the
+        caps are met. Template hashes in keep are never removed wholesale.
+        Returns a dict counting removed directories, entries and bytes."""
+        now = time.time() if now is None else now
+        removed = dict(directories=0, entries=0, bytes=0)
+
+        if self.max_age is not None:
+            for name, info in self.stats().iteritems():
+                if name in keep or now - info['last_used'] <= self.max_age:
+                    continue
+                if self._in_use(os.path.join(self.basedir, name)):
+                    continue
+                shutil.rmtree(os.path.join(self.basedir, name),
+                              ignore_errors=True)
+                removed['directories'] += 1
+                removed['entries'] += info['entries']
+                removed['bytes'] += info['bytes']
+
+        if self.max_bytes is None and self.max_entries is None:
+            return removed
+
+        # (last used, bytes, file, hash within the pack or None)
+        entries = []
+        ## Packs that TexRunners in this process have open may be written
+        ## to at any moment, so are left for their own gc
+        held = set()
+        for _, path in self._templatedirs():
+            for filename, st in self._files(path):
+                if filename.endswith(self.entry_suffix):
+                    entries.append((max(st.st_atime, st.st_mtime), st.st_size,
+                                    os.path.join(path, filename), None))
+            pack = os.path.join(path, self.pack_name)
+            if template_held(path):
+                held.add(pack)
+            entries.extend((used, nbytes, pack, h)
+                           for h, nbytes, used in self._pack_entries(path))
+
+        # Oldest first
+        entries.sort()
+        count = len(entries)
+        size = sum(e[1] for e in entries)
+        max_entries = count if self.max_entries is None else self.max_entries
+        max_bytes = size if self.max_bytes is None else self.max_bytes
+
+        evicted = {}
+        for _, nbytes, filename, h in entries:
+            if count <= max_entries and size <= max_bytes:
+                break
+            if filename in held:
+                continue
+            if h is not None:
+                evicted.setdefault(filename, []).append(h)
+            else:
+                try:
+                    os.remove(filename)
+                except OSError as exc:
+                    if exc.errno != errno.ENOENT:
+                        raise
+            count -= 1
+            size -= nbytes
+            removed['entries'] += 1
+            removed['bytes'] += nbytes
+
+        # Each pack is rewritten once, without all of its evicted entries
+        for filename, hashes in evicted.iteritems():
+            store = PackStore(filename, wal=None)
+            try:
+                store.remove(hashes)
+            finally:
+                store.close()
+
+        return removed
+
+    def _pack_entries(self, path):
+        """(hash, bytes, last used) of each entry in the pack of a template
+        directory"""
+        filename = os.path.join(path, self.pack_name)
+        if not (os.path.exists(filename) and
+                os.path.exists(filename + '.index')):
+            return []
+        store = PackStore(filename, readonly=True)
+        try:
+            return store.entries()
+        except sqlite3.OperationalError:
+            # An index whose table was never made
+            return []
+        finally:
+            store.close()
+
+    def _in_use(self, path):
+        if template_held(path):
+            return True
+        filename = os.path.join(path, self.lock_name)
+        if not os.path.exists(filename):
+            return False
+        locks = LockFile(filename)
+        try:
+            return not locks.lock(LockFile.TEMPLATE, blocking=False)
+        finally:
+            locks.close()
+
+    def _templatedirs(self):
+        try:
+            names = os.listdir(self.basedir)
+        except OSError as exc:
+            if exc.errno == errno.ENOENT:
+                return []
+            raise
+        paths = ((n, os.path.join(self.basedir, n)) for n in sorted(names))
+        return [(n, p) for n, p in paths if os.path.isdir(p)]
+
+    def _files(self, path):
+        for filename in os.listdir(path):
+            try:
+                st = os.stat(os.path.join(path, filename))
+            except OSError:
+                # Evicted or renamed under our feet by another process
+                continue
+            yield filename, st
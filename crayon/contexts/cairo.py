@@ -27,8 +27,16 @@ anchors = dict(
 
 class CairoCanvas(object):
     """Low-level stateful graphics context"""
-    def __init__(self, context, texrenderer, width, height):
+    def __init__(self, context, texrenderer, width, height, outlines=False):
+        """Keyword arguments:
+            outlines -- draw labels from their glyph outlines rather than
+                        through dvisvgm where the fonts allow (default False)
+
+        """
         self._height = height
+        self._outlines = outlines
+        ## Glyph key -> cairo path, so each glyph is only traced once
+        self._glyph_paths = {}
         paper = Space2D(LinSpace(0,width),LinSpace(0, height))
         self._scopes = dict(box = BoxSpace(), paper = paper, absolute=paper)
         self._default = paper
@@ -41,7 +49,7 @@ class CairoCanvas(object):
         context.set_line_join(1)
     
     def user_to_device(self, marker):
-        x, y = marker.absolute.pos
+        x, y = marker.pos_in('absolute')
         pos = (x, self._height - y)
         return pos
 
@@ -103,12 +111,29 @@ class CairoCanvas(object):
         x,y = self.user_to_device(pos)
         anchor = anchors[anchor]
         texes = self._texrenderer.render([label])
-        tex, = self._texrenderer.to_svg(texes)
+        tex, = texes
+        layout = None
+        if self._outlines:
+            self._texrenderer.to_glyphs(texes)
+            if tex.glyphs is not False:
+                layout = tex.glyphs
+        if layout is None:
+            self._texrenderer.to_svg(texes)
+        if tex.error:
+            # Nothing to draw; the error is on the Tex object for the caller
+            return
         s = TP2MM
         c = self.context
+        # Outlines are filled in place, so the current path has to be kept
+        # aside while they are drawn
+        saved = c.copy_path()
+        c.new_path()
+        if layout is not None:
+            glyphs = self._glyph_paths_for(layout)
         c.save()
         c.translate(x,y)
-        c.push_group()
+        if layout is None:
+            c.push_group()
         c.scale(s,s)
 
         y0, ymin, xmin, ymax, xmax, yn = tex.extents
@@ -133,22 +158,73 @@ class CairoCanvas(object):
 
         #c.scale(PT2TP, PT2TP)
         #c.scale(90/96.0, 90/96.0)
-        tex.svg.render_cairo(c)
-        surface = c.pop_group()
-        if color:
-            c.set_source_rgb(*color.rgb.color)
-        c.mask(surface)
+        if layout is not None:
+            for item in layout:
+                if item[0] == 'glyph':
+                    _, key, gx, gy = item
+                    c.save()
+                    c.translate(gx, gy)
+                    c.append_path(glyphs[key])
+                    c.restore()
+                else:
+                    _, left, bottom, w, h = item
+                    c.rectangle(left, bottom - h, w, h)
+            if color:
+                c.set_source_rgb(*color.rgb.color)
+            c.fill()
+        else:
+            tex.svg.render_cairo(c)
+            surface = c.pop_group()
+            if color:
+                c.set_source_rgb(*color.rgb.color)
+            c.mask(surface)
         c.restore()
+        c.append_path(saved)
+
+    def _glyph_paths_for(self, layout):
+        """Return a dict of cairo paths for the glyphs a layout uses,
+        tracing any not seen before. The current path must be empty."""
+        c = self.context
+        keys = set(i[1] for i in layout if i[0] == 'glyph')
+        missing = [k for k in keys if k not in self._glyph_paths]
+        if missing:
+            outlines = self._texrenderer.outlines(missing)
+            for key in missing:
+                for op in outlines[key]:
+                    if op[0] == 'M':
+                        c.move_to(*op[1:])
+                    elif op[0] == 'L':
+                        c.line_to(*op[1:])
+                    elif op[0] == 'C':
+                        c.curve_to(*op[1:])
+                    else:
+                        c.close_path()
+                self._glyph_paths[key] = c.copy_path()
+                c.new_path()
+        return dict((k, self._glyph_paths[k]) for k in keys)
 
     def make_strings(self, strings):
-        self._texes = self._texrenderer.render(strings)
+        # Only sizes are needed here; plain numbers skip latex altogether
+        self._texes = self._texrenderer.measure(strings)
         for t in self._texes:
+            if t.error:
+                t.size = 0.0, 0.0
+                continue
             y0, ymin, xmin, ymax, xmax, y1 = t.extents
             t.size = TP2MM * (xmax - xmin), TP2MM * (ymax - ymin)
         return self._texes
 
     def make_svgs(self):
-        texes = self._texrenderer.to_svg(self._texes)
-        for tex in texes:
-            if not hasattr(tex, 'svg'):
-                tex.svg = rsvg.Handle(file=tex.svgfile)
+        texes = self._texes
+        if self._outlines:
+            self._texrenderer.to_glyphs(texes)
+            texes = [t for t in texes if t.glyphs is False]
+        texes = self._texrenderer.to_svg(texes)
+        todo = [t for t in texes if not hasattr(t, 'svg') and t.svgdata]
+        with self._texrenderer.stats.stage('rsvg', len(todo)) as run:
+            for tex in todo:
+                tex.svg = rsvg.Handle(data=tex.svgdata)
+                # A parsed SVG takes a few times its document size in memory
+                tex.svg_bytes = 4 * len(tex.svgdata)
+                run.strings_out += 1
+        self._texrenderer.update_sizes(todo)
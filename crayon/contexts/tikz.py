@@ -31,7 +31,7 @@ class TikzCanvas(object):
     def push_path(self, markers, closed=False):
         """Draws a path of markers"""
         buffer = ' -- '.join(
-            '(%gmm, %gmm)' % self.user_to_device(m.absolute.pos)
+            '(%gmm, %gmm)' % self.user_to_device(m.pos_in('absolute'))
             for m in markers)
         if closed:
             buffer = buffer + ' -- cycle'
@@ -67,7 +67,7 @@ class TikzCanvas(object):
                                         r'\end{document}'])
 
     def text(self, pos, label, anchor=None):
-        x, y = pos.absolute.pos
+        x, y = pos.pos_in('absolute')
         if anchor:
             s = r'\node [anchor=%s] at (%gmm, %gmm) {%s};' % (anchor, x, y, label)
         else:
@@ -0,0 +1,284 @@
+"""Reading and rewriting DVI files.
+
+DviFile gives random access to the pages of a DVI file, walks the commands
+on each page, and works out where each character and rule ends up.
+concatenate() builds a new DVI file out of pages
+taken from several others, renumbering fonts as it goes, so that pages from
+many latex runs can be handed to one external tool.
+
+"""
+
+import mmap
+import struct
+
+SET1, SET_RULE, PUT1, PUT_RULE, NOP, BOP, EOP, PUSH, POP = \
+    128, 132, 133, 137, 138, 139, 140, 141, 142
+RIGHT1, W0, W1, X0, X1, DOWN1, Y0, Y1, Z0, Z1 = \
+    143, 147, 148, 152, 153, 157, 161, 162, 166, 167
+FNT_NUM_0, FNT1, XXX1, FNT_DEF1, PRE, POST, POST_POST = \
+    171, 235, 239, 243, 247, 248, 249
+
+## The fixed arguments of each opcode, as (bytes, signed) pairs. Specials
+## and font definitions have a variable length payload after these.
+_arguments = [()] * 256
+for _i in xrange(4):
+    _n = ((_i + 1, _i == 3),)
+    _signed = ((_i + 1, True),)
+    _arguments[SET1 + _i] = _arguments[PUT1 + _i] = _n
+    _arguments[FNT1 + _i] = _arguments[XXX1 + _i] = _n
+    _arguments[FNT_DEF1 + _i] = _n + ((4, False), (4, True), (4, True),
+                                     (1, False), (1, False))
+    for _op in (RIGHT1, W1, X1, DOWN1, Y1, Z1):
+        _arguments[_op + _i] = _signed
+_arguments[SET_RULE] = _arguments[PUT_RULE] = ((4, True), (4, True))
+_arguments[BOP] = ((4, True),) * 11
+_arguments = tuple(_arguments)
+
+_formats = {(1, False): '>B', (2, False): '>H', (4, False): '>I',
+            (1, True): '>b', (2, True): '>h', (4, True): '>i'}
+
+def _read(data, pos, size, signed):
+    """Read a big-endian integer of the given size at pos"""
+    try:
+        return struct.unpack_from(_formats[size, signed], data, pos)[0]
+    except KeyError:
+        # Three byte numbers
+        value = struct.unpack_from('>I', '\0' + data[pos:pos + 3])[0]
+        if signed and value >= 0x800000:
+            value -= 0x1000000
+        return value
+
+def commands(data, start=0, end=None):
+    """Generate (opcode, arguments, position, next position) for each DVI
+    command in data from start, stopping before end or after the first
+    eop."""
+    end = len(data) if end is None else end
+    pos = start
+    while pos < end:
+        op = ord(data[pos])
+        nxt = pos + 1
+        args = []
+        for size, signed in _arguments[op]:
+            args.append(_read(data, nxt, size, signed))
+            nxt += size
+        if XXX1 <= op < FNT_DEF1:
+            args.append(data[nxt:nxt + args[0]])
+            nxt += args[0]
+        elif FNT_DEF1 <= op < PRE:
+            length = args[4] + args[5]
+            area, name = data[nxt:nxt + args[4]], data[nxt + args[4]:
+                                                      nxt + length]
+            args[4:] = [area, name]
+            nxt += length
+        elif op >= PRE:
+            raise ValueError('Unexpected opcode %d at %d' % (op, pos))
+        yield op, args, pos, nxt
+        if op == EOP:
+            return
+        pos = nxt
+
+def marks(ops, fonts, char_width, font=None):
+    """Generate what a sequence of commands puts on paper, with v increasing
+    downwards. Characters come as ('char', FontDef, code, h, v) and rules as
+    ('rule', h, v, width, height), with v the bottom of the rule.
+
+    ops -- (opcode, arguments, ...) tuples, as from commands()
+    fonts -- maps font numbers to FontDefs
+    char_width -- char_width(font, code) gives the width that setting a
+                  character moves along by
+    font -- the font in use before the first font command (default None)
+
+    """
+    h = v = w = x = y = z = 0
+    stack = []
+    for op, args, _, _ in ops:
+        if op < SET1 or SET1 <= op < SET_RULE or PUT1 <= op < PUT_RULE:
+            code = op if op < SET1 else args[0]
+            yield ('char', font, code, h, v)
+            if op < SET_RULE:
+                h += char_width(font, code)
+        elif op == SET_RULE or op == PUT_RULE:
+            height, width = args
+            if height > 0 and width > 0:
+                yield ('rule', h, v, width, height)
+            if op == SET_RULE:
+                h += width
+        elif op == PUSH:
+            stack.append((h, v, w, x, y, z))
+        elif op == POP:
+            h, v, w, x, y, z = stack.pop()
+        elif RIGHT1 <= op < W0:
+            h += args[0]
+        elif W0 <= op < X0:
+            if args:
+                w = args[0]
+            h += w
+        elif X0 <= op < DOWN1:
+            if args:
+                x = args[0]
+            h += x
+        elif DOWN1 <= op < Y0:
+            v += args[0]
+        elif Y0 <= op < Z0:
+            if args:
+                y = args[0]
+            v += y
+        elif Z0 <= op < FNT_NUM_0:
+            if args:
+                z = args[0]
+            v += z
+        elif FNT_NUM_0 <= op < XXX1:
+            font = fonts[op - FNT_NUM_0 if op < FNT1 else args[0]]
+
+class FontDef(object):
+    """A font definition as found in a DVI or VF file"""
+    def __init__(self, checksum, scale, design, area, name):
+        self.checksum = checksum
+        self.scale = scale
+        self.design = design
+        self.area = area
+        self.name = name
+
+    @property
+    def key(self):
+        """Identifies the same font at the same size across files"""
+        return (self.area, self.name, self.checksum, self.scale, self.design)
+
+    def __repr__(self):
+        return '<FontDef %s at %g>' % (self.name, self.scale / 65536.0)
+
+class DviFile(object):
+    """A DVI file opened for random access to its pages"""
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        data = self._data
+
+        if ord(data[0]) != PRE:
+            raise ValueError('%s is not a DVI file' % filename)
+        self.num, self.den, self.mag = struct.unpack_from('>III', data, 2)
+        k = ord(data[14])
+        self.comment = data[15:15 + k]
+
+        # The file ends with the postamble pointer and at least four 223s
+        end = len(data) - 1
+        while ord(data[end]) == 223:
+            end -= 1
+        post = _read(data, end - 4, 4, False)
+        if ord(data[post]) != POST:
+            raise ValueError('%s has no postamble' % filename)
+
+        last, _, _, _, self.max_height, self.max_width, self.max_stack, \
+            count = struct.unpack_from('>iIIIIIHH', data, post + 1)
+
+        self.fonts = {}
+        for op, args, _, _ in self.ops(post + 29, end - 5):
+            if FNT_DEF1 <= op < PRE:
+                self.fonts[args[0]] = FontDef(*args[1:])
+
+        # Follow the chain of back pointers from the last page
+        self.pages = []
+        while last >= 0:
+            self.pages.append(last)
+            last = _read(data, last + 41, 4, True)
+        self.pages.reverse()
+
+        if len(self.pages) != count:
+            raise ValueError('%s is damaged' % filename)
+
+    def ops(self, start, end=None):
+        """Generate (opcode, arguments, position, next position) for each
+        command from start, stopping after end or the first eop."""
+        return commands(self._data, start, end)
+
+    def page(self, number):
+        """Generate the commands of the given page (counting from 1)"""
+        return self.ops(self.pages[number - 1])
+
+    @property
+    def scale(self):
+        """Size of a DVI unit in TeX points"""
+        return self.num / float(self.den) * self.mag / 1000.0 * 72.27 / 254000
+
+    def marks(self, number, char_width):
+        """Generate what the given page puts on paper, in DVI units. See
+        marks()."""
+        return marks(self.page(number), self.fonts, char_width)
+
+    def raw(self, start, end):
+        return self._data[start:end]
+
+    def close(self):
+        self._data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _font_def(number, font):
+    return struct.pack('>BiIiiBB', FNT_DEF1 + 3, number, font.checksum,
+                       font.scale, font.design, len(font.area),
+                       len(font.name)) + font.area + font.name
+
+def concatenate(pages, filename, comment=' crayon'):
+    """Write a new DVI file to filename holding the given pages, a sequence
+    of (DviFile, page number) pairs, in order. Fonts are renumbered so that
+    the same font in different files shares a single definition."""
+    pages = list(pages)
+    sources = []
+    for dvi, _ in pages:
+        if dvi not in sources:
+            sources.append(dvi)
+    first = sources[0]
+
+    out = []
+    length = [0]
+    def emit(bytes):
+        out.append(bytes)
+        length[0] += len(bytes)
+
+    emit(struct.pack('>BBIIIB', PRE, 2, first.num, first.den, first.mag,
+                     len(comment)) + comment)
+
+    numbers = {}
+    fonts = []
+    previous = -1
+
+    for dvi, number in pages:
+        for op, args, pos, nxt in dvi.page(number):
+            if op == BOP:
+                bop = length[0]
+                emit(struct.pack('>B10ii', BOP, *(args[:10] + [previous])))
+                previous = bop
+            elif FNT_NUM_0 <= op < XXX1:
+                font = dvi.fonts[op - FNT_NUM_0 if op < FNT1 else args[0]]
+                try:
+                    k = numbers[font.key]
+                except KeyError:
+                    # Define each font just before its first use
+                    k = numbers[font.key] = len(fonts)
+                    fonts.append(font)
+                    emit(_font_def(k, font))
+                emit(chr(FNT_NUM_0 + k) if k < 64
+                     else struct.pack('>BI', FNT1 + 3, k))
+            elif FNT_DEF1 <= op < PRE:
+                # Our own definitions are emitted instead
+                pass
+            else:
+                emit(dvi.raw(pos, nxt))
+
+    post = length[0]
+    emit(struct.pack('>BiIIIIIHH', POST, previous, first.num, first.den,
+                     first.mag, max(d.max_height for d in sources),
+                     max(d.max_width for d in sources),
+                     max(d.max_stack for d in sources), len(pages)))
+    for k, font in enumerate(fonts):
+        emit(_font_def(k, font))
+    emit(struct.pack('>BIB', POST_POST, post, 2))
+    emit(chr(223) * (4 + (-length[0] - 4) % 4))
+
+    with open(filename, 'wb') as f:
+        f.write(''.join(out))
@@ -0,0 +1,501 @@
+"""Font files used by TeX, and finding them.
+
+Tfm reads the metrics TeX itself typesets with, which is enough to work out
+where every glyph on a DVI page sits. Vf reads virtual fonts, whose
+characters are little DVI programs over other fonts. FontMap, read_encoding
+and Type1Font get from a TeX font name to the outline of each of its
+glyphs.
+
+"""
+
+import binascii
+import struct
+import subprocess
+import threading
+import re
+
+from dvi import FontDef
+
+_found = {}
+_found_lock = threading.Lock()
+
+def find_file(name):
+    """Locate a TeX support file with kpsewhich, remembering the answer.
+    Raises IOError when it cannot be found."""
+    with _found_lock:
+        try:
+            path = _found[name]
+        except KeyError:
+            try:
+                proc = subprocess.Popen(('kpsewhich', name),
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE)
+                path = proc.communicate()[0].strip() or None
+            except OSError:
+                path = None
+            _found[name] = path
+
+    if path is None:
+        raise IOError('kpsewhich cannot find %s' % name)
+    return path
+
+def _fix_words(data, offset, count):
+    """Read a table of TFM fix_words as floats (in design size units)"""
+    return [w / 1048576.0 for w in
+            struct.unpack_from('>%di' % count, data, offset)]
+
+class Tfm(object):
+    """Metrics of a TeX font, read from its TFM file. Dimensions are in
+    units of the design size, so they are scaled by the size the font is
+    used at."""
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            data = f.read()
+
+        lf, lh, bc, ec, nw, nh, nd, ni, nl, nk, ne, np = \
+            struct.unpack_from('>12H', data, 0)
+        if lf * 4 > len(data) or bc > ec + 1:
+            raise ValueError('%s is not a TFM file' % filename)
+
+        self.checksum, = struct.unpack_from('>I', data, 24)
+        self.design_size = struct.unpack_from('>i', data, 28)[0] / 1048576.0
+
+        info = 24 + 4 * lh
+        tables = info + 4 * (ec - bc + 1)
+        widths = _fix_words(data, tables, nw)
+        heights = _fix_words(data, tables + 4 * nw, nh)
+        depths = _fix_words(data, tables + 4 * (nw + nh), nd)
+        italics = _fix_words(data, tables + 4 * (nw + nh + nd), ni)
+        params = tables + 4 * (nw + nh + nd + ni + nl + nk + ne)
+
+        ## Parameters, numbered from 1 as in The TeXbook. The first is the
+        ## slant, which is not scaled but is read the same way.
+        self.params = [None] + _fix_words(data, params, np)
+
+        ## char code -> (width, height, depth, italic correction)
+        self.chars = {}
+        for code in xrange(bc, ec + 1):
+            w, hd, it, _ = struct.unpack_from('>4B', data,
+                                              info + 4 * (code - bc))
+            if w:
+                self.chars[code] = (widths[w], heights[hd >> 4],
+                                    depths[hd & 15], italics[it >> 2])
+
+    def metrics(self, code, scale=1.0):
+        """Return (width, height, depth, italic) of code at the given scale,
+        or None if the font has no such character."""
+        try:
+            w, h, d, i = self.chars[code]
+        except KeyError:
+            return None
+        return (w * scale, h * scale, d * scale, i * scale)
+
+class TfmCache(object):
+    """Loads each TFM file once, by font name"""
+    def __init__(self, find=find_file):
+        self._find = find
+        self._fonts = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        with self._lock:
+            try:
+                return self._fonts[name]
+            except KeyError:
+                tfm = self._fonts[name] = Tfm(self._find(name + '.tfm'))
+                return tfm
+
+class Vf(object):
+    """A virtual font. Each character is a packet of DVI commands over the
+    fonts it defines, with dimensions in units of the virtual font's size
+    divided by 2**20."""
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            data = f.read()
+
+        if data[:2] != '\xf7\xca':
+            raise ValueError('%s is not a VF file' % filename)
+        pos = 3 + ord(data[2]) + 8
+
+        self.fonts = {}
+        self.default_font = None
+        ## char code -> DVI commands
+        self.packets = {}
+        while True:
+            op = ord(data[pos])
+            if op < 242:
+                code = ord(data[pos + 1])
+                self.packets[code] = data[pos + 5:pos + 5 + op]
+                pos += 5 + op
+            elif op == 242:
+                length, code = struct.unpack_from('>II', data, pos + 1)
+                self.packets[code] = data[pos + 13:pos + 13 + length]
+                pos += 13 + length
+            elif 243 <= op <= 246:
+                size = op - 242
+                k = struct.unpack_from('>I', '\0' * (4 - size) +
+                                       data[pos + 1:pos + 1 + size])[0]
+                pos += 1 + size
+                checksum, scale, design, a, l = struct.unpack_from(
+                    '>IiiBB', data, pos)
+                pos += 14
+                self.fonts[k] = FontDef(checksum, scale, design,
+                                        data[pos:pos + a],
+                                        data[pos + a:pos + a + l])
+                if self.default_font is None:
+                    self.default_font = self.fonts[k]
+                pos += a + l
+            else:
+                break
+
+class FontMap(object):
+    """The map from TeX font names to PostScript font files, as read from
+    pdftex.map style files."""
+    def __init__(self, filename):
+        ## TeX name -> (font file, encoding file or None, slant, extend)
+        self.fonts = {}
+        with open(filename, 'r') as f:
+            for line in f:
+                self._parse(line)
+
+    def _parse(self, line):
+        line = line.strip()
+        if not line or line[0] in '%#*;':
+            return
+        # Quoted PostScript snippets can hold spaces
+        quoted = re.findall(r'"([^"]*)"', line)
+        words = re.sub(r'"[^"]*"', ' ', line).split()
+        fontfile = encoding = None
+        for word in words[1:]:
+            if word.startswith('<'):
+                name = word.lstrip('<[')
+                if name.endswith('.enc'):
+                    encoding = name
+                elif name.endswith(('.pfb', '.pfa')):
+                    fontfile = name
+        if fontfile is None:
+            return
+
+        slant, extend = 0.0, 1.0
+        for snippet in quoted:
+            match = re.search(r'([-\d.]+)\s+SlantFont', snippet)
+            if match:
+                slant = float(match.group(1))
+            match = re.search(r'([-\d.]+)\s+ExtendFont', snippet)
+            if match:
+                extend = float(match.group(1))
+
+        self.fonts[words[0]] = (fontfile, encoding, slant, extend)
+
+def read_encoding(filename):
+    """Read a PostScript encoding vector from an .enc file. Returns a list
+    of 256 glyph names."""
+    with open(filename, 'r') as f:
+        text = re.sub(r'%[^\n]*', '', f.read())
+    body = text[text.index('[') + 1:text.index(']')]
+    names = re.findall(r'/([^\s/]+)', body)
+    return (names + ['.notdef'] * 256)[:256]
+
+## Adobe StandardEncoding, for fonts that use it and for seac accents
+STANDARD_ENCODING = ['.notdef'] * 256
+for _code, _names in (
+        (32, 'space exclam quotedbl numbersign dollar percent ampersand '
+             'quoteright parenleft parenright asterisk plus comma hyphen '
+             'period slash zero one two three four five six seven eight nine '
+             'colon semicolon less equal greater question at A B C D E F G H '
+             'I J K L M N O P Q R S T U V W X Y Z bracketleft backslash '
+             'bracketright asciicircum underscore quoteleft a b c d e f g h i '
+             'j k l m n o p q r s t u v w x y z braceleft bar braceright '
+             'asciitilde'),
+        (161, 'exclamdown cent sterling fraction yen florin section currency '
+              'quotesingle quotedblleft guillemotleft guilsinglleft '
+              'guilsinglright fi fl'),
+        (177, 'endash dagger daggerdbl periodcentered'),
+        (182, 'paragraph bullet quotesinglbase quotedblbase quotedblright '
+              'guillemotright ellipsis perthousand'),
+        (191, 'questiondown'),
+        (193, 'grave acute circumflex tilde macron breve dotaccent dieresis'),
+        (202, 'ring cedilla'),
+        (205, 'hungarumlaut ogonek caron emdash'),
+        (225, 'AE'), (227, 'ordfeminine'),
+        (232, 'Lslash Oslash OE ordmasculine'),
+        (241, 'ae'), (245, 'dotlessi'),
+        (248, 'lslash oslash oe germandbls')):
+    for _i, _name in enumerate(_names.split()):
+        STANDARD_ENCODING[_code + _i] = _name
+
+def _decrypt(data, r, skip):
+    """Undo Type 1 eexec or charstring encryption"""
+    out = []
+    append = out.append
+    for ch in data:
+        c = ord(ch)
+        append(chr(c ^ (r >> 8)))
+        r = ((c + r) * 52845 + 22719) & 0xffff
+    return ''.join(out[skip:])
+
+class _Outline(object):
+    """State of a charstring being run"""
+    def __init__(self):
+        self.ops = []
+        self.stack = []
+        self.ps_stack = []
+        self.x = self.y = self.sbx = 0
+        self.flex = None
+        self.done = False
+
+class Type1Font(object):
+    """A Type 1 font program (PFB or PFA), read far enough to turn glyph
+    names into outlines. Outlines are lists of ('M', x, y), ('L', x, y),
+    ('C', x1, y1, x2, y2, x3, y3) and ('Z',) in text space, so one unit is
+    the size the font is used at, with y upwards."""
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            data = f.read()
+        clear, private = self._split(data)
+
+        match = re.search(r'/FontMatrix\s*\[([^\]]*)\]', clear)
+        self.matrix = tuple(float(i) for i in match.group(1).split()) \
+                      if match else (0.001, 0, 0, 0.001, 0, 0)
+
+        if re.search(r'/Encoding\s+StandardEncoding', clear):
+            self.encoding = list(STANDARD_ENCODING)
+        else:
+            self.encoding = ['.notdef'] * 256
+            for code, name in re.findall(r'dup\s+(\d+)\s*/(\S+)\s+put',
+                                         clear):
+                if int(code) < 256:
+                    self.encoding[int(code)] = name
+
+        private = _decrypt(private, 55665, 4)
+        match = re.search(r'/lenIV\s+(-?\d+)', private)
+        self._leniv = int(match.group(1)) if match else 4
+
+        start = private.find('/CharStrings')
+        self._subrs = self._read_subrs(private, start)
+        self._charstrings = self._read_charstrings(private, start)
+        self._outlines = {}
+        self._lock = threading.Lock()
+
+    def _split(self, data):
+        """Return the clear text and the still encrypted private part"""
+        if data[:1] == '\x80':
+            parts = {1: [], 2: []}
+            pos = 0
+            while pos < len(data) and data[pos] == '\x80':
+                kind = ord(data[pos + 1])
+                if kind == 3:
+                    break
+                length, = struct.unpack_from('<I', data, pos + 2)
+                parts.setdefault(kind, []).append(
+                    data[pos + 6:pos + 6 + length])
+                pos += 6 + length
+            # Only the first text segment is clear text; any later one is the
+            # zeros and cleartomark trailer.
+            return parts[1][0], ''.join(parts[2])
+
+        start = data.index('eexec') + 5
+        end = data.find('cleartomark', start)
+        hexdata = re.sub(r'\s', '', data[start:end if end > 0 else None])
+        # Drop the run of zeros that pads out the encrypted part
+        hexdata = re.sub(r'0{64,}$', '', hexdata)
+        return data[:start], binascii.unhexlify(hexdata + '0' * (len(hexdata) % 2))
+
+    def _read_binary(self, private, pos, pattern):
+        """Find pattern followed by a binary string from pos. Returns the
+        match, the string, and the position after it, or Nones."""
+        match = pattern.search(private, pos)
+        if match is None:
+            return None, None, pos
+        length = int(match.group(2))
+        end = match.end()
+        return match, private[end:end + length], end + length
+
+    def _read_subrs(self, private, limit):
+        subrs = {}
+        pattern = re.compile(r'dup\s+(\d+)\s+(\d+)\s+\S+ ')
+        start = private.find('/Subrs')
+        if start < 0:
+            return subrs
+        pos = start
+        while True:
+            match, code, pos = self._read_binary(private, pos, pattern)
+            if match is None or (limit > start and match.start() > limit):
+                break
+            subrs[int(match.group(1))] = _decrypt(code, 4330, self._leniv)
+        return subrs
+
+    def _read_charstrings(self, private, start):
+        charstrings = {}
+        pattern = re.compile(r'/([^\s/\[\]{}()<>]+)\s+(\d+)\s+\S+ ')
+        pos = private.find('dict', start)
+        while pos >= 0:
+            match, code, pos = self._read_binary(private, pos, pattern)
+            if match is None:
+                break
+            charstrings[match.group(1)] = code
+        return charstrings
+
+    def outline(self, name):
+        """Return the outline of the named glyph, or None if there is no
+        such glyph."""
+        with self._lock:
+            try:
+                return self._outlines[name]
+            except KeyError:
+                pass
+
+            state = self._run_glyph(name)
+            if state is None:
+                outline = None
+            else:
+                a, b, c, d, e, f = self.matrix
+                outline = []
+                for op in state.ops:
+                    points = op[1:]
+                    xs = points[0::2]
+                    ys = points[1::2]
+                    outline.append((op[0],) + sum(
+                        ((a * x + c * y + e, b * x + d * y + f)
+                         for x, y in zip(xs, ys)), ()))
+            self._outlines[name] = outline
+            return outline
+
+    def _run_glyph(self, name, dx=0, dy=0):
+        """Run the charstring of name, in font units, shifted by (dx, dy)"""
+        try:
+            code = self._charstrings[name]
+        except KeyError:
+            return None
+        state = _Outline()
+        state.dx, state.dy = dx, dy
+        self._run(_decrypt(code, 4330, self._leniv), state)
+        return state
+
+    def _point(self, state, op, *coords):
+        state.ops.append((op,) + tuple(
+            c + (state.dx if i % 2 == 0 else state.dy)
+            for i, c in enumerate(coords)))
+
+    def _run(self, code, state):
+        stack = state.stack
+        i = 0
+        while i < len(code) and not state.done:
+            v = ord(code[i])
+            i += 1
+            if v >= 32:
+                if v <= 246:
+                    stack.append(v - 139)
+                elif v <= 250:
+                    stack.append((v - 247) * 256 + ord(code[i]) + 108)
+                    i += 1
+                elif v <= 254:
+                    stack.append(-(v - 251) * 256 - ord(code[i]) - 108)
+                    i += 1
+                else:
+                    stack.append(struct.unpack('>i', code[i:i + 4])[0])
+                    i += 4
+                continue
+
+            if v == 12:
+                v = 32 + ord(code[i])
+                i += 1
+
+            if v == 10:                                     # callsubr
+                subr = self._subrs.get(stack.pop())
+                if subr is not None:
+                    self._run(subr, state)
+                continue
+            elif v == 11:                                   # return
+                return
+            elif v == 13:                                   # hsbw
+                state.x = state.sbx = stack[0]
+                state.y = 0
+            elif v == 32 + 7:                               # sbw
+                state.x = state.sbx = stack[0]
+                state.y = stack[1]
+            elif v in (21, 22, 4):                          # moveto
+                if v == 21:
+                    state.x += stack[0]
+                    state.y += stack[1]
+                elif v == 22:
+                    state.x += stack[0]
+                else:
+                    state.y += stack[0]
+                if state.flex is not None:
+                    state.flex.append((state.x, state.y))
+                else:
+                    self._point(state, 'M', state.x, state.y)
+            elif v in (5, 6, 7):                            # lineto
+                if v == 5:
+                    state.x += stack[0]
+                    state.y += stack[1]
+                elif v == 6:
+                    state.x += stack[0]
+                else:
+                    state.y += stack[0]
+                self._point(state, 'L', state.x, state.y)
+            elif v in (8, 30, 31):                          # curveto
+                if v == 8:
+                    dx1, dy1, dx2, dy2, dx3, dy3 = stack[:6]
+                elif v == 30:
+                    dx1, dy1, dx2, dy2, dx3, dy3 = \
+                        0, stack[0], stack[1], stack[2], stack[3], 0
+                else:
+                    dx1, dy1, dx2, dy2, dx3, dy3 = \
+                        stack[0], 0, stack[1], stack[2], 0, stack[3]
+                x1, y1 = state.x + dx1, state.y + dy1
+                x2, y2 = x1 + dx2, y1 + dy2
+                state.x, state.y = x2 + dx3, y2 + dy3
+                self._point(state, 'C', x1, y1, x2, y2, state.x, state.y)
+            elif v == 9:                                    # closepath
+                state.ops.append(('Z',))
+            elif v == 14:                                   # endchar
+                state.done = True
+            elif v == 32 + 6:                               # seac
+                self._seac(state, *stack[:5])
+                state.done = True
+            elif v == 32 + 12:                              # div
+                b = stack.pop()
+                a = stack.pop()
+                stack.append(float(a) / b)
+                continue
+            elif v == 32 + 16:                              # callothersubr
+                self._othersubr(state, stack.pop(), stack.pop())
+                continue
+            elif v == 32 + 17:                              # pop
+                stack.append(state.ps_stack.pop() if state.ps_stack else 0)
+                continue
+            elif v == 32 + 33:                              # setcurrentpoint
+                state.x, state.y = stack[0], stack[1]
+            # Anything else is a hint, which we can ignore
+            del stack[:]
+
+    def _othersubr(self, state, number, count):
+        args = [state.stack.pop() for _ in xrange(count)]
+        if number == 1:
+            # Start of flex: collect the reference point and six more
+            state.flex = []
+        elif number == 0 and state.flex is not None:
+            points = state.flex
+            state.flex = None
+            for n in (1, 4):
+                self._point(state, 'C', *sum(points[n:n + 3], ()))
+            state.x, state.y = points[-1]
+            state.ps_stack = [state.y, state.x]
+        elif number == 3:
+            # Hint replacement: hand back a harmless subroutine number
+            state.ps_stack = [3]
+        elif number != 2:
+            state.ps_stack = args
+
+    def _seac(self, state, asb, adx, ady, bchar, achar):
+        """Compose an accented glyph from two StandardEncoding glyphs"""
+        base = self._run_glyph(STANDARD_ENCODING[int(bchar)],
+                               state.dx, state.dy)
+        accent = self._run_glyph(STANDARD_ENCODING[int(achar)],
+                                 state.dx + adx + state.sbx - asb,
+                                 state.dy + ady)
+        for part in (base, accent):
+            if part is not None:
+                state.ops.extend(part.ops)
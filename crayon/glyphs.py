@@ -0,0 +1,180 @@
+"""Turning DVI pages straight into vector outlines.
+
+GlyphRenderer follows each character on a page through virtual fonts down
+to the Type 1 font that draws it. A page comes out as a layout: a list of
+('glyph', key, x, y) placements and ('rule', x, y, width, height) boxes.
+The outline of each glyph is kept once, under a key naming the font, size
+and character, so tick labels that share the same dozen digits share the
+same dozen outlines, and a backend can define each glyph once and place it
+many times. expand() turns a layout back into a single path.
+
+Paths are lists of ('M', x, y), ('L', x, y), ('C', x1, y1, x2, y2, x3, y3)
+and ('Z',) in TeX points, with y increasing downwards from the DVI origin,
+which is the same frame the extents of a Tex are measured in. Glyph
+outlines are in the same units, relative to the glyph's reference point.
+
+"""
+
+import threading
+
+import dvi
+from fonts import find_file, TfmCache, Vf, FontMap, Type1Font, read_encoding
+
+## Virtual font dimensions are fix_words of the font size
+_FIX = 1.0 / (1 << 20)
+
+## Nested virtual fonts deeper than this are taken to be a loop
+_MAX_DEPTH = 10
+
+def glyph_key(name, size, code):
+    """Key of a glyph: the font, its size in points and the character"""
+    return '%s:%.6f:%d' % (name, size, code)
+
+def expand(layout, glyphs):
+    """Return the path drawn by a layout, taking glyph outlines from the
+    glyphs mapping"""
+    path = []
+    for item in layout:
+        if item[0] == 'glyph':
+            _, key, x, y = item
+            for op in glyphs[key]:
+                path.append((op[0],) + tuple(
+                    c + (x if i % 2 == 0 else y)
+                    for i, c in enumerate(op[1:])))
+        else:
+            _, left, bottom, width, height = item
+            right, top = left + width, bottom - height
+            path.extend((('M', left, bottom), ('L', right, bottom),
+                         ('L', right, top), ('L', left, top), ('Z',)))
+    return path
+
+class GlyphRenderer(object):
+    """Outlines of DVI pages, for fonts with Type 1 outlines in the font map.
+
+    Raises IOError if a font file cannot be found, and KeyError or
+    ValueError for fonts or glyphs it does not understand; callers should
+    fall back to dvisvgm for those.
+
+    """
+    def __init__(self, find=find_file, fontmap='pdftex.map'):
+        """Keyword arguments:
+            find -- finds TeX support files by name (default kpsewhich)
+            fontmap -- name of the font map to use (default pdftex.map)
+
+        """
+        self._find = find
+        self._fontmap_name = fontmap
+        self._fontmap = None
+        self._tfms = TfmCache(find)
+        self._vfs = {}
+        self._type1 = {}
+        self._encodings = {}
+        ## Glyph key -> outline. Outlines found elsewhere, such as in an
+        ## on-disk cache, may be added here to save decoding them again.
+        self.glyphs = {}
+        self._lock = threading.RLock()
+
+    def layout(self, dvifile, number):
+        """Return the layout of the given page (counting from 1) of an open
+        DviFile. The outline of every glyph it places is in self.glyphs
+        afterwards."""
+        unit = dvifile.scale
+        layout = []
+        for mark in dvifile.marks(number, self._char_width):
+            self._mark(mark, unit, 0.0, 0.0, layout, 0)
+        return layout
+
+    def page(self, dvifile, number):
+        """Return the path drawn by the given page of an open DviFile"""
+        return expand(self.layout(dvifile, number), self.glyphs)
+
+    def _char_width(self, font, code):
+        """Width of code in the units font.scale is given in"""
+        return self._tfms[font.name].chars[code][0] * font.scale
+
+    def _mark(self, mark, unit, x, y, layout, depth):
+        """Append a mark from a page or packet whose units are unit points,
+        placed at (x, y), to layout"""
+        if mark[0] == 'rule':
+            _, h, v, width, height = mark
+            layout.append(('rule', x + h * unit, y + v * unit,
+                           width * unit, height * unit))
+            return
+
+        _, font, code, h, v = mark
+        if font is None:
+            raise ValueError('Character set before any font was selected')
+        x, y = x + h * unit, y + v * unit
+        size = font.scale * unit
+
+        vf = self._vf(font.name)
+        if vf is None:
+            key = glyph_key(font.name, size, code)
+            if key not in self.glyphs:
+                self._glyph(key, font.name, size, code)
+            layout.append(('glyph', key, x, y))
+            return
+
+        if depth >= _MAX_DEPTH:
+            raise ValueError('Virtual font %s nests too deeply' % font.name)
+        sub = size * _FIX
+        packet = dvi.commands(vf.packets[code])
+        for inner in dvi.marks(packet, vf.fonts, self._char_width,
+                               vf.default_font):
+            self._mark(inner, sub, x, y, layout, depth + 1)
+
+    def _vf(self, name):
+        """The virtual font of that name, or None if it is a real font"""
+        with self._lock:
+            try:
+                return self._vfs[name]
+            except KeyError:
+                pass
+            try:
+                vf = Vf(self._find(name + '.vf'))
+            except IOError:
+                vf = None
+            self._vfs[name] = vf
+            return vf
+
+    def _glyph(self, key, name, size, code):
+        """Decode the outline of code in the named font at size points into
+        self.glyphs, with y downwards and its reference point at the
+        origin"""
+        with self._lock:
+            fontfile, encoding, slant, extend = self._map().fonts[name]
+            font = self._type1_font(fontfile)
+            names = self._encoding(encoding) if encoding else font.encoding
+            outline = font.outline(names[code])
+            if outline is None:
+                raise KeyError('%s has no glyph %s' % (fontfile, names[code]))
+
+            glyph = []
+            for op in outline:
+                coords = []
+                for i in xrange(1, len(op), 2):
+                    ox, oy = op[i], op[i + 1]
+                    coords.append(size * (extend * ox + slant * oy))
+                    coords.append(-size * oy)
+                glyph.append((op[0],) + tuple(coords))
+            self.glyphs[key] = tuple(glyph)
+
+    def _map(self):
+        if self._fontmap is None:
+            self._fontmap = FontMap(self._find(self._fontmap_name))
+        return self._fontmap
+
+    def _type1_font(self, filename):
+        try:
+            return self._type1[filename]
+        except KeyError:
+            font = self._type1[filename] = Type1Font(self._find(filename))
+            return font
+
+    def _encoding(self, filename):
+        try:
+            return self._encodings[filename]
+        except KeyError:
+            enc = self._encodings[filename] = read_encoding(
+                self._find(filename))
+            return enc
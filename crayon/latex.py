@@ -5,15 +5,27 @@ import subprocess
 import os
 import re
 import math
-import shelve
 
 import errno
 import templite
+import dvi
+from fonts import TfmCache
+import glyphs
+from metrics import NumberMetrics, extents_of
+from cache import ExtentsStore, GlyphStore, PackStore, LockFile, \
+     hold_template, release_template, DEFAULT_BASEDIR
+from stats import Stats
 import tempfile
 import shutil
 
-import itertools
 import glob
+import select
+from distutils.spawn import find_executable
+import threading
+import json
+import weakref
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 class PosParser(object):
     """Parser for dvipos bounding box output"""
@@ -38,18 +50,361 @@ class PosParser(object):
         return tuple (self._parse_hex(i.group(0))
                       for i in self.numbers.finditer(line))
 
+class DviParser(object):
+    """Reads the extents of each page straight from a DVI file, in the same
+    layout as PosParser gives them, using the TFM metrics of the fonts
+    instead of a dvipos run."""
+    def __init__(self, fonts=None):
+        """Keyword arguments:
+            fonts -- maps font names to Tfm objects (default a TfmCache)
+
+        """
+        self._fonts = TfmCache() if fonts is None else fonts
+
+    def parse(self, filename):
+        """Open given dvi file, return list of extents"""
+        with dvi.DviFile(filename) as f:
+            return [self._page(f, n) for n in xrange(1, len(f.pages) + 1)]
+
+    def _page(self, f, number):
+        fonts = self._fonts
+        def metrics(font, code):
+            m = fonts[font.name].metrics(code, font.scale)
+            return m or (0, 0, 0, 0)
+
+        char_width = lambda font, code: metrics(font, code)[0]
+
+        s = f.scale
+        boxes = []
+        baselines = []
+        for mark in f.marks(number, char_width):
+            if mark[0] == 'char':
+                _, font, code, h, v = mark
+                width, height, depth, _ = metrics(font, code)
+                boxes.append((h * s, (v - height) * s, (h + width) * s,
+                              (v + depth) * s))
+            else:
+                _, h, v, width, height = mark
+                boxes.append((h * s, (v - height) * s, (h + width) * s, v * s))
+            baselines.append(v * s)
+
+        return extents_of(boxes, baselines)
+
+class LogParser(object):
+    """Parser for latex logs. Pins each error on the string it occurred in,
+    using the markers the body template writes before every string."""
+    def __init__(self):
+        self.lines = re.compile(r'^(?:crayon-label:(\d+)|! (.*))$',
+                                re.MULTILINE)
+
+    def parse(self, filename):
+        """Open given log, return a dict mapping string index to a list of
+        error messages. Errors before the first string are keyed by None."""
+        try:
+            with open(filename, 'r') as file:
+                log = file.read()
+        except IOError:
+            return {None: ['Latex did not run.']}
+
+        errors = {}
+        current = None
+        for match in self.lines.finditer(log):
+            label, message = match.groups()
+            if label is not None:
+                current = int(label)
+            else:
+                errors.setdefault(current, []).append(message)
+        return errors
+
 class Tex(object):
     def __init__(self, text, dvifile = None, dvipage = None, extents = None,
-                 svgfile = None):
+                 svgdata = None):
         self.text = text
         self.hash = hashlib.md5(text).hexdigest()
         self.dvifile = dvifile
         self.dvipage = dvipage
         self.extents = extents
-        self.svgfile = svgfile
+        ## The SVG document from to_svg
+        self.svgdata = svgdata
+        ## Latex's complaint if this string would not compile
+        self.error = None
+        ## Glyph layout of the label from to_glyphs, or False if it needs an
+        ## SVG; see glyphs.py
+        self.glyphs = None
+        ## Outline of the label from to_paths, or False if it needs an SVG
+        self.paths = None
+
+class TexCache(object):
+    """Tex objects by string, within a budget of entries and estimated bytes.
+
+    The least recently used are dropped first. Whatever a dropped Tex knew
+    is still in the extents database and the SVG cache, so asking for it
+    again only costs a lookup. With weak set, a dropped Tex that is still
+    in use elsewhere (in a canvas's list of labels, say) is found again
+    rather than replaced by a copy.
+
+    """
+    ## Rough bytes per Tex object with its attributes, and per glyph
+    ## placement or path operation
+    _base_bytes = 1024
+    _item_bytes = 100
+
+    def __init__(self, max_entries=None, max_bytes=None, weak=True):
+        """Keyword arguments:
+            max_entries -- most Tex objects to keep (default no limit)
+            max_bytes -- most estimated bytes to keep, counting parsed SVGs
+                         (default no limit)
+            weak -- keep weak references to dropped Tex objects
+                    (default True)
+
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self._dropped = weakref.WeakValueDictionary() if weak else None
+
+    def size(self, tex):
+        """Estimated bytes held by tex, including its SVG document and any
+        SVG parsed for it by a canvas, which records its size as
+        tex.svg_bytes"""
+        items = len(tex.glyphs or ()) + len(tex.paths or ())
+        return (self._base_bytes + len(tex.text) + items * self._item_bytes +
+                len(tex.svgdata or '') + getattr(tex, 'svg_bytes', 0))
+
+    def get(self, string):
+        """Return the Tex for string, making it if need be"""
+        tex = self._entries.pop(string, None)
+        if tex is None and self._dropped is not None:
+            tex = self._dropped.get(string)
+        if tex is None:
+            tex = Tex(string)
+        self._put(tex)
+        return tex
+
+    def update(self, texes):
+        """Account for texes having grown, and trim to the budget"""
+        for tex in texes:
+            if self._entries.get(tex.text) is tex:
+                self._put(self._entries.pop(tex.text))
+
+    def _put(self, tex):
+        self._bytes -= self._sizes.pop(tex.text, 0)
+        size = self._sizes[tex.text] = self.size(tex)
+        self._bytes += size
+        self._entries[tex.text] = tex
+        self._trim()
+
+    def _trim(self):
+        # The newest entry always stays
+        while len(self._entries) > 1 and (
+                (self.max_entries is not None and
+                 len(self._entries) > self.max_entries) or
+                (self.max_bytes is not None and self._bytes > self.max_bytes)):
+            string, tex = self._entries.popitem(last=False)
+            self._bytes -= self._sizes.pop(string)
+            if self._dropped is not None:
+                self._dropped[string] = tex
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def bytes(self):
+        return self._bytes
+
+class TexWorker(object):
+    """A long-running latex process that measures strings on demand.
+
+    The worker loads the dumped preamble format once and then takes its
+    commands from the terminal, so each new string costs one line of input
+    rather than a process launch and a format load. Strings are set in an
+    hbox and the box dimensions are written back to the terminal.
+
+    """
+    _driver = r"""\begin{document}
+\newbox\crayonbox
+\long\def\crayonmeasure#1#2{%
+  \setbox\crayonbox\hbox{#2}%
+  \immediate\write16{crayon-extents:#1:\number\wd\crayonbox:%
+    \number\ht\crayonbox:\number\dp\crayonbox}}
+\immediate\write16{crayon-ready}
+"""
+
+    ## Number of commands in flight before we stop and read the replies.
+    ## Keeps both pipes well below their buffer sizes.
+    window = 64
+
+    ## Control words that would end the run, or change how latex reads the
+    ## terminal, part way through a window
+    _refused = frozenset(['\\par', '\\stop', '\\end', '\\endinput',
+                          '\\input', '\\batchmode', '\\scrollmode'])
+
+    def __init__(self, tempdir, fmt, timeout=30):
+        self._tempdir = tempdir
+        self._timeout = timeout
+        self._buffer = ''
+        self._serial = 0
+        self._reply = re.compile(
+            r'crayon-extents:(\d+):(-?\d+):(-?\d+):(-?\d+)')
+
+        with open(os.path.join(tempdir, 'worker.tex'), 'w') as f:
+            f.write(self._driver)
+
+        pipe = subprocess.PIPE
+        ## scrollmode, since batchmode and nonstopmode both refuse to read
+        ## from the terminal once the driver file runs out.
+        self._proc = subprocess.Popen(
+            ('latex', '-interaction=scrollmode', '-fmt', fmt, 'worker.tex'),
+            cwd=tempdir, stdin=pipe, stdout=pipe, stderr=subprocess.STDOUT)
+
+        while 'crayon-ready' not in self._readline():
+            pass
+
+    @staticmethod
+    def accepts(text):
+        """True if text can be sent down the worker's terminal. Newlines
+        would end the command early, and an unescaped % would comment out the
+        rest of it; that, unbalanced braces or a \\par would make TeX wait
+        for more input that never comes. Commands such as \\stop and
+        \\end, which would end the run, are refused too."""
+        if '\n' in text or '\r' in text:
+            return False
+        depth = 0
+        for match in re.finditer(r'\\[a-zA-Z]+|\\.|[{}%]', text):
+            token = match.group(0)
+            if token == '%' or token in TexWorker._refused:
+                return False
+            elif token == '{':
+                depth += 1
+            elif token == '}':
+                depth -= 1
+                if depth < 0:
+                    return False
+        return depth == 0
+
+    def measure(self, texts):
+        """Return a list of (extents, error) pairs, one per string in texts.
+        error is None unless latex complained while setting the string."""
+        texts = list(texts)
+        extents = []
+        for n in xrange(0, len(texts), self.window):
+            chunk = texts[n:n + self.window]
+            first = self._serial
+            for text in chunk:
+                self._proc.stdin.write('\\crayonmeasure{%d}{%s}\n'
+                                       % (self._serial, text))
+                self._serial += 1
+            self._proc.stdin.flush()
+
+            for serial in xrange(first, self._serial):
+                extents.append(self._read_extents(serial))
+        return extents
+
+    def close(self):
+        if self._proc.poll() is None:
+            try:
+                self._proc.stdin.write('\\end{document}\n')
+                self._proc.stdin.close()
+                self._proc.wait()
+            except (IOError, OSError):
+                self.kill()
+
+    def kill(self):
+        """Stop latex at once, as after it has failed"""
+        if self._proc.poll() is None:
+            self._proc.kill()
+        self._proc.wait()
+
+    def _read_extents(self, serial):
+        ## Anything latex says between two replies belongs to the second
+        errors = []
+        while True:
+            line = self._readline()
+            if line.startswith('! '):
+                errors.append(line[2:])
+            match = self._reply.search(line)
+            if match and int(match.group(1)) == serial:
+                wd, ht, dp = (int(i) / 65536.0 for i in match.groups()[1:])
+                ## preview places the top left corner of each box at the
+                ## origin, so the baseline sits at the height of the box.
+                return (ht, 0.0, 0.0, ht + dp, wd, ht), \
+                       '\n'.join(errors) or None
+
+    def _readline(self):
+        """Read one line from latex, giving up after the timeout"""
+        fd = self._proc.stdout.fileno()
+        while '\n' not in self._buffer:
+            ready, _, _ = select.select((fd,), (), (), self._timeout)
+            data = os.read(fd, 4096) if ready else ''
+            if not data:
+                self._proc.kill()
+                raise RuntimeError('Latex worker stopped responding.')
+            self._buffer += data
+        line, self._buffer = self._buffer.split('\n', 1)
+        return line
+
+def _unique(texes):
+    """Drop repeated strings from texes, keeping the first of each"""
+    seen = set()
+    result = []
+    for tex in texes:
+        if tex.hash not in seen:
+            seen.add(tex.hash)
+            result.append(tex)
+    return result
+
+class PendingTexes(object):
+    """The eventual result of render_async or to_svg_async. Holds the Tex
+    objects straight away, and the background jobs that will complete
+    them."""
+    def __init__(self, texes, jobs):
+        self.texes = texes
+        self._jobs = jobs
+
+    def ready(self):
+        return all(job.ready() for job in self._jobs)
+
+    def wait(self, timeout=None):
+        for job in self._jobs:
+            job.wait(timeout)
+
+    def get(self, timeout=None):
+        """Wait for the jobs, re-raising any error, and return the Tex
+        objects."""
+        for job in self._jobs:
+            job.get(timeout)
+        return self.texes
 
 class TexRunner(object):
-    def __init__(self):
+    ## Smallest number of strings worth giving a latex process of its own
+    min_shard = 50
+
+    def __init__(self, worker=False, jobs=1, cache=None, async_jobs=4,
+                 stats=None, shared=False, max_texes=20000,
+                 max_tex_bytes=256 << 20):
+        """Keyword arguments:
+            worker -- measure new strings with a long-running latex process
+                      instead of one latex and dvipos run per batch
+                      (default False)
+            jobs -- number of latex processes a large batch may be split
+                    across (default 1)
+            cache -- a crayon.cache.CacheManager giving the cache directory
+                     and limits, enforced on close (default None)
+            async_jobs -- number of render_async and to_svg_async calls
+                          that may run at once (default 4)
+            stats -- a crayon.stats.Stats to collect timings and counters
+                     in, also available as the stats attribute (default a
+                     new one)
+            shared -- coordinate with other processes, possibly on other
+                      hosts, using the same cache directory, so that each
+                      string is compiled by only one of them (default False)
+            max_texes -- most Tex objects to keep in memory (default 20000)
+            max_tex_bytes -- most estimated bytes of Tex objects and their
+                             parsed SVGs to keep in memory (default 256M)
+
+        """
         self._errorparser = re.compile(r'^! (.*)$', re.MULTILINE)
         self._progressparser = re.compile(r'^((?:\[\d+\]\s?)+):$', re.MULTILINE)
         self._preamble_checked = False
@@ -60,13 +415,14 @@ class TexRunner(object):
         ## Since there's potential to massively save time using caches, allow
         ## user to set directory (thus they can set /dev/null) or set minimal
         ## cacheing.
-        base_cachedir = os.path.expanduser('~/.cache/crayon')
+        self._cache_manager = cache
+        base_cachedir = DEFAULT_BASEDIR if cache is None else cache.basedir
 
         ## Make a temp dir for running latex and dvipos in
         self._tempdir = tempfile.mkdtemp(prefix='crayon-')
 
-        preamble = self._template('preamble.tex')
-        self._make_preamble(preamble)
+        ## The format is only dumped when latex is first needed
+        self._preamble = preamble = self._template('preamble.tex')
 
         body = self._template('body.tpl')
 
@@ -78,7 +434,7 @@ class TexRunner(object):
         ## files.
         h = hashlib.md5(preamble)
         h.update(body)
-        templatehash = h.hexdigest()
+        self._templatehash = templatehash = h.hexdigest()
 
         self._cachedir = os.path.join(base_cachedir, templatehash)
 
@@ -92,20 +448,93 @@ class TexRunner(object):
             else:
                 raise
 
+        # Mark the template directory as in use, so it is not collected
+        os.utime(self._cachedir, None)
+        hold_template(self._cachedir)
+
+        ## A dumped format only loads into the latex that made it, so tie the
+        ## cached copy to the binary as well as the template.
+        self._fmt = self._cache('preamble-%s.fmt' % self._latex_stamp())
+
+        ## In shared mode, every process holds the template lock shared, so
+        ## that the directory is not collected under it, and takes entry
+        ## locks around compiling; see _exclusive.
+        self._shared = shared
+        self._locks = None
+        if shared:
+            self._locks = LockFile(self._cache('lock'))
+            self._locks.lock(LockFile.TEMPLATE, shared=True)
+
         # Open the database
-        self._db = shelve.open(self._cache('extents.db'), protocol=1)
+        self._db = ExtentsStore(self._cache('extents.sqlite'), wal=not shared)
+        self._glyphdb = GlyphStore(self._cache('glyphs.sqlite'),
+                                   wal=not shared)
+        self._svgs = PackStore(self._cache('svgs.pack'), wal=not shared)
 
         self._posparser = PosParser()
-
+        self._tfms = TfmCache()
+        self._dviparser = DviParser(self._tfms)
+        self._logparser = LogParser()
+        self._glyphs = glyphs.GlyphRenderer()
+        ## Glyph keys known to be in the glyph database
+        self._stored_glyphs = set()
 
         # Batch number, so we can build svgs separately
         # (Many pages of the dvi file will *not* be needed as SVG.)
         self._batchnumber = 0
-        self._tex_cache = {}
+        self._tex_cache = TexCache(max_texes, max_tex_bytes)
+
+        self._use_worker = worker
+        self._worker = None
+
+        self._jobs = max(1, jobs)
+        self._pool = None
+
+        ## Guards the bookkeeping below and the shared caches above. External
+        ## processes are always run without it held.
+        self._lock = threading.Lock()
+        self._preamble_lock = threading.Lock()
+        self._worker_lock = threading.Lock()
+
+        self.stats = Stats() if stats is None else stats
+        self._import_svg_files()
+
+        ## NumberMetrics for measure, once calibrated; False if that failed
+        self._metrics = None
+        self._metrics_lock = threading.Lock()
+
+        self._async_jobs = max(1, async_jobs)
+        self._async_pool = None
+        self._pending_render = {}
+        self._pending_svg = {}
+
+        ## Hash -> threading.Event for strings being compiled or converted
+        ## right now; see _claim
+        self._rendering = {}
+        self._converting = {}
 
     def close(self):
+        if self._async_pool is not None:
+            self._async_pool.close()
+            self._async_pool.join()
+            self._async_pool = None
+        if self._worker is not None:
+            self._worker.close()
+            self._worker = None
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
         shutil.rmtree(self._tempdir)
         self._db.close()
+        self._glyphdb.close()
+        self._svgs.close()
+        if self._locks is not None:
+            self._locks.close()
+            self._locks = None
+        release_template(self._cachedir)
+        if self._cache_manager is not None:
+            self._cache_manager.gc(keep=(self._templatehash,))
 
     def render(self, strings, force=False):
         """Batch latexing of a list of strings. Returns list of Tex
@@ -113,42 +542,328 @@ class TexRunner(object):
         
         """
 
-        basefile = 'output-%d' % self._batchnumber
-        texfile  = basefile + '.tex'
-
         ## Create a list of mutable containers
-        texes = [self._get_tex(s) for s in strings]
+        with self._lock:
+            texes = [self._get_tex(s) for s in strings]
+            self._lookup_extents(texes)
+
+        # If the force option is on, build *ALL* the tex given! Strings that
+        # failed before are not retried unless forced. A string asked for
+        # several times is only compiled once.
+        unknowns = _unique(texes if force else
+                           [t for t in texes if t.extents is None
+                            and t.error is None])
+
+        # Strings another thread is already compiling are waited on instead.
+        # If that thread gives up on them, they are compiled here after all.
+        while unknowns:
+            mine, events = self._claim(unknowns, self._rendering)
+            try:
+                if mine:
+                    self._check_preamble()
+                    self._exclusive(mine, self._compile,
+                                    None if force else self._unrendered)
+            finally:
+                self._release(mine, self._rendering)
+
+            for event in events:
+                event.wait()
+            claimed = set(t.hash for t in mine)
+            unknowns = [t for t in unknowns if t.hash not in claimed and
+                        t.extents is None and t.error is None]
 
-        self._check_preamble()
+        return texes
 
-        # If the force option is on, build *ALL* the tex given!
-        unknowns = texes if force else [t for t in texes if t.extents is None]
+    def _compile(self, texes):
+        if self._use_worker:
+            texes = self._worker_render(texes)
+        if texes:
+            self._render_batch(texes)
 
-        # Quit now if we don't need to run latex
-        if not unknowns:
-            return texes
+    def _unrendered(self, texes):
+        """Those of texes another process has not finished meanwhile"""
+        self._lookup_extents(texes)
+        return [t for t in texes if t.extents is None]
 
-        self._batchnumber += 1
+    def measure(self, strings):
+        """Like render, but simple numeric labels such as tick labels are
+        sized from font metrics rather than by running latex, unless their
+        exact extents are already known. Returns list of Tex objects; those
+        sized this way have extents but no dvi page until to_svg or
+        to_glyphs needs one.
 
-        self._write_latex(self._temp(texfile), unknowns)
+        """
+        metrics = self._number_metrics()
+        if not metrics:
+            return self.render(strings)
+
+        with self._lock:
+            texes = [self._get_tex(s) for s in strings]
+            self._lookup_extents(texes)
+            with self.stats.stage('metrics', len(texes)) as run:
+                for tex in texes:
+                    if tex.extents is None and tex.error is None:
+                        tex.extents = metrics.extents(tex.text)
+                        if tex.extents is None:
+                            run.misses += 1
+                        else:
+                            run.hits += 1
+                run.strings_out = run.hits
+
+        unknown = [t.text for t in texes
+                   if t.extents is None and t.error is None]
+        if unknown:
+            self.render(unknown)
+        return texes
 
-        dvifile = basefile + '.dvi'
+    def _number_metrics(self):
+        """Calibrate the metrics measure uses, or load them from the cache.
+        Returns False if that cannot be done, in which case measure just
+        renders."""
+        with self._metrics_lock:
+            if self._metrics is not None:
+                return self._metrics
+
+            filename = self._cache('metrics.json')
+            try:
+                with open(filename, 'r') as f:
+                    self._metrics = NumberMetrics.from_dict(json.load(f),
+                                                            self._tfms)
+                return self._metrics
+            except (IOError, ValueError, KeyError):
+                pass
 
-        self._run_latex(texfile)
+            with self._lock:
+                texes = [self._get_tex(s) for s in NumberMetrics.calibration]
+            try:
+                self._render_batch(texes)
+                if any(t.error for t in texes):
+                    raise ValueError(texes[0].error or texes[1].error)
+                with dvi.DviFile(self._temp(texes[0].dvifile)) as f:
+                    self._metrics = NumberMetrics.from_dvi(
+                        f, [t.dvipage for t in texes], self._tfms)
+            except (IOError, OSError, ValueError, KeyError, TypeError):
+                self._metrics = False
+                return False
+
+            ## A cache we cannot write to only costs calibrating again next
+            ## time; the metrics are good for this runner either way.
+            temp = '%s.%d.tmp' % (filename, os.getpid())
+            try:
+                with open(temp, 'w') as f:
+                    json.dump(self._metrics.to_dict(), f)
+                os.rename(temp, filename)
+            except (IOError, OSError):
+                try:
+                    os.remove(temp)
+                except OSError:
+                    pass
+            return self._metrics
+
+    def render_async(self, strings, force=False):
+        """Start latexing strings in the background. Returns a PendingTexes,
+        whose get() gives the same list of Tex objects as render would.
+        Strings already being rendered by an earlier call are waited on
+        rather than compiled again."""
+        with self._lock:
+            texes = [self._get_tex(s) for s in strings]
+        return self._submit(self._render_texes, texes, self._pending_render,
+                            force=force)
+
+    def to_svg_async(self, texes, force=False):
+        """Start converting texes to SVG in the background. Returns a
+        PendingTexes, whose get() gives the texes back once they all have
+        svgdata."""
+        return self._submit(self.to_svg, list(texes), self._pending_svg,
+                            force=force)
+
+    def _submit(self, method, texes, pending, force):
+        """Run method over the texes not already pending in a background job,
+        sharing the jobs of earlier calls for the rest."""
+        with self._lock:
+            if self._async_pool is None:
+                self._async_pool = ThreadPool(self._async_jobs)
+
+            jobs, todo, seen = [], [], set()
+            for tex in texes:
+                job = pending.get(tex.hash)
+                if job is None or force:
+                    if tex.hash not in seen:
+                        seen.add(tex.hash)
+                        todo.append(tex)
+                elif job not in jobs:
+                    jobs.append(job)
+
+            if todo:
+                holder = []
+                job = self._async_pool.apply_async(
+                    self._run_pending, (method, todo, pending, holder, force))
+                holder.append(job)
+                jobs.append(job)
+                for tex in todo:
+                    pending[tex.hash] = job
+
+        return PendingTexes(texes, jobs)
+
+    def _run_pending(self, method, texes, pending, holder, force):
+        try:
+            method(texes, force=force)
+        finally:
+            # The holder is filled in under the lock before we can get it
+            with self._lock:
+                for tex in texes:
+                    if pending.get(tex.hash) is holder[0]:
+                        del pending[tex.hash]
+
+    def _render_texes(self, texes, force=False):
+        return self.render([t.text for t in texes], force=force)
+
+    def _worker_render(self, texes):
+        """Measure what we can with the worker. Returns the texes that still
+        need a batch run."""
+        accepted = [t for t in texes if TexWorker.accepts(t.text)]
+        if not accepted:
+            return texes
 
-        self._run_dvipos(dvifile)
+        with self._worker_lock:
+            if self._worker is None:
+                self._worker = TexWorker(self._tempdir, self._fmt)
+                self.stats.count('worker-start')
 
-        posfile = basefile + '.pos'
+            try:
+                with self.stats.stage('worker', len(accepted)) as run:
+                    extents = self._worker.measure(t.text for t in accepted)
+                    run.strings_out = len(extents)
+            except (IOError, OSError, RuntimeError):
+                ## Latex stopped or exited under us. Let the next call start
+                ## a fresh worker and fall back to a batch for this one.
+                self._worker.kill()
+                self._worker = None
+                return texes
+
+        for tex, (ext, error) in zip(accepted, extents):
+            tex.extents = None if error else ext
+            tex.error = error
+        self._db.put_many((t.hash, t.extents) for t in accepted
+                          if t.error is None)
+
+        return [t for t in texes if not TexWorker.accepts(t.text)]
+
+    def _render_batch(self, unknowns):
+        """Run latex over unknowns, filling in their extents and
+        dvi pages. Large batches are split into shards, each compiled in its
+        own subdirectory, when more than one job is allowed."""
+        self._check_preamble()
 
-        extents = self._posparser.parse(self._temp(posfile))
+        # Each page must belong to exactly one Tex for the pairing below
+        unknowns = _unique(unknowns)
+
+        basefile = 'output-%d' % self._next_batch()
+
+        nshards = min(self._jobs, -(-len(unknowns) // self.min_shard))
+
+        if nshards <= 1:
+            shards = [('', basefile, unknowns)]
+        else:
+            size = -(-len(unknowns) // nshards)
+            shards = [(name, name, unknowns[i:i + size])
+                      for name, i in (('%s-%d' % (basefile, k), k * size)
+                                      for k in xrange(nshards))
+                      if i < len(unknowns)]
+            for subdir, _, _ in shards:
+                os.mkdir(self._temp(subdir))
+
+        with self._lock:
+            if self._pool is None and len(shards) > 1:
+                self._pool = ThreadPool(self._jobs)
+
+        mapper = map if len(shards) == 1 else self._pool.map
+        results = mapper(self._compile_shard, shards)
+
+        # map keeps the shards in order, so pages line up with unknowns
+        retry = []
+        for (subdir, base, texes), (extents, errors) in zip(shards, results):
+            # Errors outside every string do not throw the pages out
+            blamed = [n for n in errors if n is not None]
+            if not blamed and len(extents) == len(texes):
+                dvifile = os.path.join(subdir, base + '.dvi')
+                for n, (tex, ext) in enumerate(zip(texes, extents), 1):
+                    tex.extents = ext
+                    tex.error = None
+                    tex.dvifile = dvifile
+                    tex.dvipage = n
+                self._db.put_many((t.hash, t.extents) for t in texes)
+            else:
+                retry.extend(self._isolate_errors(texes, errors))
+
+        # The pages of a failed shard cannot be trusted, so go again without
+        # the strings known to be bad.
+        for texes in retry:
+            self._render_batch(texes)
+
+    def _isolate_errors(self, texes, errors):
+        """Mark the strings of a failed shard that the log blames, and
+        return the groups of strings that should be compiled again. When
+        nothing can be blamed, the shard is bisected."""
+        for n, messages in errors.iteritems():
+            if n is not None:
+                texes[n].extents = None
+                texes[n].error = '\n'.join(messages)
+
+        good = [t for n, t in enumerate(texes) if n not in errors]
+        if len(good) < len(texes):
+            return [good] if good else []
+
+        if len(texes) == 1:
+            texes[0].error = '\n'.join(errors.get(None, ())) or \
+                             'Latex produced no page for this string.'
+            return []
+
+        half = len(texes) // 2
+        return [texes[:half], texes[half:]]
+
+    def _compile_shard(self, shard):
+        """Write out and compile one shard, given as (subdir, basefile, texes).
+        Returns the list of extents read from the dvi file, and a dict of
+        error messages from the log, keyed by index into texes (or None for
+        errors outside any string)."""
+        subdir, basefile, texes = shard
+        cwd = self._temp(subdir)
+
+        # The template streams straight to disk and keeps no state of its
+        # own, so the shards are written concurrently.
+        with self.stats.stage('write', len(texes)):
+            self._write_latex(os.path.join(cwd, basefile + '.tex'), texes)
+        with self.stats.stage('latex', len(texes), processes=1):
+            self._run_latex(basefile + '.tex', cwd)
+        with self.stats.stage('log'):
+            errors = self._logparser.parse(
+                os.path.join(cwd, basefile + '.log'))
+
+        dvifile = os.path.join(cwd, basefile + '.dvi')
+        if not os.path.isfile(dvifile):
+            return [], errors or {None: ['Latex produced no pages.']}
+
+        with self.stats.stage('parse', len(texes)) as run:
+            try:
+                extents = self._dviparser.parse(dvifile)
+                run.strings_out = len(extents)
+                return extents, errors
+            except (IOError, ValueError, KeyError):
+                # Fonts we have no metrics for; dvipos may know better
+                pass
 
-        for n, (tex, ext) in enumerate(zip(unknowns, extents), 1):
-            tex.extents = ext
-            self._db[tex.text] = ext
-            tex.dvifile = dvifile
-            tex.dvipage = n
+        try:
+            with self.stats.stage('dvipos', len(texes), processes=1):
+                self._run_dvipos(basefile + '.dvi', cwd)
+        except (subprocess.CalledProcessError, OSError):
+            return [], errors or {None: ['dvipos failed.']}
 
-        return texes
+        with self.stats.stage('posparse', len(texes)) as run:
+            extents = self._posparser.parse(
+                os.path.join(cwd, basefile + '.pos'))
+            run.strings_out = len(extents)
+        return extents, errors
 
     def to_svg(self, texes, force=False):
         """Ensure given tex objects have a valid svg object
@@ -157,71 +872,318 @@ class TexRunner(object):
         force -- when True, build even when available in cache.
         
         """
-        # Basic algorithm: work out which dvifiles are needed. Then we *could*
-        # use dviconcat to join them all together! This is work for another day!
-        # Let us get tikz output first... then worry about this later!
+        # Work out which dvi pages are needed. When they are spread over the
+        # dvi files of several batches, they are joined into one dvi file so
+        # that dvisvgm only has to run once.
 
-        # For now, let's just note there is a big speedup to be had...
         # Originally, the plan was to have a 'rater', analogous to PyX. This
         # would assign 'silliness' to various scenarious, and reject overlapping
-        # text. 
+        # text. This has been abandoned, for now.
+
+        # Those already in the pack come out of it in one lookup, which
+        # also keeps their LRU times fresh.
+        if not force:
+            wanted = [t for t in texes if t.svgdata is None]
+            with self.stats.stage('svg-cache', len(wanted)) as run:
+                found = self._svgs.get_many(set(t.hash for t in wanted))
+                for tex in wanted:
+                    tex.svgdata = found.get(tex.hash)
+                run.hits = run.strings_out = len(found)
+                run.misses = len(set(t.hash for t in wanted)) - len(found)
+            self.update_sizes(t for t in wanted if t.svgdata is not None)
+
+        # Strings that do not compile have no page to convert
+        unmade = _unique(i for i in texes if i.error is None and
+                         (force or i.svgdata is None))
+
+        # As in render, strings another thread is converting are waited on
+        while unmade:
+            mine, events = self._claim(unmade, self._converting)
+            try:
+                if mine:
+                    self._exclusive(mine, self._convert,
+                                    None if force else self._unconverted)
+            finally:
+                self._release(mine, self._converting)
+
+            for event in events:
+                event.wait()
+            claimed = set(t.hash for t in mine)
+            unmade = [t for t in unmade if t.hash not in claimed and
+                      t.error is None and t.svgdata is None]
+
+        return texes
 
-        # This has been abandoned, for now. So all this function needs to do is
-        # to go through the list of texes. It should almost certainly group
-        # though. Dammit!
+    def _unconverted(self, texes):
+        """Those of texes whose SVG another process has not published
+        meanwhile"""
+        found = self._svgs.get_many(t.hash for t in texes)
+        todo = []
+        for tex in texes:
+            tex.svgdata = found.get(tex.hash)
+            if tex.svgdata is None:
+                todo.append(tex)
+        return todo
+
+    def _convert(self, unmade):
+        """Run dvisvgm over the pages of unmade, compiling any that have no
+        page yet, and add the results to the pack"""
+        # Worker-measured strings have no dvi page yet.
+        unplaced = [t for t in unmade if t.dvifile is None]
+        if unplaced:
+            self._render_batch(unplaced)
+            unmade = [t for t in unmade if t.error is None]
+            if not unmade:
+                return
+
+        wanted = sorted(set((t.dvifile, t.dvipage) for t in unmade))
+
+        if len(set(dvifile for dvifile, _ in wanted)) == 1:
+            dviname = self._temp(wanted[0][0])
+            pagemap = dict((w, w[1]) for w in wanted)
+        else:
+            with self.stats.stage('merge', len(wanted)):
+                dviname, pagemap = self._merge_pages(wanted)
+
+        # Only convert the pages we need, and pair them up by number
+        svgs = self._run_dvisvgm(dviname, pagemap.values())
+        with self.stats.stage('pack', len(unmade)) as run:
+            made = {}
+            for tex in unmade:
+                svgfile = svgs.get(pagemap[tex.dvifile, tex.dvipage])
+                if svgfile is not None:
+                    if svgfile not in made:
+                        with open(svgfile, 'rb') as f:
+                            made[svgfile] = f.read()
+                    tex.svgdata = made[svgfile]
+            self._svgs.put_many((t.hash, t.svgdata) for t in unmade
+                                if t.svgdata is not None)
+            run.strings_out = len(made)
+
+            for svgfile in svgs.itervalues():
+                os.remove(svgfile)
+        self.update_sizes(unmade)
+
+    def to_glyphs(self, texes):
+        """Give tex objects the glyph layout of their label as tex.glyphs,
+        from the glyph database or else read straight from the dvi file.
+        Labels using fonts that have no Type 1 outlines get False, and
+        should go through to_svg instead; so do labels whose fonts could not
+        be read, but those are not remembered, and are tried again next run.
+        The outlines themselves come from outlines()."""
+        unmade = [t for t in texes if t.error is None and t.glyphs is None]
+        if not unmade:
+            return texes
 
-        #filter for any that do not exist in svgcache...
-        svgnames = [self._cache(tex.hash + '.svg') for tex in texes]
+        with self.stats.stage('glyph-cache', len(unmade)) as run:
+            found = self._glyphdb.get_layouts(set(t.hash for t in unmade))
+            for tex in unmade:
+                if tex.hash in found:
+                    tex.glyphs = found[tex.hash]
+                    if tex.glyphs is None:
+                        tex.glyphs = False
+            run.hits = run.strings_out = len(found)
+            run.misses = len(unmade) - len(found)
+        unmade = [t for t in unmade if t.glyphs is None]
+        if not unmade:
+            return texes
 
-        
-        # Populate svgfiles with names for those that are known
-        for svgfile, tex in zip(svgnames, texes):
-            if os.path.isfile(svgfile):
-                tex.svgfile = svgfile
-
-        unmade = texes if force else [i for i in texes if i.svgfile is None]
-
-        unmade = sorted(unmade, key=lambda self: self.dvifile)
-
-        # filter
-
-        groups = itertools.groupby(unmade, lambda s: s.dvifile)
-
-        for group, xs in groups:
-            # Unbelievable subtle bug... we were exhausting the iterator.
-            # Lesson: test test test test test!
-            xs = list(xs)
-
-            if group is None:
-                xs = self.render((x.text for x in xs), force=True)
-                group = xs[0].dvifile
-
-            pages = sorted(x.dvipage for x in xs)
-            dviname = self._temp(group)
-            self._run_dvisvgm(dviname)
-            oldsvgs = glob.glob('%s*.svg' % dviname[:-4])
-            oldsvgs.sort()
-            for tex, oldsvg in zip(xs, oldsvgs):
-                newsvg = self._cache(tex.hash + '.svg')
-                os.rename(oldsvg, newsvg)
-                tex.svgfile = newsvg 
-                
+        unplaced = [t for t in unmade if t.dvifile is None]
+        if unplaced:
+            self._render_batch(unplaced)
+            unmade = [t for t in unmade if t.error is None]
+
+        byfile = {}
+        for tex in unmade:
+            byfile.setdefault(tex.dvifile, []).append(tex)
+
+        unread = set()
+        with self.stats.stage('layout', len(unmade)) as run:
+            for dvifile, xs in byfile.iteritems():
+                with dvi.DviFile(self._temp(dvifile)) as f:
+                    for tex in xs:
+                        try:
+                            tex.glyphs = self._glyphs.layout(f, tex.dvipage)
+                            run.strings_out += 1
+                        except IOError:
+                            ## kpsewhich or a font file failing us may not
+                            ## happen next time, so this is not stored
+                            tex.glyphs = False
+                            unread.add(tex.hash)
+                        except (KeyError, ValueError):
+                            ## A font missing from the map or a glyph missing
+                            ## from its font
+                            tex.glyphs = False
+
+        # Only outlines the database has not seen are written out
+        with self._lock:
+            keys = set(item[1] for t in unmade if t.glyphs
+                       for item in t.glyphs if item[0] == 'glyph')
+            keys -= self._stored_glyphs
+            self._stored_glyphs |= keys
+        self._glyphdb.put(((t.hash, None if t.glyphs is False else t.glyphs)
+                           for t in unmade if t.hash not in unread),
+                          dict((k, self._glyphs.glyphs[k]) for k in keys))
         return texes
 
+    def outlines(self, keys):
+        """Return a dict mapping glyph keys, as found in tex.glyphs, to
+        their outlines"""
+        known = self._glyphs.glyphs
+        missing = [k for k in set(keys) if k not in known]
+        if missing:
+            found = self._glyphdb.get_glyphs(missing)
+            known.update(found)
+            with self._lock:
+                self._stored_glyphs.update(found)
+        return dict((k, known[k]) for k in keys)
+
+    def to_paths(self, texes):
+        """Give tex objects the outline of their label as tex.paths, or
+        False where to_glyphs could not lay them out."""
+        self.to_glyphs(texes)
+        for tex in texes:
+            if tex.error is None and tex.paths is None:
+                if tex.glyphs is False:
+                    tex.paths = False
+                else:
+                    keys = [i[1] for i in tex.glyphs if i[0] == 'glyph']
+                    tex.paths = glyphs.expand(tex.glyphs, self.outlines(keys))
+        return texes
 
-    def _get_tex(self, string):
-        t = None
+    def _merge_pages(self, wanted):
+        """Join the wanted (dvifile, page) pairs into a new dvi file. Returns
+        its name and a dict mapping each pair to its page in the new file."""
+        merged = self._temp('merged-%d.dvi' % self._next_batch())
+
+        sources = {}
         try:
-            t = self._tex_cache[string]
-        except KeyError:
-            t = Tex(string)
-            self._tex_cache[string] = t
+            for dvifile, _ in wanted:
+                if dvifile not in sources:
+                    sources[dvifile] = dvi.DviFile(self._temp(dvifile))
+            dvi.concatenate(((sources[d], p) for d, p in wanted), merged)
+        finally:
+            for source in sources.itervalues():
+                source.close()
+
+        return merged, dict((w, n) for n, w in enumerate(wanted, 1))
+
+    def _claim(self, texes, inflight):
+        """Mark the texes nobody is working on as in flight in the given
+        dict. Returns those texes, which the caller must build and then
+        _release, and the events of texes another thread is building."""
+        mine, events = [], []
+        with self._lock:
+            for tex in texes:
+                event = inflight.get(tex.hash)
+                if event is None:
+                    inflight[tex.hash] = threading.Event()
+                    mine.append(tex)
+                elif event not in events:
+                    events.append(event)
+        return mine, events
+
+    def _release(self, texes, inflight):
+        """Wake anyone waiting on texes from _claim"""
+        with self._lock:
+            for tex in texes:
+                inflight.pop(tex.hash).set()
+
+    def _exclusive(self, texes, build, unbuilt=None):
+        """Call build on texes, which _claim has given this thread. In shared
+        mode, texes another process is building are waited for rather than
+        built again, and unbuilt(texes) is asked which of them still need
+        building once their locks are held. Everything build writes to the
+        cache directory is published by renaming, so nobody sees half an
+        entry."""
+        if not self._shared:
+            build(texes)
+            return
+
+        # Never wait while holding entry locks: take what is free first,
+        # then wait for the rest in a fixed order.
+        slots = dict((t.hash, LockFile.entry(t.hash)) for t in texes)
+        free, busy = [], []
+        for tex in texes:
+            if self._locks.lock(slots[tex.hash], blocking=False):
+                free.append(tex)
+            else:
+                busy.append(tex)
+
+        for group, wait in ((free, False), (busy, True)):
+            if not group:
+                continue
+            held = []
             try:
-                t.extents = self._db[string]
-            except KeyError, e:
-                pass
+                if wait:
+                    with self.stats.stage('wait', len(group)):
+                        for tex in sorted(group, key=lambda t: slots[t.hash]):
+                            self._locks.lock(slots[tex.hash])
+                            held.append(tex)
+                else:
+                    held = group
+                todo = group if unbuilt is None else unbuilt(group)
+                self.stats.count('shared', hits=len(group) - len(todo),
+                                 misses=len(todo))
+                if todo:
+                    build(todo)
+            finally:
+                for tex in held:
+                    self._locks.unlock(slots[tex.hash])
+
+    def _next_batch(self):
+        """Allocate a number for naming files in a new batch"""
+        with self._lock:
+            self._batchnumber += 1
+            return self._batchnumber - 1
 
-        return t
+    def _get_tex(self, string):
+        return self._tex_cache.get(string)
+
+    def update_sizes(self, texes):
+        """Tell the in-memory cache that texes have grown, such as by having
+        an SVG parsed for them, so that it keeps within its budget"""
+        with self._lock:
+            self._tex_cache.update(texes)
+
+    def _lookup_extents(self, texes):
+        """Fill in extents from the database in one query"""
+        missing = [t for t in texes if t.extents is None]
+        self.stats.count('memory', hits=len(texes) - len(missing),
+                         misses=len(missing))
+        if missing:
+            with self.stats.stage('lookup', len(missing)) as run:
+                found = self._db.get_many(set(t.hash for t in missing))
+                for t in missing:
+                    t.extents = found.get(t.hash)
+                run.hits = len([t for t in missing if t.extents is not None])
+                run.misses = len(missing) - run.hits
+                run.strings_out = run.hits
+
+    def _import_svg_files(self):
+        """Move SVGs cached one file each, as older versions did, into the
+        pack"""
+        name = re.compile(r'^[0-9a-f]{32}\.svg$')
+        filenames = [f for f in os.listdir(self._cachedir) if name.match(f)]
+        if not filenames:
+            return
+        with self.stats.stage('import', len(filenames)) as run:
+            svgs = []
+            for filename in filenames:
+                try:
+                    with open(self._cache(filename), 'rb') as f:
+                        svgs.append((filename[:-4], f.read()))
+                except IOError:
+                    # Another process got there first
+                    continue
+            self._svgs.put_many(svgs)
+            for filename in filenames:
+                try:
+                    os.remove(self._cache(filename))
+                except OSError as exc:
+                    if exc.errno != errno.ENOENT:
+                        raise
+            run.strings_out = len(svgs)
 
     def _template(self, filename):
         with open(os.path.join(self._templatedir, filename),'r') as f:
@@ -233,60 +1195,111 @@ class TexRunner(object):
     def _temp(self, filename):
         return os.path.join(self._tempdir, filename)
 
-    def _make_preamble(self, preamble):
+    def _latex_stamp(self):
+        """Identify the latex binary without running it"""
+        latex = find_executable('latex')
+        if latex is None:
+            return 'nolatex'
+        st = os.stat(os.path.realpath(latex))
+        return hashlib.md5('%s:%d:%d' % (latex, st.st_size, st.st_mtime))\
+                      .hexdigest()[:12]
+
+    def _check_preamble(self):
+        """Make sure the dumped preamble format is in the cache, building it
+        the first time it is needed."""
+        if self._preamble_checked:
+            return
+
+        with self._preamble_lock:
+            if self._preamble_checked:
+                return
+
+            if not os.path.isfile(self._fmt):
+                if self._shared:
+                    # Whoever gets the lock first builds it for everyone
+                    self._locks.lock(LockFile.PREAMBLE)
+                    try:
+                        if not os.path.isfile(self._fmt):
+                            self._make_preamble()
+                    finally:
+                        self._locks.unlock(LockFile.PREAMBLE)
+                else:
+                    self._make_preamble()
+
+            self._preamble_checked = True
+
+    def _make_preamble(self):
+        with self.stats.stage('preamble', processes=1):
+            self._dump_preamble()
+
+    def _dump_preamble(self):
         pipe = subprocess.PIPE
         with open(self._temp('preamble.tex'), 'w') as f:
-            f.write(preamble)
+            f.write(self._preamble)
 
-        self._pre = subprocess.Popen((
+        pre = subprocess.Popen((
             'latex','-interaction=batchmode', '-ini',
             '&latex preamble.tex\dump'), cwd=self._tempdir,
             stderr=pipe, stdout=pipe)
+        pre.communicate()
 
-    def _check_preamble(self):
-        if self._preamble_checked:
-            return
-
-        self._pre.communicate()
-
-        if self._pre.returncode != 0:
+        if pre.returncode != 0:
             raise RuntimeError('Latex was unable to compile the preamble.')
-            self._preamble_checked = True
-        del self._pre
-        self._preamble_checked = True
+
+        ## Copy next to the final name and rename, so other processes never
+        ## see a partial format.
+        partial = '%s.%d.tmp' % (self._fmt, os.getpid())
+        shutil.copyfile(self._temp('preamble.fmt'), partial)
+        os.rename(partial, self._fmt)
 
     ## Write out latex
     def _write_latex(self, filename, texes):
         with open(filename, 'w') as f:
-            f.write(self._body_tpl.render(texes = (t.text for t in texes)))
+            self._body_tpl.render_to(f, texes=(t.text for t in texes))
 
     ## Call LaTeX on file
-    def _run_latex(self, filename):
+    def _run_latex(self, filename, cwd=None):
+        ## The format lives in the cache, so point at it by its full path.
         result = subprocess.Popen(
-            ('latex','-interaction=nonstopmode','-fmt','preamble.fmt',filename),
-            stdout=subprocess.PIPE, cwd=self._tempdir)
-        ## This is stupid. It will throw an exception if there's an error.
-        ## This sounds at first like a good assumption
-        ## but it's not!!! We really need to find a way to work out which page
-        ## the error occurred on and give some kind of feedback in the TeX
-        ## objects. This would be *REALLY* handy for GUI. It would also be handy
-        ## to check that all the pages are being made.
+            ('latex','-interaction=nonstopmode',
+             '-fmt', self._fmt, filename),
+            stdout=subprocess.PIPE, cwd=cwd or self._tempdir)
+        ## Errors are read back from the log by LogParser, which can pin
+        ## them on the string that caused them.
         stdout, _ = result.communicate()
 
     ## Run dvipos
-    def _run_dvipos(self, dvifile):
+    def _run_dvipos(self, dvifile, cwd=None):
         subprocess.check_call(
-            ('dvipos', '-b', dvifile), cwd = self._tempdir,
+            ('dvipos', '-b', dvifile), cwd = cwd or self._tempdir,
             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
     ## Run dvisvgm
     def _run_dvisvgm(self, dvifile, pages=None):
+        """Convert pages of dvifile to SVGs written into the temporary
+        directory. Returns a dict mapping page numbers to the new files."""
         pipe = subprocess.PIPE
         pagestring = '0-' if pages is None\
                           else ','.join(map(str,sorted(pages)))
-        subprocess.check_call(
-            ('dvisvgm', '-S', '-n', '--bbox=none','-p', pagestring, dvifile),
-            cwd = self._tempdir, stdout=pipe, stderr=pipe)
+
+        # Unique to this run, as several may be converting at once
+        prefix = 'svg-%d' % self._next_batch()
+        pattern = self._temp(prefix + '-%p.svg')
+        with self.stats.stage('dvisvgm', len(pages or ()),
+                              processes=1) as run:
+            subprocess.check_call(
+                ('dvisvgm', '-S', '-n', '--bbox=none','-p', pagestring,
+                 '-o', pattern, dvifile),
+                cwd = os.path.dirname(dvifile), stdout=pipe, stderr=pipe)
+
+        svgs = {}
+        page = re.compile(re.escape(prefix) + r'-(\d+)\.svg$')
+        for svg in glob.glob(self._temp(prefix + '-*.svg')):
+            match = page.search(svg)
+            if match:
+                svgs[int(match.group(1))] = svg
+        run.strings_out = len(svgs)
+        return svgs
 
     def __del__(self):
         try:
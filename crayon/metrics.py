@@ -0,0 +1,147 @@
+"""Sizing simple numeric labels from font metrics, without running latex.
+
+Tick labels are nearly always plain numbers such as $0.5$, $-150$ or
+$10^{3}$, and laying those out takes nothing more than the TFM metrics of a
+handful of characters and TeX's rules for placing a superscript (rule 18 of
+Appendix G of The TeXbook). NumberMetrics does that for labels matching
+
+    $<number>$    $<number>^{<number>}$    $<number>^<digit>$
+
+where a number is an optional minus sign, digits, and optionally a point and
+more digits. Anything else is left to latex.
+
+Which font, size and character code each of those characters ends up as
+depends on the preamble, so it is found by typesetting the calibration
+strings once and reading back the DVI file. Kerns between digits are not
+applied; the math fonts in common use have none.
+
+"""
+
+import re
+
+def extents_of(boxes, baselines):
+    """Reduce character boxes (x0, y0, x1, y1) and their baselines, in
+    points, to extents (y0, ymin, xmin, ymax, xmax, yn)"""
+    if not boxes:
+        return (0.0,) * 6
+    return (baselines[0], min(b[1] for b in boxes), min(b[0] for b in boxes),
+            max(b[3] for b in boxes), max(b[2] for b in boxes), baselines[-1])
+
+class NumberMetrics(object):
+    """Lays out simple numeric labels from the TFM files of their fonts"""
+    chars = '-0123456789.'
+
+    ## Typesetting these gives the text style and script style font of
+    ## every character in chars
+    calibration = ('$%s$' % chars, '$0^{%s}$' % chars)
+
+    _number = r'-?[0-9]+(?:\.[0-9]+)?'
+    _pattern = re.compile(r'\$(%s)(?:\^(?:\{(%s)\}|([0-9])))?\$\Z'
+                          % (_number, _number))
+
+    def __init__(self, text, script, origin, fonts):
+        """Arguments:
+            text -- maps each of chars to its (font name, size in points,
+                    character code) in text style
+            script -- the same in script style
+            origin -- (h, v) in points of the top left corner of a label
+            fonts -- maps font names to Tfm objects
+
+        """
+        self.text = text
+        self.script = script
+        self.origin = origin
+        self._fonts = fonts
+
+        # Superscripts are placed using the parameters of the text size
+        # symbol font, which is where the minus sign comes from.
+        name, size, _ = text['-']
+        params = fonts[name].params
+        self._sup_shift = params[14] * size
+        self._sup_clearance = abs(params[5]) * size / 4.0
+
+    @classmethod
+    def from_dvi(cls, dvifile, pages, fonts):
+        """Calibrate from the pages of an open DviFile on which the
+        calibration strings were typeset. Raises ValueError if the pages
+        hold something unexpected."""
+        s = dvifile.scale
+        char_width = lambda font, code: \
+            fonts[font.name].metrics(code, font.scale)[0]
+
+        def read(page):
+            marks = list(dvifile.marks(page, char_width))
+            if any(m[0] != 'char' for m in marks):
+                raise ValueError('Calibration page holds a rule')
+            return [(m[1].name, m[1].scale * s, m[2], m[3] * s, m[4] * s)
+                    for m in marks]
+
+        text, script = read(pages[0]), read(pages[1])
+        if len(text) != len(cls.chars) or len(script) != len(cls.chars) + 1:
+            raise ValueError('Calibration pages do not match')
+
+        top = min(v - fonts[name].metrics(code, size)[1]
+                  for name, size, code, h, v in text)
+        origin = (text[0][3], top)
+        return cls(dict((ch, m[:3]) for ch, m in zip(cls.chars, text)),
+                   dict((ch, m[:3]) for ch, m in zip(cls.chars, script[1:])),
+                   origin, fonts)
+
+    def to_dict(self):
+        return dict(text=self.text, script=self.script, origin=self.origin)
+
+    @classmethod
+    def from_dict(cls, d, fonts):
+        fix = lambda table: dict((str(ch), (str(name), size, code))
+                                 for ch, (name, size, code) in table.items())
+        return cls(fix(d['text']), fix(d['script']), tuple(d['origin']),
+                   fonts)
+
+    def accepts(self, text):
+        return self._pattern.match(text) is not None
+
+    def extents(self, text):
+        """Return the extents latex would give text, or None if text is not
+        a simple number"""
+        match = self._pattern.match(text)
+        if match is None:
+            return None
+        base = match.group(1)
+        sup = match.group(2) or match.group(3)
+
+        boxes, baselines = [], []
+        x = self._set(base, self.text, 0.0, boxes, baselines)
+        if sup:
+            script, script_baselines = [], []
+            self._set(sup, self.script, x, script, script_baselines)
+            # Rule 18c, with u = 0 to begin with since the nucleus is a
+            # character
+            depth = max(b[3] for b in script)
+            u = max(self._sup_shift, depth + self._sup_clearance)
+            boxes.extend((x0, y0 - u, x1, y1 - u)
+                         for x0, y0, x1, y1 in script)
+            baselines.extend(v - u for v in script_baselines)
+
+        # The box is shipped out with its top left corner at the origin
+        h, v = self.origin
+        v -= min(b[1] for b in boxes)
+        return extents_of([(x0 + h, y0 + v, x1 + h, y1 + v)
+                           for x0, y0, x1, y1 in boxes],
+                          [b + v for b in baselines])
+
+    def _set(self, chars, table, x, boxes, baselines):
+        """Set chars on the baseline from x, adding their boxes. Returns
+        where the next character would go."""
+        for i, ch in enumerate(chars):
+            name, size, code = table[ch]
+            tfm = self._fonts[name]
+            width, height, depth, italic = tfm.metrics(code, size)
+            boxes.append((x, -height, x + width, depth))
+            baselines.append(0.0)
+            x += width
+            # Italic corrections go between characters unless they come
+            # from the same text font (rule 17)
+            following = table[chars[i + 1]][0] if i + 1 < len(chars) else None
+            if italic and (following != name or not tfm.params[2]):
+                x += italic
+        return x
@@ -1,10 +1,15 @@
 """Smart, immutable points which act as a 'remote control' for a
 graphics context
 
+Cursors are made by the thousand while drawing, so they are kept small: they
+have __slots__ rather than a __dict__, and the compass directions and the
+usual spaces are descriptors on the class (Mover and ChangeView), so that
+c.up(5) and c.paper are found without going through __getattr__.
+
 """
 
 from math import sqrt
-from spaces import Space2D, LinSpace2D, LinSpace
+from spaces import Space2D, LinSpace2D, LinSpace, converter
 
 class Compass(object):
     _norm = lambda x, y: (x/sqrt(2), y/sqrt(2))
@@ -26,11 +31,62 @@ class Compass(object):
         except AttributeError, e:
             raise KeyError('Not in Compass: %s' % a)
 
+class Mover(object):
+    """A direction as an attribute of Cursor: c.up(d) is a copy of c moved
+    by d in that direction, in the current space"""
+    def __init__(self, dx, dy):
+        self._dx = dx
+        self._dy = dy
+
+    def __get__(self, cursor, owner):
+        if cursor is None:
+            return self
+        dx, dy = self._dx, self._dy
+        return lambda d: cursor.move(d * dx, d * dy)
+
+    def __set__(self, cursor, value):
+        raise AttributeError('Cannot set a direction')
+
+    def __repr__(self):
+        return 'Mover(%g, %g)' % (self._dx, self._dy)
+
+class ChangeView(object):
+    """A space as an attribute of Cursor: c.paper is c in paper space"""
+    def __init__(self, name):
+        self._name = name
+
+    def __get__(self, cursor, owner):
+        if cursor is None:
+            return self
+        return cursor._switch_space(self._name)
+
+    def __set__(self, cursor, value):
+        raise AttributeError('Cannot set a space')
+
+    def __repr__(self):
+        return 'ChangeView(%r)' % self._name
+
 class Cursor(object):
     """A cursor is a coordinate proxy.  It is always made by another Cursor or a
     graphics context"""
+    __slots__ = ('_gc', '_spaces', '_current', '_cursor', '_path')
     
     compass = Compass()
+
+    N = up = Mover(*Compass.N)
+    E = right = Mover(*Compass.E)
+    S = down = Mover(*Compass.S)
+    W = left = Mover(*Compass.W)
+    NE = upRight = rightUp = Mover(*Compass.NE)
+    SE = downRight = rightDown = Mover(*Compass.SE)
+    NW = upLeft = leftUp = Mover(*Compass.NW)
+    SW = downLeft = leftDown = Mover(*Compass.SW)
+
+    ## Other spaces are found through __getattr__
+    box = ChangeView('box')
+    paper = ChangeView('paper')
+    absolute = ChangeView('absolute')
+    plot = ChangeView('plot')
     
     def __init__(self, gc, spaces, current, cursor = (0,0), path=()):
         """Initialise a Point. Most points will be created by the
@@ -59,31 +115,40 @@ class Cursor(object):
 
     def __call__(self, x, y):
         """Set cursor to coordinate (x, y) in current space"""
-        return self._set(cursor = (x,y))
+        return self._at((x, y))
 
     def __getattr__(self, attr):
-        # Proxy the Compass object
-        try:
-            dx, dy = self.compass[attr]
-            return lambda d: self.move(d * dx, d * dy)
-        except KeyError, e:
-            return self._switch_space(attr)
+        # Only reached for spaces without a ChangeView of their own
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        return self._switch_space(attr)
 
     def _set(self, spaces = None, current = None, cursor = None, path = None):
         """Return a new Cursor, settin any non-none parameters"""
-        path = self._path if path is None else path
-        spaces = self._spaces if spaces is None else spaces
-        cursor = self._cursor if cursor is None else cursor
-        current = self._current if current is None else current
-    
-        return Cursor(self._gc, spaces, current, cursor, path)
+        new = Cursor.__new__(Cursor)
+        new._gc = self._gc
+        new._spaces = self._spaces if spaces is None else spaces
+        new._current = self._current if current is None else current
+        new._cursor = self._cursor if cursor is None else cursor
+        new._path = self._path if path is None else path
+        return new
+
+    def _at(self, cursor):
+        """Return a new Cursor at cursor, otherwise the same"""
+        new = Cursor.__new__(Cursor)
+        new._gc = self._gc
+        new._spaces = self._spaces
+        new._current = self._current
+        new._cursor = cursor
+        new._path = self._path
+        return new
 
     def _lookup_space(self, name):
         """Lookup space in spaces dictionary"""
-        try:
-            return self._spaces[name]
-        except KeyError, e:
+        space = self._spaces.get(name)
+        if space is None:
             raise Exception('Space %r is undefined' % name)
+        return space
 
     def _switch_space(self, newName):
         """Switch coordinate space"""
@@ -93,10 +158,18 @@ class Cursor(object):
         if newSpace is oldSpace:
             return self
 
-        cursor = newSpace.from_box(oldSpace.to_box(self._cursor))
+        cursor = converter(oldSpace, newSpace)(self._cursor)
 
         return self._set(current = newSpace, cursor = cursor)
 
+    def pos_in(self, name):
+        """Cursor position in the named space, without making a new
+        Cursor"""
+        space = self._lookup_space(name)
+        if space is self._current:
+            return self._cursor
+        return converter(self._current, space)(self._cursor)
+
     def __dir__(self):
         return
 
@@ -109,8 +182,7 @@ class Cursor(object):
     def move(self, dx, dy):
         """Return a shifted new cursor"""
         cx, cy = self._cursor
-        cursor = (cx + dx, cy + dy)
-        return self._set(cursor = cursor)
+        return self._at((cx + dx, cy + dy))
 
     def distance_to(self, other):
         """Distance from cursor to another cursor in paper space"""
@@ -206,13 +278,11 @@ class Cursor(object):
 
     def x(self, x):
         """Return copy of current cursor with new x"""
-        _, y = self.pos
-        return self._set(cursor = (x, y))
+        return self._at((x, self._cursor[1]))
 
     def y(self, y):
         """Return copy of current cursor with new y"""
-        x, _ = self.pos
-        return self._set(cursor = (x, y))
+        return self._at((self._cursor[0], y))
 
     def draw(self, *a, **kw):
         """Draw the currently stored path - mutates context"""
@@ -262,6 +332,8 @@ class Cursor(object):
 
     def _clear_path(self):
         """Clear the currently stored path"""
+        if not self._path:
+            return self
         return self._set(path = ())
 
 
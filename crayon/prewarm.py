@@ -0,0 +1,87 @@
+"""Filling the caches ahead of time.
+
+A fresh host pays for latex, dvisvgm and friends the first time it sees
+each label. Most labels are predictable, so they can be compiled in bulk
+beforehand:
+
+    python -m crayon prewarm lin:-1000:1000:1 log:-12:12 titles.txt
+
+Each source is either a generator spec or a file of labels, one per line:
+
+    lin:A:B:STEP   the labels a LinTicker with range (A, B) and major
+                   frequency STEP gives, such as $-1000$ ... $1000$
+    log:A:B        the labels a LogTicker gives for the decades from 10^A
+                   to 10^B, such as $10^{-12}$ ... $10^{12}$
+
+"""
+
+import sys
+
+## The tickers are asked for their labels, so that prewarming compiles just
+## what plots will. They are imported when needed, so that crayon does not
+## need plots otherwise.
+
+def lin_labels(a, b, step):
+    """Labels of a linear axis, from a LinTicker"""
+    from plots.layers import LinTicker
+    ticker = LinTicker()
+    ticker.range = a, b
+    ticker.major_frequency = step
+    return [label for _, label in ticker.major]
+
+def log_labels(a, b):
+    """Labels of the decades of a log axis, from a LogTicker over 10^a to
+    10^b"""
+    from plots.layers import LogTicker
+    ticker = LogTicker()
+    ticker.range = 10.0 ** a, 10.0 ** b
+    return [label for _, label in ticker.major]
+
+_specs = dict(lin=(lin_labels, 3), log=(log_labels, 2))
+
+def read_source(source):
+    """Return the labels a source stands for: a spec, a filename, or - for
+    standard input. Raises ValueError for a malformed spec."""
+    kind, _, rest = source.partition(':')
+    if kind in _specs and rest:
+        generate, nargs = _specs[kind]
+        try:
+            args = [float(i) for i in rest.split(':')]
+        except ValueError:
+            args = ()
+        if len(args) != nargs or (kind == 'lin' and args[2] <= 0):
+            raise ValueError('bad %s spec %r' % (kind, source))
+        return generate(*args)
+
+    if source == '-':
+        return _read_lines(sys.stdin)
+    with open(source, 'r') as f:
+        return _read_lines(f)
+
+def _read_lines(f):
+    return [line.rstrip('\r\n') for line in f if line.strip()]
+
+def prewarm(runner, labels, batch=2000, svg=True, force=False,
+            progress=None):
+    """Compile labels with runner in batches of the given size, filling the
+    extents database and, if svg is true, the SVG cache. Labels that are
+    already cached are skipped unless force is true. Returns a dict
+    counting the labels and those that failed to compile.
+
+    progress -- called with (labels done, labels in all) after each batch
+                (default None)
+
+    """
+    seen = set()
+    labels = [l for l in labels if not (l in seen or seen.add(l))]
+
+    failed = 0
+    for start in xrange(0, len(labels), batch):
+        texes = runner.render(labels[start:start + batch], force=force)
+        if svg:
+            runner.to_svg(texes, force=force)
+        failed += len([t for t in texes if t.error])
+        if progress is not None:
+            progress(min(start + batch, len(labels)), len(labels))
+
+    return dict(labels=len(labels), failed=failed)
@@ -3,9 +3,30 @@ Spaces are one-dimensional bijections from real to real. These are bijections to
 and from 'box space' -- a relative space where (0, 0) is the bottom left corner
 and (1, 1) is the top-right corner of the box. 
 
+Besides converting one coordinate at a time, every space converts whole
+columns of them with to_box_array and from_box_array: a sequence of N
+coordinates for a 1D space, or of N (x, y) points for a 2D space. With numpy
+these go through the whole chain of spaces in one vectorised pass and return
+arrays of shape (N,) or (N, 2); without it they return lists.
+
+A ComposedSpace fuses each run of linear 2D spaces in it, such as the
+LinSpace2D and its inverse added by every zoom, into one AffineSpace2D, so
+a point costs one affine map per run however deeply zooms are nested.
+
+converter() goes a step further: it compiles the conversion from one space to
+another into a single Python function, with the constants of every stage
+written into its source, so that a point makes no method calls at all.
+
 """
 
-from math import log, exp
+from math import log, exp, log1p, expm1, copysign
+import datetime
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class Space(object):
     """Bijection class. Stores function and its inverse. If this class is not
@@ -18,6 +39,39 @@ class Space(object):
         """Convert from box coordinates to this coordinate space"""
         return x
 
+    def to_box_array(self, xs):
+        """Convert a sequence of coordinates to box coordinates at once"""
+        if numpy is None:
+            return [self.to_box(x) for x in xs]
+        return self._to_box_array(numpy.asarray(xs, dtype=float))
+
+    def from_box_array(self, xs):
+        """Convert a sequence of box coordinates to this space at once"""
+        if numpy is None:
+            return [self.from_box(x) for x in xs]
+        return self._from_box_array(numpy.asarray(xs, dtype=float))
+
+    # The vectorised forms, given an ndarray. Arithmetic alone works on
+    # arrays as it stands; spaces using math functions override these.
+    def _to_box_array(self, xs):
+        return self.to_box(xs)
+
+    def _from_box_array(self, xs):
+        return self.from_box(xs)
+
+    def _linear(self):
+        """Return (m, c) if to_box(x) is m*x + c, or else None. Subclasses
+        are taken not to be linear unless they say so."""
+        return (1.0, 0.0) if type(self) is Space else None
+
+    def _expr(self, var, inverse, compiler):
+        """Python expression for to_box (or from_box if inverse) of the
+        variable var, for converter(). Subclasses that do not give one are
+        called through their methods."""
+        if type(self) is Space:
+            return var
+        return compiler.call(self, inverse, var)
+
     def __repr__(self):
         return "<Space>" 
 
@@ -28,6 +82,16 @@ class Space(object):
         space = Space()
         space.to_box = self.from_box
         space.from_box = self.to_box
+        space._to_box_array = self._from_box_array
+        space._from_box_array = self._to_box_array
+        space._expr = lambda var, inverse, compiler: \
+            self._expr(var, not inverse, compiler)
+        linear = self._linear()
+        if linear is None:
+            space._linear = lambda: None
+        else:
+            m, c = linear
+            space._linear = lambda: (1.0 / m, -c / m)
         return space
 
 class LinSpace(Space):
@@ -44,6 +108,15 @@ class LinSpace(Space):
     def from_box(self, x):
         return self.range*x + self.a 
 
+    def _linear(self):
+        return self.m, -self.m * self.a
+
+    def _expr(self, var, inverse, compiler):
+        num = compiler.num
+        if inverse:
+            return '%s*%s + %s' % (num(self.range), var, num(self.a))
+        return '%s * (%s - %s)' % (num(self.m), var, num(self.a))
+
     def __repr__(self):
         return "<LinSpace (%g, %g)>" % self.params
 
@@ -63,10 +136,200 @@ class LogSpace(Space):
     def from_box(self, x):
         return self.C*exp(self.d*x)
 
+    def _to_box_array(self, xs):
+        return self.A*numpy.log(self.m*xs)
+
+    def _from_box_array(self, xs):
+        return self.C*numpy.exp(self.d*xs)
+
+    def _expr(self, var, inverse, compiler):
+        num = compiler.num
+        if inverse:
+            return '%s*_exp(%s*%s)' % (num(self.C), num(self.d), var)
+        return '%s*_log(%s*%s)' % (num(self.A), num(self.m), var)
+
     def __repr__(self):
         return "<LogSpace (%g, %g)>" % self.params
 
 
+class _WarpedSpace(Space):
+    """Bijection linear in warp(x), taking a to 0 and b to 1. Subclasses
+    give warp and unwarp, both for scalars and arrays (by way of the
+    module, math or numpy, they are given), and their expressions for
+    converter()."""
+    def __init__(self, a, b):
+        self.a, self.b = a, b
+        self._fa = fa = self._warp(a, math)
+        self._span = span = self._warp(b, math) - fa
+        self._k = 1.0 / span
+
+    def to_box(self, x):
+        return self._k * (self._warp(x, math) - self._fa)
+
+    def from_box(self, x):
+        return self._unwarp(self._span*x + self._fa, math)
+
+    def _to_box_array(self, xs):
+        return self._k * (self._warp(xs, numpy) - self._fa)
+
+    def _from_box_array(self, xs):
+        return self._unwarp(self._span*xs + self._fa, numpy)
+
+    def _expr(self, var, inverse, compiler):
+        num = compiler.num
+        if inverse:
+            return self._unwarp_expr('(%s*%s + %s)' % (
+                num(self._span), var, num(self._fa)), num)
+        return '%s * (%s - %s)' % (num(self._k), self._warp_expr(var, num),
+                                   num(self._fa))
+
+class SymLogSpace(_WarpedSpace):
+    """Symmetric logarithmic bijection: logarithmic in |x| far from zero,
+    and linear within about linthresh of it, so that zero and negative
+    values have a place."""
+    def __init__(self, a, b, linthresh=1.0):
+        self.params = a, b, linthresh
+        self.linthresh = float(linthresh)
+        _WarpedSpace.__init__(self, a, b)
+
+    def _warp(self, x, m):
+        return m.copysign(m.log1p(abs(x) / self.linthresh), x)
+
+    def _unwarp(self, x, m):
+        return m.copysign(self.linthresh * m.expm1(abs(x)), x)
+
+    def _warp_expr(self, var, num):
+        return '_copysign(_log1p(abs(%s) / %s), %s)' % (
+            var, num(self.linthresh), var)
+
+    def _unwarp_expr(self, var, num):
+        return '_copysign(%s*_expm1(abs(%s)), %s)' % (
+            num(self.linthresh), var, var)
+
+    def __repr__(self):
+        return "<SymLogSpace (%g, %g, %g)>" % self.params
+
+class PowerSpace(_WarpedSpace):
+    """Power law bijection, linear in x**exponent, and symmetric about zero
+    for negative values"""
+    def __init__(self, a, b, exponent=0.5):
+        self.params = a, b, exponent
+        self.exponent = float(exponent)
+        _WarpedSpace.__init__(self, a, b)
+
+    def _warp(self, x, m):
+        return m.copysign(abs(x) ** self.exponent, x)
+
+    def _unwarp(self, x, m):
+        return m.copysign(abs(x) ** (1.0 / self.exponent), x)
+
+    def _warp_expr(self, var, num):
+        return '_copysign(abs(%s)**%s, %s)' % (var, num(self.exponent), var)
+
+    def _unwarp_expr(self, var, num):
+        return '_copysign(abs(%s)**%s, %s)' % (
+            var, num(1.0 / self.exponent), var)
+
+    def __repr__(self):
+        return "<PowerSpace (%g, %g, %g)>" % self.params
+
+class ReversedSpace(Space):
+    """Another space running the other way, from 1 at its start to 0 at its
+    end"""
+    def __init__(self, space=None):
+        """Keyword arguments:
+            space -- the space to reverse (default Space())
+
+        """
+        self.space = space if space else Space()
+
+    def to_box(self, x):
+        return 1.0 - self.space.to_box(x)
+
+    def from_box(self, x):
+        return self.space.from_box(1.0 - x)
+
+    def _to_box_array(self, xs):
+        return 1.0 - self.space._to_box_array(xs)
+
+    def _from_box_array(self, xs):
+        return self.space._from_box_array(1.0 - xs)
+
+    def _linear(self):
+        linear = self.space._linear()
+        if linear is None:
+            return None
+        m, c = linear
+        return -m, 1.0 - c
+
+    def _expr(self, var, inverse, compiler):
+        if inverse:
+            return self.space._expr('(1.0 - %s)' % var, True, compiler)
+        return '1.0 - (%s)' % self.space._expr(var, False, compiler)
+
+    def __repr__(self):
+        return "<ReversedSpace %r>" % self.space
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+def epoch_ns(t):
+    """Nanoseconds since the Unix epoch of a datetime (naive ones taken as
+    UTC), date, numpy.datetime64 or number of seconds"""
+    if isinstance(t, datetime.datetime):
+        if t.tzinfo is not None:
+            t = t.replace(tzinfo=None) - t.utcoffset()
+    elif isinstance(t, datetime.date):
+        t = datetime.datetime(t.year, t.month, t.day)
+    elif numpy is not None and isinstance(t, numpy.datetime64):
+        return int(t.astype('datetime64[ns]').astype('int64'))
+    else:
+        return int(round(t * 1e9))
+    d = t - _EPOCH
+    return (d.days * 86400 + d.seconds) * 10**9 + d.microseconds * 1000
+
+class DateTimeSpace(LinSpace):
+    """Linear bijection for time. Coordinates are seconds since the Unix
+    epoch, but to_box also takes datetimes, dates and numpy.datetime64
+    values, and to_box_array arrays of datetime64, which are converted at
+    nanosecond precision.
+
+    Only this space itself knows about times: 2D spaces, their arrays and
+    converter() take x as seconds, as floats, which hold the time to about
+    a microsecond. Where that is not enough, convert the x column with
+    this space's own to_box_array.
+
+    """
+    def __init__(self, a, b):
+        self.params = a, b
+        self._a_ns = epoch_ns(a)
+        span_ns = epoch_ns(b) - self._a_ns
+        self.a = self._a_ns * 1e-9
+        self.range = span_ns * 1e-9
+        self.m = 1.0 / self.range
+        self._m_ns = 1.0 / span_ns
+
+    def to_box(self, t):
+        if isinstance(t, (int, long, float)):
+            return self.m * (t - self.a)
+        return self._m_ns * (epoch_ns(t) - self._a_ns)
+
+    def to_box_array(self, ts):
+        if numpy is None:
+            return [self.to_box(t) for t in ts]
+        ts = numpy.asarray(ts)
+        if ts.dtype.kind == 'M':
+            ns = ts.astype('datetime64[ns]').astype('int64') - self._a_ns
+            return self._m_ns * ns
+        if ts.dtype.kind == 'O':
+            return numpy.array([self.to_box(t) for t in ts], dtype=float)
+        return self._to_box_array(ts.astype(float))
+
+    def _to_box_array(self, xs):
+        return self.m * (xs - self.a)
+
+    def __repr__(self):
+        return "<DateTimeSpace (%r, %r)>" % self.params
+
 class Space2D(object):
     """A 2D space, composed of two 1D spaces. Defaults to the 2D
     identity space.
@@ -92,11 +355,58 @@ class Space2D(object):
         x, y = p
         return (self.xspace.from_box(x), self.yspace.from_box(y))
 
+    def to_box_array(self, ps):
+        """Convert a sequence of points (x, y) to 2D box space at once"""
+        if numpy is None:
+            return [self.to_box(p) for p in ps]
+        return self._to_box_array(_points(ps))
+
+    def from_box_array(self, ps):
+        """Convert a sequence of points (x, y) from 2D box space at once"""
+        if numpy is None:
+            return [self.from_box(p) for p in ps]
+        return self._from_box_array(_points(ps))
+
+    def _to_box_array(self, ps):
+        out = numpy.empty_like(ps)
+        out[:, 0] = self.xspace._to_box_array(ps[:, 0])
+        out[:, 1] = self.yspace._to_box_array(ps[:, 1])
+        return out
+
+    def _from_box_array(self, ps):
+        out = numpy.empty_like(ps)
+        out[:, 0] = self.xspace._from_box_array(ps[:, 0])
+        out[:, 1] = self.yspace._from_box_array(ps[:, 1])
+        return out
+
     @property
     def inverse(self):
         """A 2D space with both x and y spaces inverted."""
         return Space2D(self.xspace.inverse, self.yspace.inverse)
 
+    def _code(self, inverse, compiler):
+        """Statements converting the variables x and y to box space (or
+        from it if inverse), for converter(). Subclasses that do not give
+        their own are called through their methods."""
+        if type(self) not in (Space2D, LinSpace2D):
+            return compiler.call2d(self, inverse)
+        x = self.xspace._expr('x', inverse, compiler)
+        y = self.yspace._expr('y', inverse, compiler)
+        if (x, y) == ('x', 'y'):
+            return []
+        return ['x, y = %s, %s' % (x, y)]
+
+    def _affine(self):
+        """Return this space as an AffineSpace2D, or None if it is not
+        linear. Subclasses are taken not to be linear unless they say so,
+        since they may not map x and y separately."""
+        if type(self) not in (Space2D, LinSpace2D):
+            return None
+        x, y = self.xspace._linear(), self.yspace._linear()
+        if x is None or y is None:
+            return None
+        return AffineSpace2D(x[0], 0.0, x[1], 0.0, y[0], y[1])
+
     def append(self, other):
         """Return a ComposedSpace consisting of this space and another
         one.
@@ -107,6 +417,10 @@ class Space2D(object):
     def __repr__(self):
         return "<Space2D (%r, %r)>" % (self.xspace, self.yspace)
 
+def _points(ps):
+    """An (N, 2) array of floats from a sequence of points"""
+    return numpy.asarray(ps, dtype=float).reshape(-1, 2)
+
 class LinSpace2D(Space2D):
     """2D space composed of two linear 1D spaces. Most common 2D
     space.
@@ -118,10 +432,94 @@ class LinSpace2D(Space2D):
 # An alias for a duplicated BoxSpace class.
 BoxSpace = Space2D
 
+class AffineSpace2D(Space2D):
+    """2D affine bijection, given by the coefficients of to_box:
+
+        box x = a*x + b*y + c
+        box y = d*x + e*y + f
+
+    """
+    def __init__(self, a, b, c, d, e, f):
+        self.params = a, b, c, d, e, f
+        det = float(a * e - b * d)
+        if not det:
+            raise ValueError('Affine map is singular')
+        # from_box, found by inverting the matrix
+        self._inverse_params = (e / det, -b / det, (b * f - c * e) / det,
+                                -d / det, a / det, (c * d - a * f) / det)
+
+    def to_box(self, p):
+        """Convert 2D point p = (x, y) to 2D box space."""
+        x, y = p
+        a, b, c, d, e, f = self.params
+        return (a*x + b*y + c, d*x + e*y + f)
+
+    def from_box(self, p):
+        """Convert 2D point p = (x, y) from 2D box space."""
+        x, y = p
+        a, b, c, d, e, f = self._inverse_params
+        return (a*x + b*y + c, d*x + e*y + f)
+
+    def _to_box_array(self, ps):
+        return _affine_array(self.params, ps)
+
+    def _from_box_array(self, ps):
+        return _affine_array(self._inverse_params, ps)
+
+    @property
+    def inverse(self):
+        return AffineSpace2D(*self._inverse_params)
+
+    def _affine(self):
+        return self
+
+    def _code(self, inverse, compiler):
+        a, b, c, d, e, f = self._inverse_params if inverse else self.params
+        num = compiler.num
+        def row(mx, my, k):
+            terms = ['%s*x' % num(mx)] if mx else []
+            if my:
+                terms.append('%s*y' % num(my))
+            if k:
+                terms.append(num(k))
+            return ' + '.join(terms)
+        return ['x, y = %s, %s' % (row(a, b, c), row(d, e, f))]
+
+    def then(self, other):
+        """The affine space whose to_box is this one's after other's"""
+        a, b, c, d, e, f = self.params
+        p, q, r, s, t, u = other.params
+        return AffineSpace2D(a*p + b*s, a*q + b*t, a*r + b*u + c,
+                             d*p + e*s, d*q + e*t, d*r + e*u + f)
+
+    def __repr__(self):
+        return "<AffineSpace2D (%g, %g, %g, %g, %g, %g)>" % self.params
+
+def _affine_array(params, ps):
+    a, b, c, d, e, f = params
+    out = numpy.empty_like(ps)
+    x, y = ps[:, 0], ps[:, 1]
+    out[:, 0] = a*x + b*y + c
+    out[:, 1] = d*x + e*y + f
+    return out
+
 class ComposedSpace(Space2D):
-    """2D Space of composed 2D bijections."""
+    """2D Space of composed 2D bijections. Runs of linear spaces are fused
+    into one AffineSpace2D as they are composed."""
     def __init__(self, *kws):
-        self._spaces = tuple(kws)
+        spaces = []
+        for space in kws:
+            parts = space._spaces if isinstance(space, ComposedSpace) \
+                    else (space,)
+            for part in parts:
+                affine = part._affine()
+                if affine is not None and spaces and \
+                   isinstance(spaces[-1], AffineSpace2D):
+                    # to_box runs from the last space to the first
+                    spaces[-1] = spaces[-1].then(affine)
+                else:
+                    spaces.append(part if affine is None else affine)
+        self._spaces = tuple(spaces)
 
     def to_box(self, x):
         """Convert point p = (x, y) to 2D box space"""
@@ -135,6 +533,34 @@ class ComposedSpace(Space2D):
             x = space.from_box(x)
         return x
 
+    def _to_box_array(self, ps):
+        for space in reversed(self._spaces):
+            ps = space._to_box_array(ps)
+        return ps
+
+    def _from_box_array(self, ps):
+        for space in self._spaces:
+            ps = space._from_box_array(ps)
+        return ps
+
+    @property
+    def inverse(self):
+        """The composition of the inverses, in reverse order"""
+        return ComposedSpace(*[s.inverse for s in reversed(self._spaces)])
+
+    def _affine(self):
+        if len(self._spaces) == 1:
+            return self._spaces[0]._affine()
+        return None
+
+    def _code(self, inverse, compiler):
+        spaces = self._spaces if inverse else reversed(self._spaces)
+        return [line for space in spaces
+                for line in compiler.code(space, inverse)]
+
+    def __repr__(self):
+        return "<ComposedSpace %r>" % (self._spaces,)
+
     def append(self, other):
         """Return a new composed 2D space according to the identity: 
         
@@ -143,3 +569,89 @@ class ComposedSpace(Space2D):
         """ 
 
         return ComposedSpace(*(self._spaces + (other,)))
+
+class _Compiler(object):
+    """Gathers the source and constants of a function made by converter()"""
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.namespace = dict(numpy=numpy, _points=_points,
+                              _log=numpy.log if arrays else log,
+                              _exp=numpy.exp if arrays else exp,
+                              _log1p=numpy.log1p if arrays else log1p,
+                              _expm1=numpy.expm1 if arrays else expm1,
+                              _copysign=numpy.copysign if arrays
+                                        else copysign)
+
+    def num(self, value):
+        # repr gives back exactly the same float
+        return repr(float(value))
+
+    def const(self, obj):
+        name = '_c%d' % len(self.namespace)
+        self.namespace[name] = obj
+        return name
+
+    def call(self, space, inverse, var):
+        """Expression converting var through the methods of a 1D space"""
+        method = ('from_box' if inverse else 'to_box')
+        if self.arrays:
+            method = '_%s_array' % method
+        return '%s.%s(%s)' % (self.const(space), method, var)
+
+    def code(self, space, inverse):
+        """Statements converting x and y through a 2D space"""
+        if hasattr(space, '_code'):
+            return space._code(inverse, self)
+        return self.call2d(space, inverse)
+
+    def call2d(self, space, inverse):
+        """Statements converting x and y through the methods of a 2D
+        space"""
+        method = ('from_box' if inverse else 'to_box')
+        if self.arrays:
+            return ['x = %s._%s_array(numpy.column_stack((x, y)))'
+                    % (self.const(space), method),
+                    'x, y = x[:, 0], x[:, 1]']
+        return ['x, y = %s.%s((x, y))' % (self.const(space), method)]
+
+    def function(self, source, target):
+        lines = self.code(source, False) + self.code(target, True)
+        if self.arrays:
+            lines = (['ps = _points(ps)', 'x, y = ps[:, 0], ps[:, 1]'] +
+                     lines + ['return numpy.column_stack((x, y))'])
+        else:
+            lines = ['x, y = p'] + lines + ['return x, y']
+        text = 'def convert(%s):\n%s' % ('ps' if self.arrays else 'p',
+                                          ''.join('    %s\n' % l
+                                                  for l in lines))
+        exec compile(text, '<converter>', 'exec') in self.namespace
+        convert = self.namespace['convert']
+        convert.source = text
+        return convert
+
+## (id of source, id of target, arrays) -> (source, target, function). The
+## spaces are kept so that their ids cannot be reused while cached.
+_converters = {}
+_max_converters = 1024
+
+def converter(source, target, arrays=False):
+    """Return a function taking a point (x, y) in 2D space source to the
+    same point in target, as target.from_box(source.to_box(p)) would, but
+    compiled into one function. With arrays set, the function converts a
+    sequence of points at once, as the _array methods do. Functions are
+    cached by the identity of the spaces, so spaces must not be changed
+    once they have been converted between."""
+    key = id(source), id(target), arrays
+    entry = _converters.get(key)
+    if entry is not None and entry[0] is source and entry[1] is target:
+        return entry[2]
+
+    if arrays and numpy is None:
+        scalar = converter(source, target)
+        convert = lambda ps: [scalar(p) for p in ps]
+    else:
+        convert = _Compiler(arrays).function(source, target)
+    if len(_converters) >= _max_converters:
+        _converters.clear()
+    _converters[key] = source, target, convert
+    return convert
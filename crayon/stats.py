@@ -0,0 +1,139 @@
+"""Where the time goes in turning strings into pictures.
+
+A Stats object collects, for each named stage of the pipeline, how often it
+ran, the wall time spent in it, the external processes it started, the
+strings that went in and came out, and cache hits and misses. Only the
+totals are kept unless tracing is asked for, in which case every run of a
+stage is also kept as an event, so that a whole session can be dumped in the
+Chrome trace format and looked at in chrome://tracing or Perfetto.
+
+"""
+
+from collections import deque
+import threading
+import json
+import time
+import os
+
+class _Run(object):
+    """Counts for one run of a stage, filled in as it goes"""
+    def __init__(self, strings_in, processes):
+        self.strings_in = strings_in
+        self.strings_out = 0
+        self.processes = processes
+        self.hits = 0
+        self.misses = 0
+
+class _Stage(object):
+    def __init__(self, stats, name, strings_in, processes):
+        self._stats = stats
+        self._name = name
+        self._run = _Run(strings_in, processes)
+
+    def __enter__(self):
+        self._start = time.time()
+        return self._run
+
+    def __exit__(self, *exc):
+        self._stats._add(self._name, self._start, time.time() - self._start,
+                         self._run)
+
+class Stats(object):
+    """Timings and counters per stage. May be shared between threads."""
+    fields = ('calls', 'seconds', 'processes', 'strings_in', 'strings_out',
+              'hits', 'misses')
+
+    def __init__(self, trace=False):
+        """Keyword arguments:
+            trace -- keep every run of a stage for dump_trace: True to keep
+                     them all, or a number to keep only that many of the
+                     latest (default False, keeping only the totals)
+
+        """
+        self._lock = threading.Lock()
+        self._trace = trace
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._stages = {}
+            if self._trace is False:
+                self._events = None
+            else:
+                maxlen = None if self._trace is True else self._trace
+                self._events = deque(maxlen=maxlen)
+
+    def stage(self, name, strings_in=0, processes=0):
+        """Time a stage with a with block. The block gets an object whose
+        strings_out, processes, hits and misses it may set as it learns
+        them."""
+        return _Stage(self, name, strings_in, processes)
+
+    def count(self, name, hits=0, misses=0, strings_in=0, strings_out=0):
+        """Add to the counters of a stage without timing anything"""
+        run = _Run(strings_in, 0)
+        run.strings_out, run.hits, run.misses = strings_out, hits, misses
+        with self._lock:
+            self._accumulate(name, 0, 0.0, run)
+
+    def _add(self, name, start, seconds, run):
+        with self._lock:
+            self._accumulate(name, 1, seconds, run)
+            if self._events is not None:
+                self._events.append((name, start, seconds,
+                                     threading.current_thread().ident, run))
+
+    def _accumulate(self, name, calls, seconds, run):
+        try:
+            totals = self._stages[name]
+        except KeyError:
+            totals = self._stages[name] = dict.fromkeys(self.fields, 0)
+            totals['seconds'] = 0.0
+        totals['calls'] += calls
+        totals['seconds'] += seconds
+        for field in self.fields[2:]:
+            totals[field] += getattr(run, field)
+
+    def __getitem__(self, name):
+        """Totals for a stage, as a dict of fields"""
+        with self._lock:
+            return dict(self._stages.get(name) or
+                        dict.fromkeys(self.fields, 0))
+
+    def as_dict(self):
+        """Return a dict mapping each stage that has run to its totals"""
+        with self._lock:
+            return dict((k, dict(v)) for k, v in self._stages.iteritems())
+
+    def report(self):
+        """Return the totals as a table, slowest stage first"""
+        stages = sorted(self.as_dict().iteritems(),
+                        key=lambda item: -item[1]['seconds'])
+        lines = ['%-12s %6s %9s %5s %8s %8s %6s %6s' %
+                 ('stage', 'calls', 'seconds', 'procs', 'in', 'out', 'hits',
+                  'misses')]
+        for name, t in stages:
+            lines.append('%-12s %6d %9.3f %5d %8d %8d %6d %6d' % (
+                name, t['calls'], t['seconds'], t['processes'],
+                t['strings_in'], t['strings_out'], t['hits'], t['misses']))
+        return '\n'.join(lines)
+
+    def dump(self, filename):
+        """Write the totals to filename as JSON"""
+        with open(filename, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+
+    def dump_trace(self, filename):
+        """Write the runs of stages that were kept to filename in the Chrome
+        trace event format. Raises ValueError unless tracing is on."""
+        if self._trace is False:
+            raise ValueError('Stats were made without trace')
+        with self._lock:
+            events = list(self._events)
+        pid = os.getpid()
+        trace = [dict(name=name, ph='X', pid=pid, tid=tid,
+                      ts=int(start * 1e6), dur=int(seconds * 1e6),
+                      args=dict((f, getattr(run, f)) for f in self.fields[2:]))
+                 for name, start, seconds, tid, run in events]
+        with open(filename, 'w') as f:
+            json.dump(dict(traceEvents=trace, displayTimeUnit='ms'), f)
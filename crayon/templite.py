@@ -29,6 +29,9 @@ import sys, re
 
 class Templite(object):
     auto_emit = re.compile('(^[\'\"])|(^[a-zA-Z0-9_\[\]\'\"]+$)')
+
+    ## Emitted parts gathered into each chunk that generate yields
+    chunk_parts = 256
     
     def __init__(self, template, start='${', end='}$'):
         if len(start) != 2 or len(end) != 2:
@@ -36,12 +39,18 @@ class Templite(object):
         delimiter = re.compile('%s(.*?)%s' % (re.escape(start), re.escape(end)), re.DOTALL)
         offset = 0
         tokens = []
+        # The same code as a generator function, which hands back what has
+        # been emitted so far after each part that can emit
+        gen_tokens = ['def __templite(__out):']
+        flush = ('\n%(i)sif len(__out) >= %(n)d:\n%(i)s\tyield "".join(__out)'
+                 '\n%(i)s\tdel __out[:]')
         for i, part in enumerate(delimiter.split(template)):
             part = part.replace('\\'.join(list(start)), start)
             part = part.replace('\\'.join(list(end)), end)
             if i % 2 == 0:
                 if not part: continue
                 part = part.replace('\\', '\\\\').replace('"', '\\"')
+                gen_part = '\t' * (offset + 1) + 'emit("""%s""")' % part
                 part = '\t' * offset + 'emit("""%s""")' % part
             else:
                 part = part.rstrip()
@@ -57,12 +66,22 @@ class Templite(object):
                 lines = part.splitlines()
                 margin = min(len(l) - len(l.lstrip()) for l in lines if l.strip())
                 part = '\n'.join('\t' * offset + l[margin:] for l in lines)
+                gen_part = '\n'.join('\t' + l for l in part.split('\n'))
                 if part.endswith(':'):
                     offset += 1
+                    tokens.append(part)
+                    gen_tokens.append(gen_part)
+                    continue
             tokens.append(part)
+            gen_tokens.append(gen_part + flush % dict(i='\t' * (offset + 1),
+                                                      n=self.chunk_parts))
         if offset:
             raise SyntaxError('%i block statement(s) not terminated' % offset)
+        gen_tokens.append('\tif __out:\n\t\tyield "".join(__out)')
+        gen_tokens.append('\treturn\n\tyield')
         self.__code = compile('\n'.join(tokens), '<templite %r>' % template[:20], 'exec')
+        self.__gen_code = compile('\n'.join(gen_tokens),
+                                  '<templite %r>' % template[:20], 'exec')
 
     def render(self, __namespace=None, **kw):
         """
@@ -85,3 +104,34 @@ class Templite(object):
     def write(self, *args):
         for a in args:
             self.__output.append(str(a))
+
+    def render_to(self, fileobj, __namespace=None, **kw):
+        """
+        renders the template straight into fileobj, which need only have
+        a write method. Unlike render, this leaves sys.stdout alone and
+        keeps no state on the template, so any number of threads may use it
+        at once; templates must use emit rather than print.
+        """
+        write = fileobj.write
+        def emit(*args):
+            for a in args:
+                write(str(a))
+        namespace = {}
+        if __namespace: namespace.update(__namespace)
+        if kw: namespace.update(kw)
+        namespace['emit'] = emit
+        eval(self.__code, namespace)
+
+    def generate(self, __namespace=None, **kw):
+        """
+        renders the template a chunk at a time, as a generator of strings.
+        Like render_to, this is safe to use from several threads, and
+        templates must use emit rather than print.
+        """
+        out = []
+        namespace = {}
+        if __namespace: namespace.update(__namespace)
+        if kw: namespace.update(kw)
+        namespace['emit'] = lambda *args: out.extend(str(a) for a in args)
+        exec self.__gen_code in namespace
+        return namespace['__templite'](out)
@@ -0,0 +1,99 @@
+"""What drawing an axis tick costs in Cursors.
+
+    python -m crayon.tests.bench_cursor [ticks]
+
+Draws ticks the way HTicks does, onto a canvas that only records the points
+of each path, and reports per tick the time taken, the Cursors made, the
+bytes each Cursor takes and the exceptions raised along the way.
+
+"""
+
+from crayon.point import Cursor
+from crayon.spaces import Space2D, LinSpace, LogSpace, BoxSpace
+import sys
+import time
+
+class RecordingCanvas(object):
+    """A graphics context that keeps the absolute points of each path"""
+    def __init__(self, width=120, height=80):
+        paper = Space2D(LinSpace(0, width), LinSpace(0, height))
+        self._scopes = dict(box=BoxSpace(), paper=paper, absolute=paper)
+        self._default = paper
+        self.paths = []
+
+    def cursor(self):
+        return Cursor(self, self._scopes, self._default)
+
+    def push_path(self, markers, closed=False):
+        self.paths.append([m.pos_in('absolute') for m in markers])
+
+    def draw(self, color=None, width=None):
+        pass
+
+    def text(self, pos, label, **kwargs):
+        pos.pos_in('absolute')
+
+def draw_ticks(c, xs):
+    """One major tick, with its label, at each of xs"""
+    top = c.box(0, 1).plot.x
+    bottom = c.box(0, 0).plot.x
+    style = dict(color=None, width=0.2)
+    for x in xs:
+        top(x).to.paper.down(2).draw(**style)
+        b = bottom(x).to.paper.up(2).draw(**style)
+        b.down(3).text('$%g$' % x, anchor='north')
+
+def plot_cursor():
+    c = RecordingCanvas().cursor()
+    c = c.box(0.1, 0.1).to.box(0.9, 0.9).zoom()
+    return c.set_plot(Space2D(LogSpace(1, 1000), LinSpace(-1, 1)))
+
+def count_cursors(c, xs):
+    made = [0]
+    def new(cls, *a, **kw):
+        made[0] += 1
+        return object.__new__(cls)
+    Cursor.__new__ = staticmethod(new)
+    try:
+        draw_ticks(c, xs)
+    finally:
+        del Cursor.__new__
+    return made[0]
+
+def count_exceptions(c, xs):
+    """Exceptions raised, counting each once however far it unwinds"""
+    seen = []
+    def trace(frame, event, arg):
+        if event == 'exception' and not (seen and seen[-1] is arg[1]):
+            seen.append(arg[1])
+        return trace
+    sys.settrace(trace)
+    try:
+        draw_ticks(c, xs)
+    finally:
+        sys.settrace(None)
+    return len(seen)
+
+def cursor_size(c):
+    size = sys.getsizeof(c)
+    if hasattr(c, '__dict__'):
+        size += sys.getsizeof(c.__dict__)
+    return size
+
+def main(argv):
+    ticks = int(argv[1]) if len(argv) > 1 else 10000
+    c = plot_cursor()
+    xs = [1 + 999.0 * i / ticks for i in xrange(ticks)]
+
+    start = time.time()
+    draw_ticks(c, xs)
+    elapsed = time.time() - start
+
+    print 'time      %8.2f us per tick' % (1e6 * elapsed / ticks)
+    print 'cursors   %8.2f per tick' % (float(count_cursors(c, xs)) / ticks)
+    print 'bytes     %8d per cursor' % cursor_size(c)
+    print 'raised    %8.2f per tick' % (
+        float(count_exceptions(c, xs)) / ticks)
+
+if __name__ == '__main__':
+    main(sys.argv)
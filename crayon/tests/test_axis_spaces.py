@@ -0,0 +1,84 @@
+from crayon.spaces import (LinSpace, LogSpace, SymLogSpace, PowerSpace,
+                           ReversedSpace, DateTimeSpace, Space2D, LinSpace2D,
+                           converter, epoch_ns)
+import crayon.spaces as spaces
+import unittest
+import datetime
+
+class TestAxisSpaces(unittest.TestCase):
+    boxes = [0.0, 0.1, 0.5, 0.9, 1.0]
+
+    def check(self, space):
+        """from_box and to_box undo each other, the inverse swaps them, and
+        columns and compiled conversions agree with single points"""
+        values = [space.from_box(x) for x in self.boxes]
+        for x, v in zip(self.boxes, values):
+            self.assertAlmostEqual(space.to_box(v), x)
+            self.assertAlmostEqual(space.inverse.to_box(x), v)
+        for got, x in zip(space.to_box_array(values), self.boxes):
+            self.assertAlmostEqual(got, x)
+        for got, v in zip(space.from_box_array(self.boxes), values):
+            self.assertAlmostEqual(got, v)
+
+        s2, paper = Space2D(space, LinSpace(0, 1)), LinSpace2D(0, 0, 80, 60)
+        convert = converter(s2, paper)
+        for v in values:
+            self.assertEqual(convert((v, 0.5)),
+                             paper.from_box(s2.to_box((v, 0.5))))
+
+    def test_symlog(self):
+        space = SymLogSpace(-100, 1000, linthresh=2)
+        self.check(space)
+        # Zero and negative values have a place, and the sign is kept
+        self.assertTrue(0 < space.to_box(0) < space.to_box(1))
+        self.assertTrue(space.to_box(-100) == 0)
+
+    def test_power(self):
+        space = PowerSpace(0, 100, exponent=0.5)
+        self.check(space)
+        self.assertAlmostEqual(space.to_box(25), 0.5)
+        self.check(PowerSpace(-8, 8, exponent=3))
+
+    def test_reversed(self):
+        self.check(ReversedSpace(LogSpace(1, 100)))
+        space = ReversedSpace(LinSpace(0, 10))
+        self.check(space)
+        self.assertEqual((space.to_box(0), space.to_box(10)), (1.0, 0.0))
+        # Still linear, so it fuses with its neighbours
+        composed = LinSpace2D(0, 0, 2, 2).append(Space2D(space, None))
+        self.assertEqual(len(composed._spaces), 1)
+
+    def test_datetime(self):
+        a = datetime.datetime(2020, 1, 1)
+        space = DateTimeSpace(a, datetime.datetime(2020, 1, 3))
+        self.check(space)
+        self.assertAlmostEqual(space.to_box(datetime.datetime(2020, 1, 2)),
+                               0.5)
+        self.assertAlmostEqual(space.to_box(datetime.date(2020, 1, 2)), 0.5)
+        self.assertEqual(epoch_ns(a), 1577836800 * 10**9)
+        self.assertAlmostEqual(space.from_box(0.5), 1577836800 + 86400)
+        # Linear in seconds, so it fuses and compiles like a LinSpace
+        composed = LinSpace2D(0, 0, 2, 2).append(Space2D(space, None))
+        self.assertEqual(len(composed._spaces), 1)
+        convert = converter(Space2D(space, None), LinSpace2D(0, 0, 80, 60))
+        self.assertFalse('_c' in convert.source)
+        # 2D spaces take times as seconds
+        noon = 1577836800 + 86400 * 1.5
+        self.assertEqual(Space2D(space, None).to_box_array([(noon, 1)])[0][0],
+                         0.75)
+
+    @unittest.skipIf(spaces.numpy is None, 'needs numpy')
+    def test_datetime64(self):
+        import numpy
+        start = numpy.datetime64('2020-01-01T00:00:00', 'ns')
+        times = start + numpy.arange(5) * numpy.timedelta64(12, 'h')
+        space = DateTimeSpace(start, times[-1])
+        got = space.to_box_array(times)
+        self.assertEqual(list(got), [0.0, 0.25, 0.5, 0.75, 1.0])
+        # Nanoseconds are not lost to the size of the epoch time
+        space = DateTimeSpace(start, start + numpy.timedelta64(4, 'ns'))
+        self.assertEqual(space.to_box_array(
+            [start + numpy.timedelta64(1, 'ns')])[0], 0.25)
+
+if __name__ == '__main__':
+    unittest.main()
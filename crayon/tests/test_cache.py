@@ -0,0 +1,229 @@
+from crayon.cache import ExtentsStore, GlyphStore, PackStore, CacheManager, \
+     LockFile, hold_template, release_template
+import unittest
+import tempfile
+import threading
+import multiprocessing
+import shutil
+import time
+import os
+
+class TestExtentsStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='crayon-test-')
+        self.filename = os.path.join(self.dir, 'extents.sqlite')
+        self.store = ExtentsStore(self.filename)
+
+    def test_get_many(self):
+        items = [('%032x' % i, (i, 0.0, 0.0, 2.0, 1.5 * i, i))
+                 for i in xrange(1200)]
+        self.store.put_many(items)
+        found = self.store.get_many(h for h, _ in items[::3])
+        self.assertEqual(len(found), 400)
+        self.assertEqual(found['%032x' % 3], (3, 0.0, 0.0, 2.0, 4.5, 3))
+        self.assertEqual(self.store.get('missing'), None)
+
+    def test_shared(self):
+        other = ExtentsStore(self.filename)
+        self.store.put_many([('abc', (1, 2, 3, 4, 5, 6))])
+        self.assertEqual(other.get('abc'), (1, 2, 3, 4, 5, 6))
+        other.close()
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+class TestGlyphStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='crayon-test-')
+        self.store = GlyphStore(os.path.join(self.dir, 'glyphs.sqlite'))
+
+    def test_put(self):
+        one = (('M', 0.0, 0.0), ('L', 1.0, 0.0), ('Z',))
+        layout = [('glyph', 'cmr10:10.000000:49', 0.0, 6.5),
+                  ('glyph', 'cmr10:10.000000:49', 5.0, 6.5),
+                  ('rule', 0.0, 8.0, 10.0, 0.4)]
+        self.store.put([('abc', layout), ('bad', None)],
+                       {'cmr10:10.000000:49': one})
+        # Outlines are only ever stored once
+        self.store.put([], {'cmr10:10.000000:49': ()})
+
+        self.assertEqual(self.store.get_layouts(['abc', 'bad', 'missing']),
+                         {'abc': layout, 'bad': None})
+        self.assertEqual(self.store.get_glyphs(['cmr10:10.000000:49']),
+                         {'cmr10:10.000000:49': one})
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+class TestPackStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='crayon-test-')
+        self.filename = os.path.join(self.dir, 'svgs.pack')
+        self.store = PackStore(self.filename)
+        self.items = [('%032x' % i, '<svg>%s</svg>' % ('x' * i))
+                      for i in xrange(600)]
+        self.store.put_many(self.items)
+
+    def test_get_many(self):
+        found = self.store.get_many(h for h, _ in self.items[::3])
+        self.assertEqual(found, dict(self.items[::3]))
+        self.assertEqual(self.store.get('%032x' % 999), None)
+        # Long runs of one character compress well
+        self.assertTrue(os.path.getsize(self.filename) <
+                        sum(len(d) for _, d in self.items) / 4)
+
+    def test_remove(self):
+        other = PackStore(self.filename)
+        self.assertEqual(other.get('%032x' % 5), self.items[5][1])
+        size = os.path.getsize(self.filename)
+        self.store.remove(h for h, _ in self.items[:300])
+        self.assertEqual(len(self.store), 300)
+        self.assertTrue(os.path.getsize(self.filename) < size)
+        # The other store follows the rewritten pack
+        self.assertEqual(other.get_many(h for h, _ in self.items),
+                         dict(self.items[300:]))
+        other.put_many([('%032x' % 999, 'new')])
+        self.assertEqual(self.store.get('%032x' % 999), 'new')
+        other.close()
+
+    def test_same_process(self):
+        # Appends from one store are not lost to another rewriting the pack
+        other = PackStore(self.filename)
+        added = [('%032x' % (1000 + i), 'z' * i) for i in xrange(200)]
+        def append():
+            for item in added:
+                other.put_many([item])
+        thread = threading.Thread(target=append)
+        thread.start()
+        for i in xrange(0, 600, 30):
+            self.store.remove(h for h, _ in self.items[i:i + 30])
+        thread.join()
+        other.close()
+        self.assertEqual(self.store.get_many(h for h, _ in added),
+                         dict(added))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+def _try_lock(filename, slot, result):
+    """In another process, see whether slot is free"""
+    locks = LockFile(filename)
+    result.put(locks.lock(slot, blocking=False))
+    locks.close()
+
+class TestLockFile(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='crayon-test-')
+        self.filename = os.path.join(self.dir, 'lock')
+
+    def free(self, slot):
+        result = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=_try_lock,
+                                       args=(self.filename, slot, result))
+        proc.start()
+        proc.join()
+        return result.get()
+
+    def test_shared_slot(self):
+        # Two entries of one process on the same slot: the slot stays
+        # locked until both are done
+        locks = LockFile(self.filename)
+        slot = LockFile.entry('%08x' % 5)
+        self.assertEqual(slot, LockFile.entry('%08x' % (5 + (1 << 20))))
+        self.assertTrue(locks.lock(slot, blocking=False))
+        self.assertTrue(locks.lock(slot, blocking=False))
+        locks.unlock(slot)
+        self.assertFalse(self.free(slot))
+        locks.unlock(slot)
+        self.assertTrue(self.free(slot))
+        locks.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+class TestCacheManager(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='crayon-test-')
+        for name in ('current', 'stale'):
+            os.mkdir(os.path.join(self.dir, name))
+        # Ten entries of ten bytes each, used at times 1000..1009
+        for i in xrange(10):
+            filename = os.path.join(self.dir, 'current', '%d.svg' % i)
+            with open(filename, 'w') as f:
+                f.write('x' * 10)
+            os.utime(filename, (1000 + i, 1000 + i))
+        os.utime(os.path.join(self.dir, 'current'), (1000, 1000))
+        os.utime(os.path.join(self.dir, 'stale'), (10, 10))
+
+    def test_lru(self):
+        manager = CacheManager(self.dir, max_bytes=45, max_entries=8)
+        removed = manager.gc(now=2000)
+        self.assertEqual(removed['entries'], 6)
+        left = sorted(os.listdir(os.path.join(self.dir, 'current')))
+        self.assertEqual(left, ['6.svg', '7.svg', '8.svg', '9.svg'])
+
+    def test_pack(self):
+        pack = os.path.join(self.dir, 'current', 'svgs.pack')
+        store = PackStore(pack, compress=False)
+        store.put_many([('%032x' % i, 'y' * 10) for i in xrange(4)])
+        # The entries in the pack are the most recently used
+        manager = CacheManager(self.dir, max_entries=6)
+        self.assertEqual(manager.stats()['current']['entries'], 14)
+        removed = manager.gc(now=time.time())
+        self.assertEqual(removed['entries'], 8)
+        self.assertEqual(len(store), 4)
+        left = os.listdir(os.path.join(self.dir, 'current'))
+        self.assertEqual(sorted(f for f in left if f.endswith('.svg')),
+                         ['8.svg', '9.svg'])
+        store.close()
+
+    def test_held_pack(self):
+        # Counting entries creates nothing, and the pack of a template a
+        # runner in this process holds is not rewritten under it
+        current = os.path.join(self.dir, 'current')
+        manager = CacheManager(self.dir, max_entries=2)
+        self.assertEqual(manager.stats()['current']['entries'], 10)
+        self.assertFalse(os.path.exists(os.path.join(current, 'svgs.pack')))
+
+        store = PackStore(os.path.join(current, 'svgs.pack'))
+        store.put_many([('%032x' % i, 'y' * 10) for i in xrange(4)])
+        hold_template(current)
+        try:
+            removed = manager.gc(now=time.time())
+        finally:
+            release_template(current)
+        self.assertEqual(removed['entries'], 10)
+        self.assertEqual(len(store), 4)
+        store.close()
+
+    def test_stale(self):
+        manager = CacheManager(self.dir, max_age=500)
+        manager.gc(keep=('current',), now=2000)
+        self.assertEqual(sorted(manager.stats()), ['current'])
+        self.assertEqual(manager.stats()['current']['entries'], 10)
+
+    def test_held(self):
+        # A runner in this process using a directory keeps it, even though
+        # its lockf lock cannot be seen from here
+        stale = os.path.join(self.dir, 'stale')
+        locks = LockFile(os.path.join(stale, 'lock'))
+        locks.lock(LockFile.TEMPLATE, shared=True)
+        hold_template(stale)
+        for path in (os.path.join(stale, 'lock'), stale):
+            os.utime(path, (10, 10))
+        manager = CacheManager(self.dir, max_age=500)
+        keep = ('current',)
+        self.assertEqual(manager.gc(keep, now=2000)['directories'], 0)
+        release_template(stale)
+        locks.close()
+        self.assertEqual(manager.gc(keep, now=2000)['directories'], 1)
+        self.assertFalse(os.path.exists(stale))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+if __name__ == '__main__':
+    unittest.main()
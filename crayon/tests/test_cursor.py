@@ -0,0 +1,62 @@
+from crayon.point import Cursor, Mover, ChangeView
+from crayon.spaces import Space2D, LinSpace
+from crayon.tests.bench_cursor import RecordingCanvas, draw_ticks
+import math
+import unittest
+
+class TestCursor(unittest.TestCase):
+    def setUp(self):
+        self.canvas = RecordingCanvas(120, 80)
+        self.c = self.canvas.cursor()
+
+    def assertPos(self, got, want):
+        self.assertAlmostEqual(got[0], want[0])
+        self.assertAlmostEqual(got[1], want[1])
+
+    def test_compass(self):
+        c = self.c(10, 20)
+        self.assertEqual(c.up(5).pos, (10, 25))
+        self.assertEqual(c.N(5).pos, (10, 25))
+        self.assertEqual(c.left(4).pos, (6, 20))
+        self.assertEqual(c.down(1).right(2).pos, (12, 19))
+        r = math.sqrt(0.5)
+        self.assertPos(c.upRight(2).pos, (10 + 2 * r, 20 + 2 * r))
+        self.assertPos(c.SW(2).pos, c.leftDown(2).pos)
+        # Moves keep the cursor where it was
+        self.assertEqual(c.pos, (10, 20))
+
+    def test_spaces(self):
+        c = self.c.box(0.5, 0.25)
+        self.assertEqual(c.paper.pos, (60, 20))
+        self.assertEqual(c.pos_in('absolute'), (60, 20))
+        self.assertTrue(c.box is c)
+        self.assertRaises(Exception, getattr, c, 'plot')
+        # Spaces without a ChangeView are still found by name
+        spaces = dict(self.canvas._scopes, inches=Space2D(
+            LinSpace(0, 120 / 25.4), LinSpace(0, 80 / 25.4)))
+        c = c._set(spaces=spaces)
+        self.assertPos(c.inches.paper.pos, (60, 20))
+        self.assertRaises(Exception, getattr, c, 'nowhere')
+
+    def test_slots(self):
+        self.assertFalse(hasattr(self.c, '__dict__'))
+        self.assertTrue(isinstance(Cursor.__dict__['up'], Mover))
+        self.assertTrue(isinstance(Cursor.__dict__['paper'], ChangeView))
+        self.assertRaises(AttributeError, setattr, self.c, 'up', 1)
+        self.assertRaises(AttributeError, getattr, self.c, '_missing')
+
+    def test_paths(self):
+        c = self.c.box(0.1, 0.1).to.box(0.9, 0.9).zoom()
+        c = c.set_plot(Space2D(LinSpace(0, 10), LinSpace(-1, 1)))
+        draw_ticks(c, [0, 5])
+        self.assertEqual(len(self.canvas.paths), 4)
+        top, bottom = self.canvas.paths[2:]
+        self.assertPos(top[0], (60, 72))
+        self.assertPos(top[1], (60, 70))
+        self.assertPos(bottom[0], (60, 8))
+        # Drawing leaves the cursor without a path
+        self.assertEqual(c.to.up(1).draw()._path, ())
+        self.assertTrue(c.draw() is c)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+import crayon.dvi as dvi
+from crayon.fonts import Tfm
+from crayon.latex import DviParser
+import unittest
+import tempfile
+import shutil
+import struct
+import os
+
+def font_def(k, name, scale=10 << 16):
+    return struct.pack('>BBIiiBB', dvi.FNT_DEF1, k, 0x1234, scale, 10 << 16,
+                       0, len(name)) + name
+
+def make_dvi(filename, pages, fonts):
+    """Write a small DVI file. pages is a list of page bodies, fonts a dict
+    mapping font numbers to names."""
+    out = [struct.pack('>BBIIIB', dvi.PRE, 2, 25400000, 473628672, 1000, 4),
+           'test']
+    length = lambda: sum(len(i) for i in out)
+    previous = -1
+    for n, body in enumerate(pages, 1):
+        bop = length()
+        out.append(struct.pack('>B10ii', dvi.BOP, n, *([0] * 9 + [previous])))
+        out.append(body + chr(dvi.EOP))
+        previous = bop
+    post = length()
+    out.append(struct.pack('>BiIIIIIHH', dvi.POST, previous, 25400000,
+                           473628672, 1000, 100, 200, 3, len(pages)))
+    out.extend(font_def(k, name) for k, name in sorted(fonts.items()))
+    out.append(struct.pack('>BIB', dvi.POST_POST, post, 2))
+    out.append(chr(223) * (4 + (-length() - 4) % 4))
+    with open(filename, 'wb') as f:
+        f.write(''.join(out))
+
+def make_tfm(filename, chars, design=10.0, params=()):
+    """Write a TFM file holding chars, a dict mapping codes to (width,
+    height, depth) in design size units, and the given font parameters."""
+    bc, ec = min(chars), max(chars)
+    fix = lambda x: int(round(x * (1 << 20)))
+    tables = [sorted(set([0] + [c[i] for c in chars.values()]))
+              for i in xrange(3)]
+    info = []
+    for code in xrange(bc, ec + 1):
+        if code in chars:
+            w, h, d = (tables[i].index(chars[code][i]) for i in xrange(3))
+            info.append(struct.pack('>4B', w, (h << 4) | d, 0, 0))
+        else:
+            info.append(struct.pack('>4B', 0, 0, 0, 0))
+    body = [struct.pack('>Ii', 0xabcd, fix(design))] + info
+    for table in tables + [[0], params]:
+        body.append(struct.pack('>%di' % len(table), *map(fix, table)))
+    lengths = [len(t) for t in tables]
+    lf = 6 + 2 + len(info) + sum(lengths) + 1 + len(params)
+    with open(filename, 'wb') as f:
+        f.write(struct.pack('>12H', lf, 2, bc, ec, lengths[0], lengths[1],
+                            lengths[2], 1, 0, 0, 0, len(params)) +
+                ''.join(body))
+
+class TestDviParser(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='crayon-test-')
+        self.tfm = os.path.join(self.dir, 'fake.tfm')
+        make_tfm(self.tfm, {65: (0.5, 0.75, 0.0), 103: (0.5, 0.5, 0.25)})
+
+    def test_tfm(self):
+        tfm = Tfm(self.tfm)
+        self.assertEqual(tfm.design_size, 10.0)
+        self.assertEqual(tfm.metrics(103, 4.0), (2.0, 2.0, 1.0, 0.0))
+        self.assertEqual(tfm.metrics(66), None)
+
+    def test_extents(self):
+        filename = os.path.join(self.dir, 'page.dvi')
+        ten_pt = 10 << 16
+        # 'Ag' at (0, 100pt), then a 3pt x 2pt rule 10pt further down
+        body = (font_def(0, 'fake') + chr(dvi.FNT_NUM_0) +
+                struct.pack('>Bi', dvi.DOWN1 + 3, 100 << 16) + 'Ag' +
+                struct.pack('>BiBii', dvi.DOWN1 + 3, ten_pt,
+                            dvi.SET_RULE, 2 << 16, 3 << 16))
+        make_dvi(filename, [body, ''], {0: 'fake'})
+
+        parser = DviParser(fonts={'fake': Tfm(self.tfm)})
+        (first, empty) = parser.parse(filename)
+        y0, ymin, xmin, ymax, xmax, yn = first
+        self.assertAlmostEqual(y0, 100, 4)
+        self.assertAlmostEqual(ymin, 92.5, 4)
+        self.assertAlmostEqual(xmin, 0, 4)
+        self.assertAlmostEqual(ymax, 110, 4)
+        self.assertAlmostEqual(xmax, 13, 4)
+        self.assertAlmostEqual(yn, 110, 4)
+        self.assertEqual(empty, (0.0,) * 6)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+class TestConcatenate(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='crayon-test-')
+        self.a = os.path.join(self.dir, 'a.dvi')
+        self.b = os.path.join(self.dir, 'b.dvi')
+        rule = struct.pack('>Bii', dvi.SET_RULE, 5, 7)
+        # cmr10 is font 3 in a and font 9 in b
+        make_dvi(self.a, [font_def(3, 'cmr10') + chr(dvi.FNT_NUM_0 + 3) + 'A',
+                          rule,
+                          chr(dvi.FNT_NUM_0 + 3) + 'B'], {3: 'cmr10'})
+        make_dvi(self.b, [font_def(9, 'cmmi10') + chr(dvi.FNT_NUM_0 + 9) +
+                          'C' + font_def(1, 'cmr10') + chr(dvi.FNT_NUM_0 + 1)
+                          + 'D'], {9: 'cmmi10', 1: 'cmr10'})
+
+    def test_concatenate(self):
+        out = os.path.join(self.dir, 'out.dvi')
+        with dvi.DviFile(self.a) as a:
+            with dvi.DviFile(self.b) as b:
+                self.assertEqual(len(a.pages), 3)
+                dvi.concatenate([(a, 3), (b, 1), (a, 2)], out)
+
+        with dvi.DviFile(out) as f:
+            self.assertEqual(len(f.pages), 3)
+            self.assertEqual(sorted(i.name for i in f.fonts.values()),
+                             ['cmmi10', 'cmr10'])
+            pages = []
+            for n in xrange(1, 4):
+                font, text = None, []
+                for op, args, _, _ in f.page(n):
+                    if dvi.FNT_NUM_0 <= op < dvi.FNT1:
+                        font = f.fonts[op - dvi.FNT_NUM_0].name
+                    elif op < dvi.SET1:
+                        text.append((font, chr(op)))
+                    elif op == dvi.SET_RULE:
+                        text.append(tuple(args))
+                pages.append(text)
+
+        self.assertEqual(pages, [[('cmr10', 'B')],
+                                 [('cmmi10', 'C'), ('cmr10', 'D')],
+                                 [(5, 7)]])
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import crayon.dvi as dvi
+from crayon.glyphs import GlyphRenderer
+from crayon.tests.test_dvi import font_def, make_dvi, make_tfm
+import unittest
+import tempfile
+import shutil
+import struct
+import os
+
+def encrypt(data, r, prefix='\0\0\0\0'):
+    out = []
+    for ch in prefix + data:
+        c = ord(ch) ^ (r >> 8)
+        r = ((c + r) * 52845 + 22719) & 0xffff
+        out.append(chr(c))
+    return ''.join(out)
+
+def charstring(*items):
+    """Encode a charstring from small numbers and (operator,) tuples"""
+    out = []
+    for item in items:
+        if isinstance(item, tuple):
+            out.append(''.join(chr(i) for i in item))
+        else:
+            assert -107 <= item <= 107
+            out.append(chr(item + 139))
+    return ''.join(out)
+
+HSBW, RMOVETO, RLINETO, CLOSEPATH, ENDCHAR = (13,), (21,), (5,), (9,), (14,)
+
+def make_pfa(filename, glyphs):
+    """Write a Type 1 font in PFA form with the given charstrings, encoding
+    each glyph name at the code of its first letter"""
+    private = ['/Private 8 dict dup begin /lenIV 4 def\n',
+               '/CharStrings %d dict dup begin\n' % len(glyphs)]
+    for name, code in sorted(glyphs.items()):
+        code = encrypt(code, 4330)
+        private.append('/%s %d RD %s ND\n' % (name, len(code), code))
+    private.append('end end\nmark currentfile closefile\n')
+    clear = ['%!PS-AdobeFont-1.0: Fake\n',
+             '/FontMatrix [0.001 0 0 0.001 0 0] readonly def\n',
+             '/Encoding 256 array\n']
+    clear.extend('dup %d /%s put\n' % (ord(name[0]), name) for name in glyphs)
+    clear.append('readonly def\ncurrentfile eexec\n')
+    body = encrypt(''.join(private), 55665).encode('hex')
+    with open(filename, 'w') as f:
+        f.write(''.join(clear) + body + '\n' + '0' * 512 +
+                '\ncleartomark\n')
+
+class TestGlyphRenderer(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='crayon-test-')
+        make_tfm(os.path.join(self.dir, 'fake.tfm'), {65: (0.5, 0.7, 0.0)})
+        # A 50 unit square standing 20 units above the baseline
+        make_pfa(os.path.join(self.dir, 'fake.pfa'), {'A': charstring(
+            0, 100, HSBW, 10, 20, RMOVETO, 50, 0, RLINETO, 0, 50, RLINETO,
+            -50, 0, RLINETO, CLOSEPATH, ENDCHAR)})
+        with open(os.path.join(self.dir, 'test.map'), 'w') as f:
+            f.write('% comment\nfake Fake " .2 SlantFont " <fake.pfa\n')
+
+    def find(self, name):
+        path = os.path.join(self.dir, name)
+        if not os.path.exists(path):
+            raise IOError(name)
+        return path
+
+    def test_page(self):
+        filename = os.path.join(self.dir, 'page.dvi')
+        body = (font_def(0, 'fake') + chr(dvi.FNT_NUM_0) +
+                struct.pack('>Bi', dvi.DOWN1 + 3, 100 << 16) + 'AA' +
+                struct.pack('>Bii', dvi.SET_RULE, 2 << 16, 3 << 16))
+        make_dvi(filename, [body], {0: 'fake'})
+
+        renderer = GlyphRenderer(find=self.find, fontmap='test.map')
+        with dvi.DviFile(filename) as f:
+            path = renderer.page(f, 1)
+
+        # Each A is 5pt wide at 10pt, and slanted by 0.2
+        def point(x, y):
+            return (x + 0.2 * y, 100 - y)
+        square = lambda x: [('M',) + point(x + 0.1, 0.2),
+                            ('L',) + point(x + 0.6, 0.2),
+                            ('L',) + point(x + 0.6, 0.7),
+                            ('L',) + point(x + 0.1, 0.7), ('Z',)]
+        rule = [('M', 10, 100), ('L', 13, 100), ('L', 13, 98),
+                ('L', 10, 98), ('Z',)]
+        expected = square(0) + square(5) + rule
+
+        self.assertEqual([op[0] for op in path], [op[0] for op in expected])
+        for got, want in zip(path, expected):
+            for a, b in zip(got[1:], want[1:]):
+                self.assertAlmostEqual(a, b, 4)
+
+    def test_layout(self):
+        filename = os.path.join(self.dir, 'page.dvi')
+        make_dvi(filename, [font_def(0, 'fake') + chr(dvi.FNT_NUM_0) + 'AAA'],
+                 {0: 'fake'})
+        renderer = GlyphRenderer(find=self.find, fontmap='test.map')
+        with dvi.DviFile(filename) as f:
+            layout = renderer.layout(f, 1)
+
+        # Three placements of a single outline
+        self.assertEqual(len(layout), 3)
+        self.assertEqual(len(set(item[1] for item in layout)), 1)
+        self.assertEqual(renderer.glyphs.keys(), [layout[0][1]])
+        self.assertEqual([round(item[2], 4) for item in layout],
+                         [0, 5, 10])
+
+    def test_unmapped(self):
+        filename = os.path.join(self.dir, 'page.dvi')
+        make_dvi(filename, [font_def(0, 'other') + chr(dvi.FNT_NUM_0) + 'A'],
+                 {0: 'other'})
+        renderer = GlyphRenderer(find=self.find, fontmap='test.map')
+        with dvi.DviFile(filename) as f:
+            self.assertRaises((IOError, KeyError), renderer.page, f, 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,7 +2,15 @@ import crayon.latex as latex
 import contextlib
 import unittest
 import shutil
+import tempfile
+import subprocess
+from distutils.spawn import find_executable
 import os
+import threading
+import time
+import multiprocessing
+from crayon.cache import CacheManager
+from crayon.tests.test_dvi import make_dvi
 
 class TestTexRunner(unittest.TestCase):
     def setUp(self):
@@ -15,7 +23,7 @@ class TestTexRunner(unittest.TestCase):
         # print texes
         texes = tex.to_svg(texes)
         for t in texes:
-            print t.svgfile
+            print t.svgdata
 
         tex.close()
 
@@ -24,5 +32,318 @@ class TestTexRunner(unittest.TestCase):
         #shutil.rmtree(os.path.expanduser('~/.cache/crayon'))
         pass
 
+@unittest.skipUnless(find_executable('latex') and find_executable('dvipos'),
+                     'needs latex and dvipos')
+class TestDviParser(unittest.TestCase):
+    corpus = [r'$10^{%d}$' % i for i in xrange(-3, 4)] + \
+             [r'$%g$' % (0.5 * i) for i in xrange(-4, 5)] + \
+             [r'Energy [GeV]', r'$\sqrt{s} = 7$ TeV', r'$p_T$',
+              r'\parbox{40mm}{A title that is long enough to wrap}']
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='crayon-test-')
+        with open('templates/preamble.tex') as f:
+            preamble = f.read()
+        with open('templates/body.tpl') as f:
+            body = latex.templite.Templite(f.read())
+        with open(os.path.join(self.dir, 'corpus.tex'), 'w') as f:
+            f.write(preamble + body.render(texes=self.corpus))
+        for cmd in (('latex', '-interaction=nonstopmode', 'corpus.tex'),
+                    ('dvipos', '-b', 'corpus.dvi')):
+            subprocess.call(cmd, cwd=self.dir, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+
+    def test_against_dvipos(self):
+        ours = latex.DviParser().parse(os.path.join(self.dir, 'corpus.dvi'))
+        theirs = latex.PosParser().parse(os.path.join(self.dir, 'corpus.pos'))
+        self.assertEqual(len(ours), len(self.corpus))
+        self.assertEqual(len(ours), len(theirs))
+        for text, a, b in zip(self.corpus, ours, theirs):
+            for x, y in zip(a, b):
+                self.assertAlmostEqual(x, y, 2, '%s: %r != %r' % (text, a, b))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+class TestCoalesce(unittest.TestCase):
+    """Repeated and concurrent requests for a string compile it once"""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='crayon-test-')
+        self.runner = latex.TexRunner(cache=CacheManager(self.dir))
+        self.compiled = []
+        self.runner._check_preamble = lambda: None
+        self.runner._render_batch = self.fake_batch
+
+    def fake_batch(self, texes):
+        self.compiled.extend(t.text for t in texes)
+        time.sleep(0.1)
+        for n, tex in enumerate(texes, 1):
+            tex.extents = (n, 0, 0, n, 1, n)
+
+    def test_duplicates(self):
+        texes = self.runner.render(['$1$', '$2$', '$1$', '$1$'])
+        self.assertEqual(self.compiled, ['$1$', '$2$'])
+        self.assertTrue(texes[0] is texes[2] is texes[3])
+
+    def test_concurrent(self):
+        threads = [threading.Thread(target=self.runner.render,
+                                    args=(['$1$', '$%d$' % i],))
+                   for i in xrange(2, 6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(sorted(self.compiled),
+                         ['$1$', '$2$', '$3$', '$4$', '$5$'])
+
+    def tearDown(self):
+        self.runner.close()
+        shutil.rmtree(self.dir)
+
+def _shared_render(cachedir, log, strings):
+    """Render strings in shared mode with a fake latex that notes what it
+    compiles in log"""
+    runner = latex.TexRunner(cache=CacheManager(cachedir), shared=True)
+    runner._check_preamble = lambda: None
+
+    def fake_batch(texes):
+        with open(log, 'a') as f:
+            f.write(''.join(t.text + '\n' for t in texes))
+        time.sleep(0.2)
+        for tex in texes:
+            tex.extents = (1, 0, 0, 1, 1, 1)
+        runner._db.put_many((t.hash, t.extents) for t in texes)
+    runner._render_batch = fake_batch
+
+    try:
+        runner.render(strings)
+    finally:
+        runner.close()
+
+class TestShared(unittest.TestCase):
+    """Processes sharing a cache compile each string once between them"""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='crayon-test-')
+        self.log = os.path.join(self.dir, 'compiled.log')
+
+    def test_processes(self):
+        strings = ['$%d$' % i for i in xrange(20)]
+        procs = [multiprocessing.Process(target=_shared_render,
+                                         args=(self.dir, self.log,
+                                               strings[i:] + strings[:i]))
+                 for i in (0, 7, 13)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+            self.assertEqual(p.exitcode, 0)
+
+        with open(self.log) as f:
+            compiled = f.read().split()
+        self.assertEqual(sorted(compiled), sorted(strings))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+class TestSvgPack(unittest.TestCase):
+    """SVGs come from the pack, and files left by older versions are moved
+    into it"""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='crayon-test-')
+
+    def test_import(self):
+        runner = latex.TexRunner(cache=CacheManager(self.dir))
+        cachedir = runner._cachedir
+        runner.close()
+        tex = latex.Tex('$1$')
+        with open(os.path.join(cachedir, tex.hash + '.svg'), 'w') as f:
+            f.write('<svg>1</svg>')
+
+        runner = latex.TexRunner(cache=CacheManager(self.dir))
+        runner._convert = None
+        try:
+            tex.extents = (0, 0, 0, 1, 1, 1)
+            runner.to_svg([tex])
+        finally:
+            runner.close()
+        self.assertEqual(tex.svgdata, '<svg>1</svg>')
+        self.assertFalse(os.path.exists(os.path.join(cachedir,
+                                                     tex.hash + '.svg')))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+class TestTexCache(unittest.TestCase):
+    def test_entries(self):
+        cache = latex.TexCache(max_entries=3, weak=False)
+        first = cache.get('a')
+        for s in 'bcd':
+            cache.get(s)
+        self.assertEqual(len(cache), 3)
+        # 'a' was least recently used, so it was dropped and made afresh
+        self.assertFalse(cache.get('a') is first)
+        # ...which pushed out 'b', but using 'c' kept it
+        cache.get('c')
+        cache.get('e')
+        self.assertEqual(list(cache._entries), ['a', 'c', 'e'])
+
+    def test_bytes(self):
+        cache = latex.TexCache(max_bytes=5000, weak=False)
+        texes = [cache.get(s) for s in 'abcd']
+        self.assertEqual(len(cache), 4)
+        texes[1].svg_bytes = 2500
+        cache.update([texes[1]])
+        self.assertTrue(cache.bytes <= 5000)
+        self.assertEqual(list(cache._entries), ['d', 'b'])
+
+    def test_weak(self):
+        cache = latex.TexCache(max_entries=1)
+        kept = cache.get('a')
+        cache.get('b')
+        cache.get('c')
+        self.assertEqual(len(cache), 1)
+        # Still referenced here, so the same object comes back
+        self.assertTrue(cache.get('a') is kept)
+
+class FailingGlyphs(object):
+    """A GlyphRenderer whose layout raises the error given for each page"""
+    glyphs = {}
+
+    def __init__(self, errors):
+        self._errors = errors
+
+    def layout(self, f, page):
+        raise self._errors[page]('page %d' % page)
+
+class TestGlyphLayouts(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='crayon-test-')
+        self.runner = latex.TexRunner(cache=CacheManager(self.dir))
+        self.runner._check_preamble = lambda: None
+
+    def test_unread_fonts(self):
+        # Only definite answers are remembered as having no outlines
+        make_dvi(self.runner._temp('glyphs.dvi'), ['', '', ''], {})
+        self.runner._glyphs = FailingGlyphs({1: KeyError, 2: ValueError,
+                                             3: IOError})
+        texes = [latex.Tex(s, 'glyphs.dvi', n, (0,) * 6)
+                 for n, s in enumerate(['A', 'B', 'C'], 1)]
+        self.runner.to_glyphs(texes)
+        self.assertEqual([t.glyphs for t in texes], [False] * 3)
+        stored = self.runner._glyphdb.get_layouts([t.hash for t in texes])
+        self.assertEqual(stored, {texes[0].hash: None, texes[1].hash: None})
+
+    def tearDown(self):
+        self.runner.close()
+        shutil.rmtree(self.dir)
+
+class TestLogParser(unittest.TestCase):
+    log = '\n'.join([
+        'This is pdfTeX, Version 3.1415926',
+        '! LaTeX Error: Missing \\begin{document}.',
+        'crayon-label:0',
+        'crayon-label:1',
+        '! Missing $ inserted.',
+        '<inserted text> ',
+        '! Extra }, or forgotten $.',
+        'crayon-label:2',
+        '[1] [2] [3] ',
+        ''])
+
+    def test_parse(self):
+        filename = tempfile.mktemp(suffix='.log')
+        with open(filename, 'w') as f:
+            f.write(self.log)
+        errors = latex.LogParser().parse(filename)
+        os.remove(filename)
+        self.assertEqual(errors, {
+            None: ['LaTeX Error: Missing \\begin{document}.'],
+            1: ['Missing $ inserted.', 'Extra }, or forgotten $.']})
+
+class DeadWorker(object):
+    """A TexWorker whose latex has exited"""
+    killed = False
+
+    def measure(self, texts):
+        raise IOError(32, 'Broken pipe')
+
+    def kill(self):
+        self.killed = True
+
+    def close(self):
+        pass
+
+class TestTexWorker(unittest.TestCase):
+    def test_accepts(self):
+        accepts = latex.TexWorker.accepts
+        self.assertTrue(accepts(r'$10^{3}$'))
+        self.assertTrue(accepts(r'\{x\}'))
+        self.assertFalse(accepts(r'$10^{3$'))
+        self.assertFalse(accepts(r'}{'))
+        self.assertFalse(accepts('two\nlines'))
+        self.assertTrue(accepts(r'50\%'))
+        self.assertTrue(accepts(r'\parbox{2cm}{x}'))
+        self.assertFalse(accepts('50%'))
+        self.assertFalse(accepts(r'a\par b'))
+        for word in ('stop', 'end', 'endinput', 'input', 'batchmode',
+                     'scrollmode'):
+            self.assertFalse(accepts('x\\%s y' % word))
+        self.assertTrue(accepts(r'\endash'))
+
+    def test_dead_worker(self):
+        # A worker whose latex has exited is dropped, and the batch run
+        # takes its strings
+        dir = tempfile.mkdtemp(prefix='crayon-test-')
+        runner = latex.TexRunner(worker=True, cache=CacheManager(dir))
+        runner._check_preamble = lambda: None
+        batches = []
+        def fake_batch(texes):
+            batches.append([t.text for t in texes])
+            for tex in texes:
+                tex.extents = (1, 0, 0, 1, 1, 1)
+        runner._render_batch = fake_batch
+        worker = runner._worker = DeadWorker()
+        try:
+            texes = runner.render(['a', 'b'])
+            self.assertEqual(batches, [['a', 'b']])
+            self.assertEqual([t.extents for t in texes],
+                             [(1, 0, 0, 1, 1, 1)] * 2)
+            self.assertTrue(worker.killed)
+            self.assertTrue(runner._worker is None)
+        finally:
+            runner.close()
+            shutil.rmtree(dir)
+
+    @unittest.skipUnless(find_executable('latex'), 'needs latex')
+    def test_after_stop(self):
+        # A label that would stop latex does not take the worker down
+        dir = tempfile.mkdtemp(prefix='crayon-test-')
+        runner = latex.TexRunner(worker=True, cache=CacheManager(dir))
+        try:
+            runner.render([r'a\stop b'])
+            texes = runner.render(['after'])
+            self.assertTrue(texes[0].extents is not None)
+        finally:
+            runner.close()
+            shutil.rmtree(dir)
+
+    @unittest.skipUnless(find_executable('latex'), 'needs latex')
+    def test_comments(self):
+        # A % must not comment out the end of the worker's command
+        strings = [r'50\%', '50%', r'a{b}c']
+        dirs = [tempfile.mkdtemp(prefix='crayon-test-') for i in xrange(2)]
+        worker = latex.TexRunner(worker=True, cache=CacheManager(dirs[0]))
+        batch = latex.TexRunner(cache=CacheManager(dirs[1]))
+        try:
+            measured = worker.measure(strings)
+            rendered = batch.render(strings)
+            self.assertEqual([t.extents for t in measured],
+                             [t.extents for t in rendered])
+        finally:
+            worker.close()
+            batch.close()
+            for d in dirs:
+                shutil.rmtree(d)
+
 if __name__ == '__main__':
     unittest.main()
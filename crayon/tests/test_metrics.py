@@ -0,0 +1,141 @@
+from crayon.metrics import NumberMetrics
+from crayon.fonts import Tfm
+from crayon.tests.test_dvi import make_tfm, make_dvi
+import crayon.latex as latex
+from crayon.cache import CacheManager
+from distutils.spawn import find_executable
+import unittest
+import tempfile
+import shutil
+import os
+
+class TestNumberMetrics(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='crayon-test-')
+        digits = dict((48 + i, (0.5, 0.7, 0.0)) for i in xrange(10))
+        digits[46] = (0.25, 0.1, 0.0)
+        make_tfm(os.path.join(self.dir, 'num.tfm'), digits)
+        # Symbol font parameters: x-height 0.4, sup2 0.35
+        params = [0.0] * 22
+        params[4], params[13] = 0.4, 0.35
+        make_tfm(os.path.join(self.dir, 'sym.tfm'), {0: (0.75, 0.25, 0.1)},
+                 params=params)
+        fonts = dict((name, Tfm(os.path.join(self.dir, name + '.tfm')))
+                     for name in ('num', 'sym'))
+
+        def table(size):
+            t = dict((str(i), ('num', size, 48 + i)) for i in xrange(10))
+            t['.'] = ('num', size, 46)
+            t['-'] = ('sym', size, 0)
+            return t
+        self.metrics = NumberMetrics(table(10.0), table(7.0), (0.0, 0.0),
+                                     fonts)
+
+    def test_grammar(self):
+        for text in ('$0.5$', '$-150$', '$10^{3}$', '$10^{-12}$', '$10^3$'):
+            self.assertTrue(self.metrics.accepts(text), text)
+        for text in ('$1e+06$', '0.5', '$10^{x}$', '$x$', '$1.$', '$-$'):
+            self.assertFalse(self.metrics.accepts(text), text)
+            self.assertEqual(self.metrics.extents(text), None)
+
+    def test_number(self):
+        y0, ymin, xmin, ymax, xmax, yn = self.metrics.extents('$-1.5$')
+        self.assertEqual((ymin, xmin), (0.0, 0.0))
+        self.assertAlmostEqual(xmax, 7.5 + 5 + 2.5 + 5, 4)
+        self.assertAlmostEqual(y0, 7.0, 4)
+        self.assertAlmostEqual(ymax, 8.0, 4)
+        self.assertAlmostEqual(yn, 7.0, 4)
+
+    def test_superscript(self):
+        y0, ymin, xmin, ymax, xmax, yn = self.metrics.extents('$10^{-3}$')
+        # The superscript rises by sup2, as it has hardly any depth, and
+        # its top is the top of the box
+        u = 3.5
+        self.assertAlmostEqual(xmax, 10 + 5.25 + 3.5, 4)
+        self.assertAlmostEqual(ymin, 0.0, 4)
+        self.assertAlmostEqual(y0, u + 4.9, 4)
+        self.assertAlmostEqual(yn, 4.9, 4)
+        self.assertAlmostEqual(ymax, u + 4.9, 4)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+class FakeMetrics(object):
+    """NumberMetrics that size every label as 1pt square, calibrated from
+    whatever pages it is given"""
+    calibration = NumberMetrics.calibration
+
+    @classmethod
+    def from_dvi(cls, f, pages, tfms):
+        return cls()
+
+    def to_dict(self):
+        return {}
+
+    def extents(self, text):
+        return (1.0, 0.0, 0.0, 1.0, 1.0, 1.0)
+
+class TestMetricsCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = tempfile.mkdtemp(prefix='crayon-test-')
+        self.runner = latex.TexRunner(cache=CacheManager(self.cache))
+        self.runner._check_preamble = lambda: None
+
+    def test_unwritable(self):
+        # Calibrated metrics are used even if they cannot be saved
+        make_dvi(self.runner._temp('calibration.dvi'), ['', ''], {})
+        def fake_batch(texes):
+            for n, tex in enumerate(texes, 1):
+                tex.dvifile, tex.dvipage = 'calibration.dvi', n
+        self.runner._render_batch = fake_batch
+        self.runner._cache = lambda name: os.path.join(self.cache, 'gone',
+                                                       name)
+        real, latex.NumberMetrics = latex.NumberMetrics, FakeMetrics
+        try:
+            texes = self.runner.measure(['$1$'])
+        finally:
+            latex.NumberMetrics = real
+        self.assertEqual(texes[0].extents, (1.0, 0.0, 0.0, 1.0, 1.0, 1.0))
+        self.assertTrue(isinstance(self.runner._metrics, FakeMetrics))
+
+    def test_known_extents(self):
+        # Extents latex gave before win over the metrics
+        exact = (2.0, 0.0, 0.0, 3.0, 4.0, 2.0)
+        self.runner._db.put_many([(latex.Tex('$1$').hash, exact)])
+        self.runner._metrics = FakeMetrics()
+        texes = self.runner.measure(['$1$', '$2$'])
+        self.assertEqual([t.extents for t in texes],
+                         [exact, (1.0, 0.0, 0.0, 1.0, 1.0, 1.0)])
+
+    def tearDown(self):
+        self.runner.close()
+        shutil.rmtree(self.cache)
+
+class TestMeasure(unittest.TestCase):
+    """Metrics against latex itself"""
+    tolerance = 0.05
+
+    def setUp(self):
+        if not (find_executable('latex') and find_executable('kpsewhich')):
+            self.skipTest('latex is not installed')
+        self.cache = tempfile.mkdtemp(prefix='crayon-test-')
+        self.runner = latex.TexRunner(cache=CacheManager(self.cache))
+
+    def test_against_latex(self):
+        strings = ['$%g$' % x for x in (0, 0.5, -1, 25, -2.5, 1000, 0.125)]
+        strings += ['$10^{%d}$' % i for i in (-3, -1, 0, 2, 10)]
+        measured = [t.extents for t in self.runner.measure(strings)]
+        rendered = [t.extents for t in self.runner.render(strings,
+                                                          force=True)]
+        for text, a, b in zip(strings, measured, rendered):
+            for x, y in zip(a, b):
+                self.assertTrue(abs(x - y) < self.tolerance,
+                                '%s: %r != %r' % (text, a, b))
+
+    def tearDown(self):
+        if hasattr(self, 'runner'):
+            self.runner.close()
+            shutil.rmtree(self.cache)
+
+if __name__ == '__main__':
+    unittest.main()
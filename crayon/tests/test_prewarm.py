@@ -0,0 +1,61 @@
+from crayon.prewarm import lin_labels, log_labels, read_source, prewarm
+import unittest
+import tempfile
+import os
+
+class Runner(object):
+    """Records what prewarm asks of a TexRunner"""
+    class Tex(object):
+        def __init__(self, text):
+            self.text = text
+            self.error = 'bad' if 'bad' in text else None
+
+    def __init__(self):
+        self.rendered = []
+        self.converted = []
+
+    def render(self, strings, force=False):
+        self.rendered.append(list(strings))
+        return [self.Tex(s) for s in strings]
+
+    def to_svg(self, texes, force=False):
+        self.converted.append([t.text for t in texes])
+        return texes
+
+class TestPrewarm(unittest.TestCase):
+    def test_specs(self):
+        self.assertEqual(read_source('lin:-1:1:0.5'),
+                         ['$-1$', '$-0.5$', '$0$', '$0.5$', '$1$'])
+        self.assertEqual(read_source('log:-1:1'),
+                         ['$10^{-1}$', '$10^{0}$', '$10^{1}$'])
+        self.assertEqual(len(lin_labels(-1000, 1000, 1)), 2001)
+        # Reversed ranges are ticked as plots tick them
+        self.assertEqual(log_labels(3, 2), ['$10^{2}$', '$10^{3}$'])
+        for spec in ('lin:0:1', 'lin:0:1:0', 'log:a:b'):
+            self.assertRaises(ValueError, read_source, spec)
+
+    def test_file(self):
+        fd, filename = tempfile.mkstemp(suffix='.txt')
+        with os.fdopen(fd, 'w') as f:
+            f.write('Energy [GeV]\n\n$p_T$ [GeV]\n')
+        try:
+            self.assertEqual(read_source(filename),
+                             ['Energy [GeV]', '$p_T$ [GeV]'])
+        finally:
+            os.remove(filename)
+
+    def test_batches(self):
+        runner = Runner()
+        labels = ['$%d$' % i for i in xrange(5)] + ['$1$', 'bad']
+        result = prewarm(runner, labels, batch=4)
+        self.assertEqual(result, dict(labels=6, failed=1))
+        self.assertEqual(runner.rendered, [['$0$', '$1$', '$2$', '$3$'],
+                                           ['$4$', 'bad']])
+        self.assertEqual(runner.converted, runner.rendered)
+
+        runner = Runner()
+        prewarm(runner, labels, svg=False)
+        self.assertEqual(runner.converted, [])
+
+if __name__ == '__main__':
+    unittest.main()
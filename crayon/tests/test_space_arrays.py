@@ -0,0 +1,49 @@
+from crayon.spaces import Space, LinSpace, LogSpace, Space2D, LinSpace2D
+import crayon.spaces as spaces
+import unittest
+
+class TestArrays(unittest.TestCase):
+    """Whole columns convert as the points would one at a time"""
+    def setUp(self):
+        self.space = Space2D(LinSpace(2, 10), LogSpace(10, 1000)) \
+            .append(LinSpace2D(0, 0, 4, 5).inverse) \
+            .append(Space2D(LogSpace(1, 100), Space()))
+        self.points = [(1 + 6 * i, 1 + 0.25 * i) for i in xrange(9)]
+
+    def assertPointsEqual(self, got, want):
+        self.assertEqual(len(got), len(want))
+        for a, b in zip(got, want):
+            self.assertAlmostEqual(a[0], b[0])
+            self.assertAlmostEqual(a[1], b[1])
+
+    def test_1d(self):
+        space = LogSpace(10, 1000)
+        xs = [10, 50, 100, 1000]
+        for got, x in zip(space.to_box_array(xs), xs):
+            self.assertAlmostEqual(got, space.to_box(x))
+        boxes = [0, 0.25, 1]
+        for got, x in zip(space.inverse.to_box_array(boxes), boxes):
+            self.assertAlmostEqual(got, space.from_box(x))
+
+    def test_composed(self):
+        s = self.space
+        self.assertPointsEqual(s.to_box_array(self.points),
+                               [s.to_box(p) for p in self.points])
+        self.assertPointsEqual(s.from_box_array(self.points),
+                               [s.from_box(p) for p in self.points])
+
+    def test_inverse(self):
+        s = self.space
+        self.assertPointsEqual(s.inverse.to_box_array(self.points),
+                               s.from_box_array(self.points))
+        self.assertPointsEqual(s.inverse.from_box_array(
+                                   s.from_box_array(self.points)),
+                               self.points)
+
+    @unittest.skipIf(spaces.numpy is None, 'needs numpy')
+    def test_shape(self):
+        self.assertEqual(self.space.to_box_array(self.points).shape, (9, 2))
+        self.assertEqual(LinSpace(0, 2).to_box_array(range(5)).shape, (5,))
+
+if __name__ == '__main__':
+    unittest.main()
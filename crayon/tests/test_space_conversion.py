@@ -0,0 +1,152 @@
+from crayon.spaces import (Space, LinSpace, LogSpace, Space2D, LinSpace2D,
+                           AffineSpace2D, ComposedSpace, converter)
+import unittest
+
+def chain(spaces, p):
+    """to_box through spaces one at a time, as ComposedSpace did before
+    fusing"""
+    for space in reversed(spaces):
+        p = space.to_box(p)
+    return p
+
+def unchain(spaces, p):
+    for space in spaces:
+        p = space.from_box(p)
+    return p
+
+class TestFusion(unittest.TestCase):
+    """Fused chains convert as the spaces they were built from"""
+    points = [(0, 0), (1, 1), (-3.5, 12.25), (1e3, 1e-3), (123.456, 7.89)]
+    ## Within the domain of the log spaces below
+    positive = [(7, 3), (10, 12.25), (1e3, 5), (123.456, 7.89)]
+    boxes = [(0, 0), (0.25, 0.5), (1, 1), (0.9, 0.1)]
+
+    def assertSame(self, got, want):
+        for a, b in zip(got, want):
+            self.assertTrue(abs(a - b) <= 1e-12 * max(1.0, abs(b)),
+                            '%r != %r' % (got, want))
+
+    def check(self, parts, composed, points=points):
+        for p in points:
+            self.assertSame(composed.to_box(p), chain(parts, p))
+            self.assertSame(composed.from_box(composed.to_box(p)), p)
+        for p in self.boxes:
+            self.assertSame(composed.from_box(p), unchain(parts, p))
+            self.assertSame(composed.inverse.to_box(p), composed.from_box(p))
+
+    def test_zooms(self):
+        # What Cursor.zoom builds for margins, then a plot area, then a panel
+        parts = [Space2D(), LinSpace2D(0.1, 0.1, 0.9, 0.9).inverse,
+                 LinSpace2D(0.2, 0.05, 0.95, 0.8).inverse,
+                 LinSpace2D(0, 0, 0.5, 0.5).inverse,
+                 LinSpace2D(0, 0, 120, 80)]
+        composed = reduce(lambda a, b: a.append(b), parts)
+        self.assertEqual(len(composed._spaces), 1)
+        self.assertTrue(isinstance(composed._spaces[0], AffineSpace2D))
+        self.check(parts, composed)
+
+    def test_nonlinear(self):
+        log = Space2D(LinSpace(30, 180), LogSpace(10, 1000))
+        parts = [LinSpace2D(0.1, 0.1, 0.9, 0.9).inverse,
+                 LinSpace2D(0, 0, 2, 2), log, LinSpace2D(1, 2, 3, 4),
+                 Space2D(Space(), LinSpace(-1, 1)).inverse]
+        composed = ComposedSpace(*parts)
+        # The log space splits the chain in two
+        self.assertEqual(len(composed._spaces), 3)
+        self.assertTrue(composed._spaces[1] is log)
+        self.check(parts, composed, self.positive)
+
+    def test_nested(self):
+        inner = ComposedSpace(LinSpace2D(0, 0, 4, 4),
+                              Space2D(LogSpace(1, 100), Space()))
+        parts = [LinSpace2D(-1, -1, 1, 1), inner, LinSpace2D(5, 5, 6, 7)]
+        composed = ComposedSpace(*parts)
+        self.assertEqual(len(composed._spaces), 3)
+        self.check(parts, composed, self.positive)
+
+    def test_subclass(self):
+        # A subclass mapping x and y together is kept as it is
+        skew = Skewed(0.5)
+        parts = [LinSpace2D(0, 0, 2, 2), skew, LinSpace2D(1, 1, 3, 3)]
+        composed = ComposedSpace(*parts)
+        self.assertEqual(len(composed._spaces), 3)
+        self.check(parts, composed)
+
+    def test_affine(self):
+        # A general map, with shear, and its inverse
+        space = AffineSpace2D(2.0, 0.5, -1.0, 0.25, 3.0, 4.0)
+        for p in self.points:
+            self.assertSame(space.from_box(space.to_box(p)), p)
+        self.assertRaises(ValueError, AffineSpace2D, 1, 2, 0, 2, 4, 0)
+
+class Skewed(Space2D):
+    """A 2D space that is not the product of its axes"""
+    def __init__(self, shear):
+        Space2D.__init__(self)
+        self.shear = shear
+
+    def to_box(self, p):
+        x, y = p
+        return x + self.shear * y, y
+
+    def from_box(self, p):
+        x, y = p
+        return x - self.shear * y, y
+
+    @property
+    def inverse(self):
+        return Skewed(-self.shear)
+
+class Shifted(Space):
+    """A space with no compiled form of its own"""
+    def to_box(self, x):
+        return x - 1
+
+    def from_box(self, x):
+        return x + 1
+
+class TestConverter(unittest.TestCase):
+    """Compiled conversions give exactly what the methods do"""
+    def setUp(self):
+        self.source = Space2D(LinSpace(2, 10), LogSpace(10, 1000)) \
+            .append(LinSpace2D(0, 0, 4, 5).inverse)
+        self.target = LinSpace2D(0, 0, 80, 60) \
+            .append(LinSpace2D(0.1, 0.1, 0.9, 0.9).inverse) \
+            .append(Space2D(Shifted(), LinSpace(3, 4).inverse))
+        self.points = [(3.0, 2.0), (0.5, 1.25), (2, 7)]
+
+    def test_exact(self):
+        convert = converter(self.source, self.target)
+        for p in self.points:
+            self.assertEqual(convert(p),
+                             self.target.from_box(self.source.to_box(p)))
+        # The other way round goes through the inverses
+        back = converter(self.target.inverse, self.source.inverse)
+        for p in self.points:
+            self.assertEqual(back(p),
+                             self.source.to_box(self.target.from_box(p)))
+
+    def test_subclass(self):
+        # Called through its own methods rather than compiled from its axes
+        source = LinSpace2D(0, 0, 2, 2).append(Skewed(0.5))
+        convert = converter(source, self.target)
+        for p in self.points:
+            self.assertEqual(convert(p),
+                             self.target.from_box(source.to_box(p)))
+
+    def test_arrays(self):
+        convert = converter(self.source, self.target)
+        got = converter(self.source, self.target, arrays=True)(self.points)
+        for a, p in zip(got, self.points):
+            for x, y in zip(a, convert(p)):
+                self.assertAlmostEqual(x, y)
+
+    def test_cached(self):
+        convert = converter(self.source, self.target)
+        self.assertTrue(converter(self.source, self.target) is convert)
+        self.assertFalse(converter(self.target, self.source) is convert)
+        # Constants are written into the function
+        self.assertTrue('0.125' in convert.source)
+
+if __name__ == '__main__':
+    unittest.main()
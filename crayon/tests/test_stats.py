@@ -0,0 +1,69 @@
+from crayon.stats import Stats
+import unittest
+import tempfile
+import shutil
+import json
+import os
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='crayon-test-')
+        self.stats = Stats()
+
+    def test_totals(self):
+        for n in (3, 4):
+            with self.stats.stage('latex', n, processes=1) as run:
+                run.strings_out = n - 1
+        self.stats.count('lookup', hits=5, misses=2)
+        self.stats.count('lookup', hits=1)
+
+        latex = self.stats['latex']
+        self.assertEqual(latex['calls'], 2)
+        self.assertEqual(latex['processes'], 2)
+        self.assertEqual((latex['strings_in'], latex['strings_out']), (7, 5))
+        self.assertTrue(latex['seconds'] >= 0)
+        lookup = self.stats['lookup']
+        self.assertEqual((lookup['calls'], lookup['hits'], lookup['misses']),
+                         (0, 6, 2))
+        self.assertEqual(self.stats['missing']['calls'], 0)
+        self.assertEqual(len(self.stats.report().splitlines()), 3)
+
+    def test_dump(self):
+        self.stats = Stats(trace=True)
+        with self.stats.stage('dvisvgm', 2, processes=1):
+            pass
+        self.stats.dump(os.path.join(self.dir, 'stats.json'))
+        self.stats.dump_trace(os.path.join(self.dir, 'trace.json'))
+
+        with open(os.path.join(self.dir, 'stats.json')) as f:
+            self.assertEqual(json.load(f)['dvisvgm']['strings_in'], 2)
+        with open(os.path.join(self.dir, 'trace.json')) as f:
+            event, = json.load(f)['traceEvents']
+        self.assertEqual((event['name'], event['ph']), ('dvisvgm', 'X'))
+        self.assertEqual(event['args']['processes'], 1)
+
+    def test_trace_bounds(self):
+        # Without trace only the totals are kept
+        for i in xrange(5):
+            with self.stats.stage('latex'):
+                pass
+        self.assertEqual(self.stats._events, None)
+        self.assertEqual(self.stats['latex']['calls'], 5)
+        self.assertRaises(ValueError, self.stats.dump_trace,
+                          os.path.join(self.dir, 'trace.json'))
+
+        stats = Stats(trace=3)
+        for i in xrange(5):
+            with stats.stage('latex', i):
+                pass
+        stats.dump_trace(os.path.join(self.dir, 'trace.json'))
+        with open(os.path.join(self.dir, 'trace.json')) as f:
+            events = json.load(f)['traceEvents']
+        self.assertEqual([e['args']['strings_in'] for e in events], [2, 3, 4])
+        self.assertEqual(stats['latex']['calls'], 5)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+from crayon.templite import Templite
+import unittest
+import threading
+import StringIO
+import sys
+
+class TestTemplite(unittest.TestCase):
+    template = ('head\n${ for n, t in enumerate(items): }$'
+                '[${n}$:${t}$${ if n % 2: }$ odd${:else:}$ even${:end}$]\n'
+                '${:end}$${ emit("tail", 1) }$')
+
+    def expected(self, items):
+        return 'head\n%stail1' % ''.join(
+            '[%d:%s %s]\n' % (n, t, 'odd' if n % 2 else 'even')
+            for n, t in enumerate(items))
+
+    def test_modes(self):
+        tpl = Templite(self.template)
+        items = ['"a"', '\\b', 'c']
+        f = StringIO.StringIO()
+        tpl.render_to(f, items=items)
+        self.assertEqual(f.getvalue(), self.expected(items))
+        self.assertEqual(''.join(tpl.generate(items=items)),
+                         self.expected(items))
+        self.assertEqual(tpl.render(items=items), self.expected(items))
+
+    def test_chunks(self):
+        tpl = Templite(self.template)
+        items = range(1000)
+        stdout = sys.stdout
+        chunks = tpl.generate(items=items)
+        self.assertTrue(sys.stdout is stdout)
+        chunks = list(chunks)
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(''.join(chunks), self.expected(items))
+
+    def test_threads(self):
+        tpl = Templite(self.template)
+        results = {}
+        def run(k):
+            f = StringIO.StringIO()
+            tpl.render_to(f, items=range(k, k + 500))
+            results[k] = (f.getvalue(),
+                          ''.join(tpl.generate(items=range(k))))
+        threads = [threading.Thread(target=run, args=(k,))
+                   for k in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for k in xrange(8):
+            self.assertEqual(results[k], (self.expected(range(k, k + 500)),
+                                          self.expected(range(k))))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,7 +2,9 @@ from typesys import Int, String, Tuple, Color, Float, NameSpace, Maybe
 from crayon.spaces import LinSpace, LogSpace, Space2D
 from crayon.color import Rgb
 
+import calendar
 import math
+import time
 
 ceil = lambda x : int(math.ceil(x))
 floor = lambda x: int(math.floor(x))
@@ -58,6 +60,124 @@ class LogTicker(NameSpace):
 
         return lsum([0.1*i*x for i in xrange(2,10)] for x,_ in self.major[1:])
 
+def nice_step(span, count):
+    """The smallest of 1, 2 or 5 times a power of ten that divides span,
+    which must be positive, into at most count steps"""
+    raw = span / float(max(count, 1))
+    power = 10 ** floor(math.log10(raw))
+    for m in (1, 2, 5, 10):
+        if m * power >= raw:
+            return m * power
+
+def nice_ticks(a, b, count):
+    """Major ticks at round values from a to b, about count of them; none
+    if the range is empty"""
+    if b <= a:
+        return []
+    dx = nice_step(b - a, count)
+    return [(i * dx, '$%g$' % (i * dx))
+            for i in xrange(ceil(a / dx - 1e-9), floor(b / dx + 1e-9) + 1)]
+
+class SymLogTicker(NameSpace):
+    """A ticker for SymLogSpace axes: zero and the decades either side of
+    it beyond linthresh, or round values if the range lies within
+    linthresh"""
+    range = Tuple(Float(), Float())
+    linthresh = Float(default=1.0)
+    count = Int(default=6)
+
+    def _to_str(self, x):
+        if not x:
+            return '$0$'
+        return '$%s10^{%d}$' % ('-' if x < 0 else '', round(log(abs(x), 10)))
+
+    @property
+    def major(self):
+        a, b = sorted(self.range)
+        first = ceil(log(self.linthresh, 10) - 0.0001)
+        top = max(abs(a), abs(b))
+        if top < 10 ** first:
+            return nice_ticks(a, b, self.count)
+        decades = [10 ** i for i in xrange(first, floor(log(top, 10) +
+                                                         0.0001) + 1)]
+        ticks = [-x for x in reversed(decades)] + [0] + decades
+        return [(x, self._to_str(x)) for x in ticks if a <= x <= b]
+
+    @property
+    def minor(self):
+        a, b = sorted(self.range)
+        decades = [x for x, _ in self.major if x]
+        return [x for d in decades for x in
+                (0.1 * i * d for i in xrange(2, 10))
+                if a <= x <= b and abs(x) > self.linthresh]
+
+class PowerTicker(NameSpace):
+    """A ticker for PowerSpace axes, at round values about count to the
+    axis"""
+    range = Tuple(Float(), Float())
+    count = Int(default=6)
+
+    @property
+    def major(self):
+        a, b = sorted(self.range)
+        return nice_ticks(a, b, self.count)
+
+    @property
+    def minor(self):
+        return ()
+
+class DateTimeTicker(NameSpace):
+    """A ticker for DateTimeSpace axes, whose range is in seconds since the
+    epoch. Picks the shortest step of whole seconds, minutes, hours, days,
+    months or years that gives at most count ticks, and labels them in
+    UTC."""
+    range = Tuple(Float(), Float())
+    count = Int(default=6)
+
+    ## (seconds, label format)
+    _steps = ([(s, '%H:%M:%S') for s in (1, 2, 5, 10, 15, 30)] +
+              [(60 * m, '%H:%M') for m in (1, 2, 5, 10, 15, 30)] +
+              [(3600 * h, '%d %b %H:%M') for h in (1, 2, 3, 6, 12)] +
+              [(86400 * d, '%d %b') for d in (1, 2, 7)])
+    _month_steps = (1, 2, 3, 6)
+
+    @property
+    def major(self):
+        a, b = sorted(self.range)
+        for step, fmt in self._steps:
+            if (b - a) / step <= self.count:
+                ticks = [i * step for i in xrange(ceil(a / step),
+                                                  floor(b / step) + 1)]
+                return self._label(ticks, fmt)
+
+        # Months and years are not all the same length
+        start = time.gmtime(a)
+        months = start.tm_year * 12 + start.tm_mon - 1
+        span = (b - a) / (30.44 * 86400)
+        for step in self._month_steps:
+            if span / step <= self.count:
+                fmt = '%b %Y'
+                break
+        else:
+            step = 12 * int(max(1, nice_step(span / 12, self.count)))
+            fmt = '%Y'
+        first = months + (-months) % step
+        ticks = []
+        for m in xrange(first, months + int(span) + step + 1, step):
+            t = calendar.timegm((m // 12, m % 12 + 1, 1, 0, 0, 0))
+            if t > b:
+                break
+            if t >= a:
+                ticks.append(t)
+        return self._label(ticks, fmt)
+
+    @property
+    def minor(self):
+        return ()
+
+    def _label(self, ticks, fmt):
+        return [(t, time.strftime(fmt, time.gmtime(t))) for t in ticks]
+
 class Layer(NameSpace):
     def __init__(self):
         super(Layer, self).__init__()
@@ -39,5 +39,36 @@ class TestHisto(unittest.TestCase):
         self.histo.draw(canvas.cursor())
         c.finish()
 
+class TestTickers(unittest.TestCase):
+    def test_symlog(self):
+        ticker = layers.SymLogTicker()
+        ticker.range = -500, 20000
+        self.assertEqual([x for x, _ in ticker.major],
+                         [-100, -10, -1, 0, 1, 10, 100, 1000, 10000])
+        self.assertEqual(ticker.major[0][1], '$-10^{2}$')
+        # Within linthresh there are no decades, so round values instead
+        ticker.range = 0.5, 0.9
+        self.assertEqual([label for _, label in ticker.major],
+                         ['$0.5$', '$0.6$', '$0.7$', '$0.8$', '$0.9$'])
+
+    def test_power(self):
+        ticker = layers.PowerTicker()
+        ticker.range = 0, 37
+        self.assertEqual(ticker.major, [(0, '$0$'), (10, '$10$'),
+                                        (20, '$20$'), (30, '$30$')])
+        ticker.range = 5, 5
+        self.assertEqual(ticker.major, [])
+
+    def test_datetime(self):
+        ticker = layers.DateTimeTicker()
+        start = 1577836800      # 2020-01-01
+        ticker.range = start + 17, start + 3000
+        self.assertEqual([label for _, label in ticker.major],
+                         ['00:10', '00:20', '00:30', '00:40', '00:50'])
+        ticker.range = start, start + 400 * 86400
+        self.assertEqual([label for _, label in ticker.major],
+                         ['Jan 2020', 'Apr 2020', 'Jul 2020', 'Oct 2020',
+                          'Jan 2021'])
+
 if __name__=='__main__':
     unittest.main()
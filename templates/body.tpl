@@ -1,5 +1,6 @@
 \begin{document}
-${ for t in texes: }$
+${ for n, t in enumerate(texes): }$
+  \immediate\write-1{crayon-label:${n}$}
   \begin{preview}
     ${t}$
   \end{preview}